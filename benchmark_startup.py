@@ -0,0 +1,74 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+"""
+Measures how long model2dsgx.py takes to start, and what it imports.
+
+The converter runs once per model in an asset build, so its start up time adds
+up. This runs model2dsgx.py --version (which loads the script and its imports
+but converts nothing) repeatedly, reports the fastest and median times, and
+lists any optional importer backends that were loaded at start up, which
+should be none.
+
+Usage:
+    benchmark_startup.py [--runs=<n>] [--limit=<seconds>]
+
+Options:
+    -h --help          Print this message and exit
+    --runs=<n>         Number of times to start the converter [default: 20]
+    --limit=<seconds>  Exit with an error if the median start up time is
+                       slower than this
+"""
+import os, statistics, subprocess, sys, time
+from docopt import docopt
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CONVERTER = os.path.join(SCRIPT_DIRECTORY, "model2dsgx.py")
+
+# Modules that only specific importers need, and that must not be loaded
+# before a file asks for them.
+OPTIONAL_MODULES = ["FbxCommon", "PIL", "pyassimp", "model.fbx_importer",
+    "model.obj_importer", "model.assimp_importer"]
+
+CHECK_IMPORTS = """
+import sys
+sys.argv = ["model2dsgx.py", "--version"]
+try:
+    import model2dsgx
+finally:
+    print(",".join(name for name in %r if name in sys.modules))
+""" % OPTIONAL_MODULES
+
+def time_startup(runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, CONVERTER, "--version"],
+            stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def loaded_optional_modules():
+    result = subprocess.run([sys.executable, "-c", CHECK_IMPORTS],
+        cwd=SCRIPT_DIRECTORY, stdout=subprocess.PIPE, check=True,
+        universal_newlines=True)
+    return [name for name in result.stdout.strip().split(",") if name]
+
+def main():
+    arguments = docopt(__doc__)
+    times = time_startup(int(arguments["--runs"]))
+    median = statistics.median(times)
+    print("Start up: fastest %.1f ms, median %.1f ms over %d runs" %
+        (min(times) * 1000, median * 1000, len(times)))
+
+    loaded = loaded_optional_modules()
+    if loaded:
+        print("Optional modules loaded at start up: %s" % ", ".join(loaded))
+    else:
+        print("No optional modules loaded at start up")
+
+    limit = arguments["--limit"]
+    if loaded or (limit and median > float(limit)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,3 @@
 #happy
 
+VERSION = "0.1d"
@@ -0,0 +1,69 @@
+"""Minimal bounding spheres of point sets.
+
+The sphere is found by Welzl's algorithm, run on a small support set of points
+rather than on every vertex. The support set starts with the extreme points
+along each axis; after each pass, the point furthest outside the sphere found
+so far is added, and the sphere found again. Distances to every point are
+taken as whole-array operations, and in practice only a few dozen points ever
+join the support set, so the exact sphere is found quickly even for large
+meshes.
+"""
+
+import numpy
+
+# Relative slack when testing whether a point lies within a sphere, to absorb
+# rounding errors.
+EPSILON = 1e-9
+
+def _circumsphere(boundary):
+    """Find the smallest sphere with every point of boundary on its surface.
+
+    Points that are collinear or coplanar (with too few points to span that
+    many dimensions) are handled by solving in the least squares sense.
+    """
+    if not boundary:
+        return numpy.zeros(3), -1.0
+    origin = boundary[0]
+    if len(boundary) == 1:
+        return origin, 0.0
+    edges = numpy.array(boundary[1:]) - origin
+    gram = 2 * edges @ edges.T
+    lengths = (edges ** 2).sum(axis=1)
+    weights = numpy.linalg.lstsq(gram, lengths, rcond=None)[0]
+    center = origin + weights @ edges
+    return center, float(numpy.sqrt(((center - origin) ** 2).sum()))
+
+def _contains(sphere, point):
+    center, radius = sphere
+    return (numpy.sqrt(((point - center) ** 2).sum()) <=
+        radius + EPSILON * max(radius, 1.0))
+
+def _welzl(points, boundary):
+    sphere = _circumsphere(boundary)
+    if len(boundary) == 4:
+        return sphere
+    for index, point in enumerate(points):
+        if not _contains(sphere, point):
+            sphere = _welzl(points[:index], boundary + [point])
+    return sphere
+
+def minimal_sphere(points):
+    """Return the center and radius of the smallest sphere around points.
+
+    points is an (n, 3) array. The center is returned as an array of three
+    values. An empty set of points has a sphere of radius zero at the origin.
+    """
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if not len(points):
+        return numpy.zeros(3), 0.0
+    support = sorted(set(points.argmin(axis=0)) | set(points.argmax(axis=0)))
+    while True:
+        center, radius = _welzl([points[index] for index in support], [])
+        distances = numpy.sqrt(((points - center) ** 2).sum(axis=1))
+        furthest = int(distances.argmax())
+        if (distances[furthest] <= radius + EPSILON * max(radius, 1.0) or
+            furthest in support):
+            break
+        support.append(furthest)
+    # Rounding can leave a point a hair outside; grow the sphere to cover it.
+    return center, max(radius, float(distances[furthest]))
@@ -0,0 +1,64 @@
+"""Checks meshes against the geometry engine's per frame limits.
+
+The geometry engine holds at most 2048 polygons and 6144 vertices per frame,
+and whatever doesn't fit is silently dropped. A mesh's worst case use of each
+is worked out from its command stream, which counts the vertices strips share
+only once, and from its face normals, as back facing polygons are culled
+before they are stored. Both give an upper bound, and the lower of the two is
+used.
+"""
+
+POLYGON_LIMIT = 2048
+VERTEX_LIMIT = 6144
+
+BEGIN_VTXS = 0x40
+VERTEX_COMMANDS = {0x23, 0x24, 0x25, 0x26, 0x27, 0x28}
+
+# The polygons made from n vertices in each primitive type.
+_POLYGONS = (
+    lambda n: n // 3,
+    lambda n: n // 4,
+    lambda n: max(n - 2, 0),
+    lambda n: max(n - 2, 0) // 2,
+)
+
+class BudgetExceeded(ValueError):
+    pass
+
+def stream_usage(commands):
+    """Count the polygons and vertices a command stream draws, without culling.
+
+    Returns a (polygons, vertices) pair.
+    """
+    polygons = vertices = 0
+    primitive_type = None
+    list_vertices = 0
+    for index, instruction in enumerate(commands.instructions):
+        if instruction == BEGIN_VTXS:
+            if primitive_type is not None:
+                polygons += _POLYGONS[primitive_type](list_vertices)
+            primitive_type = commands.parameters(index)[0] & 0x3
+            list_vertices = 0
+        elif instruction in VERTEX_COMMANDS:
+            list_vertices += 1
+            vertices += 1
+    if primitive_type is not None:
+        polygons += _POLYGONS[primitive_type](list_vertices)
+    return polygons, vertices
+
+def worst_case_usage(mesh, commands):
+    """Find the most polygons and vertices mesh can use in a frame."""
+    polygons, vertices = stream_usage(commands)
+    return (min(polygons, mesh.max_cull_polys()),
+        min(vertices, mesh.max_cull_vertices()))
+
+def within(usage, max_polygons=None, max_vertices=None):
+    polygons, vertices = usage
+    return ((not max_polygons or polygons <= max_polygons) and
+        (not max_vertices or vertices <= max_vertices))
+
+def describe(mesh_name, usage, max_polygons=None, max_vertices=None):
+    polygons, vertices = usage
+    return "%s: %d polygons (budget %s), %d vertices (budget %s)" % (
+        mesh_name, polygons, max_polygons or "none", vertices,
+        max_vertices or "none")
@@ -0,0 +1,166 @@
+"""An on-disk cache of conversion results.
+
+Entries are stored under the hash of everything that went into them, so a
+changed input simply misses rather than needing to be invalidated. Two kinds of
+entries are kept:
+
+Whole conversions are keyed by the path and bytes of the input file, the
+converter version and the conversion options. Files the input refers to
+(material libraries, textures) are only known after loading it, so the
+dependency list is stored under that key, and the output under a second key
+that also covers the current contents of every dependency.
+
+Single meshes are keyed by the mesh's arrays, the materials and groups it uses,
+the model's global matrix, the options and the converter version, so that only
+the changed meshes of a multi-mesh model are converted again.
+
+The cache is trimmed back to its size limit by evicting the least recently
+used entries first.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+from model import VERSION
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache",
+    "dsgx-converter")
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+def _digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else repr(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+def hash_file(filename):
+    """Hash the contents of filename, or return None if it can't be read."""
+    digest = hashlib.sha256()
+    try:
+        with open(filename, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def _material_description(material):
+    return (material.texture, getattr(material, "texture_size", None),
+        material.ambient, material.diffuse, material.specular, material.emit)
+
+class Cache:
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory if directory else DEFAULT_DIRECTORY
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the bytes stored under key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            # The modification time doubles as the last use time for eviction.
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so other processes sharing the cache
+        # never read a partly written entry.
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path))
+        with os.fdopen(descriptor, "wb") as fp:
+            fp.write(data)
+        os.replace(temporary_path, path)
+
+    def get_object(self, key):
+        data = self.get(key)
+        return pickle.loads(data) if data is not None else None
+
+    def put_object(self, key, value):
+        self.put(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def entries(self):
+        """List (path, size in bytes, last use time) for every entry."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, status.st_size, status.st_mtime))
+        return entries
+
+    def info(self):
+        """Return the number of entries and their total size in bytes."""
+        entries = self.entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def evict(self):
+        """Remove the least recently used entries until under max_size."""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def conversion_key(self, input_filename, options):
+        # The path is part of the key, as relative references in the input are
+        # resolved against it.
+        return _digest("conversion", VERSION, os.path.abspath(input_filename),
+            hash_file(input_filename), sorted(options.items()))
+
+    def _output_key(self, conversion_key, dependencies):
+        return _digest(conversion_key, [(dependency, hash_file(dependency))
+            for dependency in dependencies])
+
+    def load_conversion(self, input_filename, options):
+        """Return the cached output for input_filename, or None."""
+        conversion_key = self.conversion_key(input_filename, options)
+        dependencies = self.get_object(conversion_key)
+        if dependencies is None:
+            return None
+        return self.get(self._output_key(conversion_key, dependencies))
+
+    def store_conversion(self, input_filename, options, dependencies, data):
+        conversion_key = self.conversion_key(input_filename, options)
+        dependencies = sorted(os.path.abspath(dependency)
+            for dependency in dependencies)
+        self.put_object(conversion_key, dependencies)
+        self.put(self._output_key(conversion_key, dependencies), data)
+
+    def mesh_key(self, model, mesh, options):
+        materials = [(name, _material_description(model.materials[name]))
+            for name in mesh.material_names]
+        arrays = [getattr(mesh, name).tobytes() for name in ("positions",
+            "vertex_groups", "polygon_offsets", "polygon_vertices",
+            "polygon_uvs", "polygon_vertex_normals", "polygon_normals",
+            "polygon_materials", "polygon_flags")]
+        return _digest("mesh", VERSION, mesh.name, materials,
+            model.groups, tuple(model.global_matrix), options, *arrays)
@@ -0,0 +1,202 @@
+"""A compact container for lists of geometry commands.
+
+Commands are kept in parallel flat arrays instead of one dict per command: one
+byte per command for the instruction, a single array of 32 bit parameter words
+shared by every command, the offset of each command's first parameter word, and
+a sparse table of tags keyed by command index. A call list is laid out from
+these arrays in one go, without building bytes for each command.
+
+Breaks mark the commands the engine may start sending from, skipping the
+commands since the previous break. A break always starts a new command word,
+and no command after it relies on state set before it.
+"""
+
+from array import array
+from bisect import bisect_right
+from collections import Counter
+
+import numpy
+
+import model.geometry_command as gc
+
+WORD_TYPE = "I" if array("I").itemsize == 4 else "L"
+COMMANDS_PER_WORD = 4
+
+class CommandBuffer:
+    def __init__(self):
+        self.instructions = array("B")
+        self.offsets = array(WORD_TYPE, [0])
+        self.params = array(WORD_TYPE)
+        self.tags = {}
+        self.breaks = set()
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def add(self, instruction, words=(), tag=None):
+        """Add one command given its parameters as integer words."""
+        if tag:
+            self.tags[len(self.instructions)] = tag
+        self.instructions.append(instruction)
+        self.params.extend(words)
+        self.offsets.append(len(self.params))
+
+    def add_break(self):
+        """Put a break before the next command added."""
+        self.breaks.add(len(self.instructions))
+
+    def append(self, command):
+        """Add an (instruction, words, tag) triple from geometry_command."""
+        self.add(*command)
+
+    def extend(self, commands):
+        """Add every command from commands.
+
+        commands may be another CommandBuffer, or any nesting of lists of
+        command triples; empty entries are skipped.
+        """
+        if isinstance(commands, CommandBuffer):
+            base_index = len(self.instructions)
+            base_offset = len(self.params)
+            self.instructions.extend(commands.instructions)
+            self.params.extend(commands.params)
+            self.offsets.extend(offset + base_offset
+                for offset in commands.offsets[1:])
+            self.tags.update((index + base_index, tag)
+                for index, tag in commands.tags.items())
+            self.breaks.update(index + base_index for index in commands.breaks)
+        elif isinstance(commands, tuple):
+            self.append(commands)
+        else:
+            for command in commands:
+                if command:
+                    self.extend(command)
+
+    def copy_command(self, source, index):
+        """Add command index of the buffer source."""
+        if index in source.breaks:
+            self.add_break()
+        self.add(source.instructions[index], source.parameters(index),
+            source.tags.get(index))
+
+    def select(self, indices):
+        """Build a new buffer holding only the commands at indices, in order.
+
+        A break before a command that is left out moves to the next command
+        kept.
+        """
+        selected = CommandBuffer()
+        breaks = sorted(self.breaks)
+        previous = -1
+        for index in indices:
+            if bisect_right(breaks, index) > bisect_right(breaks, previous):
+                selected.add_break()
+            selected.copy_command(self, index)
+            previous = index
+        if len(breaks) > bisect_right(breaks, previous):
+            selected.add_break()
+        return selected
+
+    def parameters(self, index):
+        return self.params[self.offsets[index]:self.offsets[index + 1]]
+
+    def parameter_count(self, index):
+        return self.offsets[index + 1] - self.offsets[index]
+
+    def word_count(self):
+        """Count the words used by the commands sent one per command word."""
+        return len(self.instructions) + len(self.params)
+
+    def cycles(self):
+        """Count the geometry engine cycles spent on these commands."""
+        return sum(gc.CYCLES[instruction] * count
+            for instruction, count in Counter(self.instructions).items())
+
+    def pack(self, packed=False):
+        """Split the commands into the groups that share a command word.
+
+        Unpacked, every command gets a command word of its own. Packed, up to
+        four commands share one command word, and their parameters follow it in
+        order. Unused slots are left as zero (NOP).
+
+        A command word that ends in commands without parameters is followed by
+        a zero dummy parameter word. To avoid that where possible, trailing
+        parameterless commands are pushed into the next command word. A break
+        always starts a new command word.
+
+        Returns a list of (first command, end command, needs dummy parameter)
+        triples.
+        """
+        count = len(self.instructions)
+        if not packed:
+            return [(index, index + 1, False) for index in range(count)]
+        offsets = self.offsets
+        has_params = lambda index: offsets[index + 1] > offsets[index]
+        breaks = sorted(self.breaks) + [count]
+        groups = []
+        start = 0
+        while start < count:
+            end = min(start + COMMANDS_PER_WORD,
+                breaks[bisect_right(breaks, start)])
+            # Hand trailing parameterless commands over to the next word, as
+            # long as this word keeps at least one command.
+            while end < count and end - start > 1 and not has_params(end - 1):
+                end -= 1
+            groups.append((start, end, not has_params(end - 1)))
+            start = end
+        return groups
+
+    def layout(self, packed=False):
+        """Lay the commands out as a call list.
+
+        Returns the call list words as a numpy array, and the position of each
+        command's first parameter word within it.
+        """
+        groups = self.pack(packed)
+        instructions = numpy.array(self.instructions, dtype=numpy.uint8)
+        offsets = numpy.array(self.offsets, dtype=numpy.int64)
+        starts = numpy.array([group[0] for group in groups], dtype=numpy.int64)
+        ends = numpy.array([group[1] for group in groups], dtype=numpy.int64)
+        dummies = numpy.array([group[2] for group in groups], dtype=numpy.int64)
+        group_params = offsets[ends] - offsets[starts] + dummies
+        # Each group takes a command word, its parameters and maybe a dummy.
+        group_positions = numpy.zeros(len(groups), dtype=numpy.int64)
+        numpy.cumsum(1 + group_params[:-1], out=group_positions[1:])
+        total = int(group_positions[-1] + 1 + group_params[-1]) if groups else 0
+
+        command_words = numpy.zeros(len(groups), dtype=numpy.uint32)
+        group_of_command = numpy.repeat(numpy.arange(len(groups)), ends - starts)
+        slots = numpy.arange(len(instructions)) - starts[group_of_command]
+        numpy.bitwise_or.at(command_words, group_of_command,
+            instructions.astype(numpy.uint32) << (8 * slots).astype(numpy.uint32))
+
+        parameter_positions = (group_positions[group_of_command] + 1 +
+            offsets[:-1] - offsets[starts[group_of_command]])
+
+        words = numpy.zeros(total, dtype=numpy.uint32)
+        words[group_positions] = command_words
+        parameter_counts = numpy.diff(offsets)
+        parameter_slots = (numpy.repeat(parameter_positions, parameter_counts) +
+            numpy.arange(len(self.params)) -
+            numpy.repeat(offsets[:-1], parameter_counts))
+        words[parameter_slots] = numpy.array(self.params, dtype=numpy.uint32)
+        return words, parameter_positions
+
+    def break_positions(self, parameter_positions, word_count):
+        """Find the word each break starts at, given the call list layout.
+
+        Returns a dict from command index to word position. A break after the
+        last command is at the end of the call list.
+        """
+        return {index: int(parameter_positions[index]) - 1
+            if index < len(self.instructions) else word_count
+            for index in self.breaks}
+
+    def references(self, instructions, parameter_positions):
+        """Collect the positions of tagged commands' parameters by tag."""
+        references = {}
+        for index, tag in sorted(self.tags.items()):
+            if self.instructions[index] in instructions:
+                references.setdefault(tag, []).append(
+                    int(parameter_positions[index]))
+        return references
@@ -0,0 +1,92 @@
+"""Groups faces into clusters with tight normal cones.
+
+A cluster whose face normals all lie within a cone can be skipped as a whole
+when the camera looks at it from behind: if the direction from the camera to
+a face lies within 90 degrees minus the cone's half angle of the cone's axis,
+the face faces away. The cone is recorded as the sine of the half angle, the
+cutoff; a cone of 90 degrees or wider can never face away entirely, and gets
+a cutoff above one.
+
+Under a perspective projection that direction differs from face to face, so
+each cluster also records the center and radius of a sphere around its faces.
+With the camera at eye, every face of the cluster faces away when
+
+    dot(center - eye, axis) >= cutoff * length(center - eye) +
+        radius * (1 + cutoff)
+
+Moving from the center to any point within the sphere lowers the left side by
+at most radius, and raises cutoff * length by at most cutoff * radius, so the
+test for the direction to that point still holds. It never holds with the
+camera inside the sphere. Vertices moved by
+bones leave their sphere, so the test only applies to a bone's cluster once
+the camera is brought into the bone's space.
+
+Clusters are grown greedily: the first face not yet clustered seeds a cluster,
+which takes every remaining face whose normal is within the maximum angle of
+the seed's. Clusters too small to be worth skipping separately, and faces
+without a usable normal, are gathered into one last cluster.
+"""
+
+import math
+
+import numpy
+
+MIN_CLUSTER_FACES = 4
+NEVER_CULLED = 2.0
+
+def unit_vectors(vectors):
+    """Scale vectors to unit length, leaving zero length vectors as they are."""
+    vectors = numpy.asarray(vectors, dtype=float).reshape(-1, 3)
+    lengths = numpy.sqrt((vectors ** 2).sum(axis=1))
+    return vectors / numpy.where(lengths > 1e-9, lengths, 1.0)[:, None]
+
+def cone(normals):
+    """Find a cone around normals, returning its axis and cutoff.
+
+    The axis is the direction of the normals' average, or of the first normal
+    if that gives a narrower cone.
+    """
+    normals = unit_vectors(normals)
+    best = None
+    average = normals.sum(axis=0)
+    for axis in (average, normals[0]):
+        length = numpy.sqrt((axis ** 2).sum())
+        if length < 1e-9:
+            continue
+        axis = axis / length
+        spread = numpy.clip(normals @ axis, -1.0, 1.0).min()
+        if best is None or spread > best[1]:
+            best = axis, spread
+    if best is None:
+        return numpy.zeros(3), NEVER_CULLED
+    axis, spread = best
+    half_angle = math.acos(spread)
+    if half_angle >= math.pi / 2:
+        return axis, NEVER_CULLED
+    return axis, math.sin(half_angle)
+
+def cluster(normals, max_angle, min_faces=MIN_CLUSTER_FACES):
+    """Split faces into clusters whose normals lie within max_angle radians.
+
+    normals is an (n, 3) array of face normals. Returns a list of arrays of
+    face indices, in their original order within each cluster.
+    """
+    unit = unit_vectors(normals)
+    usable = (unit ** 2).sum(axis=1) > 0.5
+    leftovers = [numpy.flatnonzero(~usable)]
+    clusters = []
+    remaining = numpy.flatnonzero(usable)
+    cos_limit = math.cos(max_angle)
+    while remaining.size:
+        within = unit[remaining] @ unit[remaining[0]] >= cos_limit
+        within[0] = True
+        members = remaining[within]
+        remaining = remaining[~within]
+        if len(members) < min_faces:
+            leftovers.append(members)
+        else:
+            clusters.append(members)
+    leftovers = numpy.sort(numpy.concatenate(leftovers))
+    if leftovers.size:
+        clusters.append(leftovers)
+    return clusters
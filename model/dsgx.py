@@ -8,18 +8,35 @@ alignment, elimintating the possibility of unaligned data without the need for
 complex padding rules.
 """
 
-import logging, struct
-from collections import defaultdict
+import logging, math, struct
+from concurrent.futures import ProcessPoolExecutor
 from itertools import groupby
 from operator import methodcaller, attrgetter
 import types
 
 import euclid3 as euclid
+import numpy
+
+import model.bounds as bounds
+import model.budget as budget
+from model.budget import BudgetExceeded
+import model.cones as cones
 import model.geometry_command as gc
+from model.command_buffer import CommandBuffer
+import model.keyframes as keyframes
+from model.names import NameClash, find_clashes
+import model.partition as partition
+import model.peephole as peephole
+import model.quads as quads
+import model.simplify as simplify
+import model.stripify as stripify
+import model.vertex_deltas as vertex_deltas
 from model.geometry_command import _to_fixed_point
 
 log = logging.getLogger()
 WORD_SIZE_BYTES = 4
+# The furthest distance a signed 20.12 fixed point word holds.
+MAX_DISTANCE = (2 ** 31 - 1) / 2 ** 12
 
 def reconcile(new):
     """Ensure two functions return the same values given the same arugments."""
@@ -35,9 +52,6 @@ def reconcile(new):
         return reconciler
     return reconcile_decorator
 
-def compact(iterable):
-    return (element for element in iterable if element)
-
 # from https://stackoverflow.com/a/10824420
 def flatten(container):
     for i in container:
@@ -85,7 +99,7 @@ def parse_material_flags(material_name):
     The pipe character indicates that flags are present, and the flags are comma
     separated. A flag without a value is interpreted as a boolean True.
     """
-    if "|" not in material_name:
+    if not material_name or "|" not in material_name:
         return {}
     flags_string = material_name.split("|")[0]
     flag_parts = (flag.split("=") for flag in flags_string.split(","))
@@ -107,16 +121,67 @@ def generate_face_attributes(material, flags):
     polygon_attributes = gc.polygon_attr(light0=1, light1=1, light2=1, light3=1,
         alpha=int(flags.get("alpha", 31)), polygon_id=int(flags.get("id", 0)))
     scale = lambda components: gc._scale_components(components, 255)
-    material_properties = (gc.dif_amb(scale(material.diffuse),
+    material_properties = [gc.dif_amb(scale(material.diffuse),
         scale(material.ambient), use_24bit=True),
         gc.spe_emi(scale(material.specular), scale(material.emit),
-        use_24bit=True))
-    return list(flatten([texture_attributes,  polygon_attributes,
-        material_properties]))
+        use_24bit=True)]
+    return [texture_attributes, polygon_attributes, material_properties]
 
-def generate_vertex(location, scale_factor, vtx10=False, tag=None):
-    vtx = gc.vtx_10 if vtx10 else gc.vtx_16
-    return vtx(location.x * scale_factor, location.y * scale_factor, location.z * scale_factor, tag)
+def generate_vertices(positions, scale_factor, vtx10=False):
+    vtx_many = gc.vtx_10_many if vtx10 else gc.vtx_16_many
+    return vtx_many(positions * scale_factor)
+
+def _signed_16(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+def compact_vertex(position, previous, tag=None):
+    """Find a one word vertex command that sends position exactly.
+
+    Both position and previous are the 16 bit (1.3.12) coordinates the hardware
+    holds, and previous must be the vertex the hardware last received. Returns
+    None when only a full VTX_16 reproduces position.
+    """
+    x, y, z = position
+    last_x, last_y, last_z = previous
+    to_float = lambda value: _signed_16(value) / 2 ** 12
+    if z == last_z:
+        return gc.vtx_xy(to_float(x), to_float(y), tag)
+    if y == last_y:
+        return gc.vtx_xz(to_float(x), to_float(z), tag)
+    if x == last_x:
+        return gc.vtx_yz(to_float(y), to_float(z), tag)
+    deltas = [_signed_16(new) - _signed_16(old) for new, old in zip(position,
+        previous)]
+    if all(-512 <= delta <= 511 for delta in deltas):
+        return gc.vtx_diff(*(delta / 2 ** 12 for delta in deltas), tag=tag)
+    return None
+
+def compact_vertices(commands):
+    """Replace VTX_16 commands with cheaper ones that give the same vertex.
+
+    Tracks the last vertex sent within each polygon list and picks the first of
+    VTX_XY, VTX_XZ, VTX_YZ or VTX_DIFF that reproduces the exact 16 bit
+    position, saving a parameter word each time. Tracking starts over at every
+    BEGIN_VTXS, so each polygon list can be sent on its own.
+    """
+    previous = None
+    compacted = CommandBuffer()
+    for index, instruction in enumerate(commands.instructions):
+        if instruction == 0x40 or index in commands.breaks:
+            previous = None
+        elif instruction == 0x23:
+            xy, z = commands.parameters(index)
+            position = xy & 0xFFFF, xy >> 16, z & 0xFFFF
+            replacement = (compact_vertex(position, previous,
+                commands.tags.get(index)) if previous else None)
+            previous = position
+            if replacement:
+                if index in commands.breaks:
+                    compacted.add_break()
+                compacted.append(replacement)
+                continue
+        compacted.copy_command(commands, index)
+    return compacted
 
 def determine_scale_factor(box):
     largest_coordinate = max(abs(box["wx"]), abs(box["wy"]), abs(box["wz"]))
@@ -130,54 +195,134 @@ def generate_defaults():
         gc.dif_amb(default_diffuse_color, default_ambient_color,
         use_24bit=True)]
 
-def generate_polygon_list_start(points_per_polygon):
+def generate_polygon_list_start(points_per_polygon, strip=False):
     assert points_per_polygon in (3, 4), \
         "invalid number of points in polygon: %d" % points_per_polygon
+    if strip:
+        return gc.begin_vtxs(gc.PrimitiveType.TRIANGLE_STRIPS
+            if points_per_polygon == 3 else
+            gc.PrimitiveType.QUADRILATERAL_STRIPS)
     return gc.begin_vtxs(gc.PrimitiveType.SEPARATE_TRIANGLES
         if points_per_polygon == 3 else
         gc.PrimitiveType.SEPAPATE_QUADRILATERALS)
 
-def generate_face(material, vertices, face, scale_factor, vtx10=False):
-    commands = [gc.normal(*face.face_normal)
-        if not face.smooth_shading else None]
-    for i, vertex_index in enumerate(face.vertices):
-        if material.texture:
-            commands.append(gc.texcoord(
-                face.uvlist[i][0] * material.texture_size[0],
-                (1.0 - face.uvlist[i][1]) * material.texture_size[1]))
-        if face.smooth_shading:
-            commands.append(gc.normal(*face.vertex_normals[i], tag=("normal", vertex_index)))
-        commands.append(generate_vertex(vertices[vertex_index].location,
-            scale_factor, vtx10, tag=("vertex", vertex_index)))
-    return list(compact(flatten(commands)))
+def generate_corners(material, mesh, corners, scale_factor, vtx10=False):
+    """Build the commands sent for each (face, corner) pair in corners.
 
-def generate_faces(materials, mesh, scale_factor, vtx10=False):
+    The parameters for every corner in the run are quantized and packed at
+    once. Returns a list of (instruction, parameter words, tag) triples for
+    each corner.
+    """
+    offsets = mesh.polygon_offsets
+    corner_ids = numpy.array([offsets[face.index] + corner
+        for face, corner in corners], dtype=int)
+    vertex_ids = mesh.polygon_vertices[corner_ids]
+    vertex_words = generate_vertices(mesh.positions[vertex_ids], scale_factor,
+        vtx10).tolist()
+    normal_words = gc.normal_many(
+        mesh.polygon_vertex_normals[corner_ids]).tolist()
+    texcoord_words = None
+    if material.texture:
+        uvs = mesh.polygon_uvs[corner_ids]
+        texcoord_words = gc.texcoord_many(numpy.stack((uvs[:, 0],
+            1.0 - uvs[:, 1]), axis=1), material.texture_size).tolist()
+
+    vertex_instruction = 0x24 if vtx10 else 0x23
+    corner_commands = []
+    for i, ((face, corner), vertex_index) in enumerate(zip(corners,
+        vertex_ids.tolist())):
+        commands = []
+        if texcoord_words:
+            commands.append((0x22, texcoord_words[i], None))
+        if face.smooth_shading:
+            commands.append((0x21, normal_words[i], ("normal", vertex_index)))
+        commands.append((vertex_instruction, vertex_words[i],
+            ("vertex", vertex_index)))
+        corner_commands.append(commands)
+    return corner_commands
+
+def generate_polygons(commands, material, mesh, faces, points_per_face,
+    scale_factor, vtx10=False, strip_mode=None):
+    strips, faces = (stripify.stripify(faces, points_per_face, strip_mode)
+        if strip_mode else ([], faces))
+    singles = [[(face, corner) for corner in range(points_per_face)]
+        for face in faces]
+    runs = strips + singles
+    corner_commands = iter(generate_corners(material, mesh,
+        [pair for run in runs for pair in run], scale_factor, vtx10))
+    # Each strip, and each separate face, starts with its own flat normal.
+    # Flat shaded strips only join faces with the same normal, so one normal
+    # covers the whole strip.
+    face_normals = gc.normal_many(mesh.polygon_normals[
+        [run[0][0].index for run in runs]]).tolist()
+
+    for run_id, run in enumerate(runs):
+        is_strip = run_id < len(strips)
+        if is_strip or run_id == len(strips):
+            commands.append(generate_polygon_list_start(points_per_face,
+                strip=is_strip))
+        if not run[0][0].smooth_shading:
+            commands.add(0x21, face_normals[run_id])
+        for _ in run:
+            for command in next(corner_commands):
+                commands.add(*command)
+
+def generate_cone_clusters(commands, material, mesh, faces, points_per_face,
+    scale_factor, vtx10=False, strip_mode=None, cone_angle=None):
+    """Emit faces in clusters with tight normal cones.
+
+    Each cluster is sent as polygon lists of its own, between breaks, and its
+    first command is tagged with its cone's axis and cutoff, and the center and
+    radius of its faces' bounding sphere. See model.cones.
+    """
+    normals = mesh.polygon_normals[[face.index for face in faces]]
+    for cluster in cones.cluster(normals, math.radians(cone_angle)):
+        axis, cutoff = cones.cone(normals[cluster])
+        center, radius = bounds.minimal_sphere(mesh.positions[
+            [vertex for index in cluster for vertex in faces[index].vertices]])
+        commands.add_break()
+        first_command = len(commands)
+        generate_polygons(commands, material, mesh,
+            [faces[index] for index in cluster], points_per_face, scale_factor,
+            vtx10, strip_mode)
+        commands.tags[first_command] = ("cone", tuple(axis.tolist()), cutoff,
+            tuple(center.tolist()), radius)
+    commands.add_break()
+
+def generate_faces(materials, mesh, scale_factor, vtx10=False,
+    strip_mode=None, affine_bones=False, cone_angle=None):
     vertex_count = lambda face: len(face.vertices)
     face_material = attrgetter("material")
     face_group = methodcaller("vertexGroup")
     faces = sorted(mesh.polygons, key=lambda f:
-        (f.vertexGroup(), f.material, len(f.vertices)))
+        (f.vertexGroup(), f.material or "", len(f.vertices)))
 
-    commands = []
+    commands = CommandBuffer()
     for group, group_faces in groupby(faces, face_group):
         commands.append(gc.push())
         if group == "__mixed":
             log.warning("use of mixed-group polygons found: animation for this is not yet implemented")
         else:
-            commands.append(gc.mtx_mult_4x4(euclid.Matrix4(),
-                tag=("bone", group)))
+            # The engine patches animation frames over this matrix, so it must
+            # be the size every frame can be sent in.
+            bone_matrix = gc.mtx_mult_4x3 if affine_bones else gc.mtx_mult_4x4
+            commands.append(bone_matrix(euclid.Matrix4(), tag=("bone", group)))
         for material_name, material_faces in groupby(group_faces,
             face_material):
-            commands.append(generate_face_attributes(materials[material_name],
+            commands.extend(generate_face_attributes(materials[material_name],
                 parse_material_flags(material_name)))
             for points_per_face, polytype_faces in groupby(material_faces,
                 vertex_count):
-                commands.append(generate_polygon_list_start(points_per_face))
-                for face in polytype_faces:
-                    commands.append(generate_face(materials[face.material],
-                        mesh.vertices, face, scale_factor, vtx10))
+                if cone_angle:
+                    generate_cone_clusters(commands, materials[material_name],
+                        mesh, list(polytype_faces), points_per_face,
+                        scale_factor, vtx10, strip_mode, cone_angle)
+                else:
+                    generate_polygons(commands, materials[material_name], mesh,
+                        list(polytype_faces), points_per_face, scale_factor,
+                        vtx10, strip_mode)
         commands.append(gc.pop())
-    return list(flatten(commands))
+    return commands
 
 def generate_bounding_sphere(mesh_name, sphere):
     log.debug("Bounding sphere of radius %f centered at (%f, %f, %f)",
@@ -187,57 +332,89 @@ def generate_bounding_sphere(mesh_name, sphere):
         _to_fixed_point(sphere[0].z), _to_fixed_point(sphere[0].y * -1),
         _to_fixed_point(sphere[1])))
 
-def generate_mesh(model, mesh, vtx10=False):
-    commands = generate_command_list(model, mesh, vtx10)
-    call_list, references = generate_gl_call_list(commands)
+def generate_bone_bounds(model, mesh, source_mesh_name=None):
+    """Generate a chunk of bounding spheres, one per vertex group of mesh.
+
+    Each sphere encloses the group's vertices in its rest pose and in every
+    frame of every bone animation of the group, transformed the way the
+    geometry engine will transform them, so the engine can cull a skinned mesh
+    by its bones. The spheres are stored in the same order and coordinate
+    system as BSPH, after the group name. For a cluster, source_mesh_name
+    names the mesh it was split from.
+    """
+    if not mesh.vertex_count():
+        return
+    scale_factor = determine_scale_factor(mesh.bounding_box())
+    animations = [animation for animation in model.animations.get("bone", [])
+        if animation.mesh_name in (None, source_mesh_name or mesh.name)]
+    spheres = []
+    for code in sorted(set(mesh.vertex_groups.tolist()),
+        key=lambda code: model.groups[code]):
+        group = model.groups[code]
+        points = mesh.positions[mesh.vertex_groups == code] * scale_factor
+        points = numpy.hstack((points, numpy.ones((len(points), 1))))
+        poses = [numpy.identity(4)] + [
+            numpy.array(frame[:]).reshape(4, 4).T
+            for animation in animations
+            for frame in animation.channels.get(group, [])[:animation.length]]
+        # Vertices are rows multiplied by the bone matrix, then scaled back.
+        posed = (points @ numpy.array(poses))[..., :3] / scale_factor
+        center, radius = bounds.minimal_sphere(posed.reshape(-1, 3))
+        spheres.append(struct.pack("< 32s i i i i", to_dsgx_string(group),
+            _to_fixed_point(center[0]), _to_fixed_point(center[2]),
+            _to_fixed_point(center[1] * -1), _to_fixed_point(radius)))
+    sphere_count = len(spheres)
+    spheres = b"".join(spheres)
+    return wrap_chunk("BBSP", struct.pack("< 32s I %ds" % len(spheres),
+        to_dsgx_string(mesh.name), sphere_count, spheres))
+
+def generate_mesh(model, mesh, vtx10=False, strip_mode=None, packed=False,
+    compact_vtx=False, optimize=False, animation_mode="bone",
+    affine_bones=False, cone_angle=None, measure_usage=False):
+    commands = generate_command_list(model, mesh, vtx10, strip_mode, compact_vtx,
+        affine_bones, cone_angle)
+    if optimize:
+        commands = peephole.optimize(commands,
+            patched_tag_types(animation_mode), packed)
+    call_list, references = generate_gl_call_list(commands, packed)
     dsgx_chunk = generate_dsgx(mesh.name, call_list)
     bsph_chunk = generate_bounding_sphere(mesh.name, mesh.bounding_sphere())
     cost_chunk = generate_cost(mesh, commands)
+    if measure_usage:
+        references["usage"] = budget.worst_case_usage(mesh, commands)
+    if cone_angle:
+        cone_chunk = generate_cones(mesh.name, references["cones"])
+        return [dsgx_chunk, bsph_chunk, cost_chunk, cone_chunk], references
     return [dsgx_chunk, bsph_chunk, cost_chunk], references
 
-def generate_references(commands, command_id):
-    references = defaultdict(list)
-    offset = 0
-    for command in commands:
-        # Go past the command word; the references point to the command data
-        # instead, as the references only need to modify the data - never the
-        # command.
-        offset += 1
-        if command["instruction"] == command_id and command.get("tag"):
-            references[command["tag"]].append(offset)
-        offset += len(command["params"])
-    return references
+def patched_tag_types(animation_mode):
+    """List the tag types whose commands the engine patches at runtime."""
+    if animation_mode == "vertex":
+        return ("bone", "vertex", "normal")
+    return ("bone",)
+
+def generate_references(commands, command_ids, packed=False,
+    parameter_positions=None):
+    # The references point to the command data instead of the command word, as
+    # the references only need to modify the data - never the command.
+    if parameter_positions is None:
+        _, parameter_positions = commands.layout(packed)
+    return commands.references(set(command_ids), parameter_positions)
 
 def generate_cost(mesh, commands):
-    costs = {
-        0x40: 1,
-        0x20: 1,
-        0x30: 4,
-        0x18: 35,
-        0x1B: 22,
-        0x21: 12,
-        0x29: 1,
-        0x12: 36,
-        0x11: 17,
-        0x31: 4,
-        0x22: 1,
-        0x2A: 1,
-        0x2B: 1,
-        0x24: 8,
-        0x23: 9,
-    }
-    cycles = sum(costs[command['instruction']] for command in commands)
+    cycles = commands.cycles()
     return wrap_chunk("COST", struct.pack("< 32s I I", to_dsgx_string(mesh.name), mesh.max_cull_polys(), cycles))
 
 def generate_dsgx(mesh_name, call_list):
     return wrap_chunk("DSGX", to_dsgx_string(mesh_name) + call_list)
 
-def generate_command_list(model, mesh, vtx10=False):
-    gx_commands = []
-    gx_commands.append(generate_defaults())
+def generate_command_list(model, mesh, vtx10=False, strip_mode=None,
+    compact_vtx=False, affine_bones=False, cone_angle=None):
+    gx_commands = CommandBuffer()
+    gx_commands.extend(generate_defaults())
     scale_factor = determine_scale_factor(mesh.bounding_box())
     gx_commands.append(gc.push())
-    gx_commands.append(gc.mtx_mult_4x4(model.global_matrix))
+    gx_commands.append(gc.mtx_mult(model.global_matrix))
     if scale_factor != 1.0:
         inverse_scale = 1 / scale_factor
         gx_commands.append(gc.mtx_scale(inverse_scale, inverse_scale, inverse_scale))
@@ -245,23 +422,55 @@ def generate_command_list(model, mesh, vtx10=False):
     log.debug("Global Matrix: ")
     log.debug(model.global_matrix)
 
-    gx_commands.append(generate_faces(model.materials, mesh, scale_factor, vtx10))
+    gx_commands.extend(generate_faces(model.materials, mesh, scale_factor, vtx10,
+        strip_mode, affine_bones, cone_angle))
 
     gx_commands.append(gc.pop())
-    return list(flatten(gx_commands))
-
-def generate_gl_call_list(commands):
-    call_list = []
-    for command in commands:
-        command_bytes = struct.pack("< B B B B", command["instruction"], 0, 0, 0)
-        command_bytes += b"".join(command["params"])
-        call_list.append(command_bytes)
-    call_list = b"".join(call_list)
-    return struct.pack("< I %ds" % len(call_list), int(len(call_list) / 4), call_list), dict(
-        bones=generate_references(commands, 0x18),
-        textures=generate_references(commands, 0x2A),
-        vertices=generate_references(commands, 0x24),
-        normals=generate_references(commands, 0x21))
+    # 10 bit vertices already fit in a single word.
+    if compact_vtx and not vtx10:
+        gx_commands = compact_vertices(gx_commands)
+    return gx_commands
+
+def generate_gl_call_list(commands, packed=False):
+    words, parameter_positions = commands.layout(packed)
+    call_list = numpy.concatenate(([len(words)], words)).astype("<u4").tobytes()
+    references = lambda *command_ids: generate_references(commands,
+        command_ids, packed, parameter_positions)
+    return call_list, dict(
+        bones=references(0x18, 0x19),
+        textures=references(0x2A),
+        vertices=references(0x24),
+        normals=references(0x21),
+        cones=generate_cone_ranges(commands, parameter_positions, len(words)))
+
+def generate_cone_ranges(commands, parameter_positions, word_count):
+    """List each cone cluster's tag with the call list words it covers."""
+    positions = commands.break_positions(parameter_positions, word_count)
+    break_indices = sorted(positions)
+    ranges = []
+    for index, tag in sorted(commands.tags.items()):
+        if isinstance(tag, tuple) and tag[0] == "cone":
+            end = next(later for later in break_indices if later > index)
+            ranges.append((tag, positions[index], positions[end]))
+    return ranges
+
+def generate_cones(mesh_name, cone_ranges):
+    """Generate the normal cone of each cluster and the words it covers.
+
+    Each entry holds the cone's axis and cutoff, then the center and radius of
+    the cluster's bounding sphere, all in the same coordinate layout as BSPH and
+    as fixed point, then the range of call list words that draw the cluster,
+    counted like references. The sphere lets the engine test each cluster from
+    its own direction to the camera. See model.cones.
+    """
+    entries = b"".join(struct.pack("< i i i i i i i i I I",
+        _to_fixed_point(axis[0]), _to_fixed_point(axis[2]),
+        _to_fixed_point(axis[1] * -1), _to_fixed_point(cutoff),
+        _to_fixed_point(center[0]), _to_fixed_point(center[2]),
+        _to_fixed_point(center[1] * -1), _to_fixed_point(radius), start, end)
+        for (_, axis, cutoff, center, radius), start, end in cone_ranges)
+    return wrap_chunk("CONE", struct.pack("< 32s I %ds" % len(entries),
+        to_dsgx_string(mesh_name), len(cone_ranges), entries))
 
 def generate_bones(animations, mesh_name, bone_references):
     if not animations:
@@ -278,14 +487,20 @@ def generate_bones(animations, mesh_name, bone_references):
     bones = b"".join(bones)
     return wrap_chunk("BONE", struct.pack("< 32s I %ds" % len(bones), name, bone_count, bones))
 
-def generate_animation_references(animations, mesh_name, tag_type, references):
+def generate_animation_references(animations, mesh_name, tag_type, references,
+    source_mesh_name=None):
+    # source_mesh_name names the mesh a cluster was split from, whose
+    # animations the cluster shares.
     if not animations:
         return
     tag = to_dsgx_string(tag_type)
     name = to_dsgx_string(mesh_name)
+    source_mesh_name = source_mesh_name if source_mesh_name else mesh_name
     # some_animation = animations[next(iter(animations.keys()))]
-    mesh_animations = filter(lambda animation: animation.mesh_name == mesh_name or animation.mesh_name == None, animations)
-    some_animation = next(mesh_animations)
+    mesh_animations = filter(lambda animation: animation.mesh_name == source_mesh_name or animation.mesh_name == None, animations)
+    some_animation = next(mesh_animations, None)
+    if some_animation is None:
+        return
     unique_reference_count = len(some_animation.channels.keys())
     unique_references = []
     log.debug("AREF: ", mesh_name, ", ", tag_type)
@@ -308,46 +523,62 @@ def generate_textures(mesh, texture_references):
         for texture in sorted(texture_references))
     return wrap_chunk("TXTR", struct.pack("< 32s I %ds" % len(references), name, count, references))
 
-def generate_animations(animations, animation_mode):
+def generate_animations(animations, animation_mode, anim_tolerance=None,
+    affine_bones=False, vertex_delta_bits=None):
     animation_chunks = []
     for tag_type in animations:
-        chunk = [generate_animation(tag_type, animation, animation_mode) for animation in animations[tag_type]]
+        chunk = [generate_animation(tag_type, animation, animation_mode, anim_tolerance, affine_bones, vertex_delta_bits) for animation in animations[tag_type]]
         chunk = filter(None, chunk)
         animation_chunks.extend(chunk)
     return animation_chunks
 
 def encode_animation_matrix(matrix):
-    return gc.mtx_mult_4x4(matrix)["params"]
+    return gc.mtx_mult_4x4(matrix)[1]
+
+def encode_animation_matrix_4x3(matrix):
+    return gc.mtx_mult_4x3(matrix)[1]
 
 def encode_animation_vertex(vertex):
-    return gc.vtx_10(*vertex)["params"]
+    return gc.vtx_10(*vertex)[1]
 
 def encode_animation_normal(normal):
-    return gc.normal(*normal)["params"]
+    return gc.normal(*normal)[1]
 
 animation_data_encoders = {
     "bone": encode_animation_matrix,
     "normal": encode_animation_normal,
     "vertex": encode_animation_vertex}
 
-def encode_animation_data(data, data_type):
+def encode_animation_data(data, data_type, affine_bones=False):
+    if data_type == "bone" and affine_bones:
+        return encode_animation_matrix_4x3(data)
     if data_type in animation_data_encoders:
         return animation_data_encoders[data_type](data)
     log.warning("No encoder for %s data type in animation!" % data_type)
     return []
 
-def generate_animation(tag_type, animation, animation_mode):
+def generate_animation(tag_type, animation, animation_mode, anim_tolerance=None,
+    affine_bones=False, vertex_delta_bits=None):
+    if vertex_delta_bits and tag_type in ("vertex", "normal"):
+        generate_chunk = lambda tag_type, animation: generate_vdlt_chunk(
+            tag_type, animation, vertex_delta_bits)
+    elif anim_tolerance is not None and tag_type in animation_data_encoders:
+        generate_chunk = lambda tag_type, animation: generate_kanm_chunk(
+            tag_type, animation, anim_tolerance, affine_bones)
+    else:
+        generate_chunk = lambda tag_type, animation: generate_anim_chunk(
+            tag_type, animation, affine_bones)
     if tag_type == "bone":
         if animation_mode == "bone":
             # return generate_bani_chunk(animation)
-            return generate_anim_chunk(tag_type, animation)
+            return generate_chunk(tag_type, animation)
     elif tag_type == "vertex" or tag_type == "normal":
         if animation_mode == "vertex":
-            return generate_anim_chunk(tag_type, animation)
+            return generate_chunk(tag_type, animation)
     elif tag_type in animation_data_encoders:
         log.warning("Unknown tag type %s, ignoring animation data." % tag_type)
 
-def generate_anim_chunk(tag_type, animation):
+def generate_anim_chunk(tag_type, animation, affine_bones=False):
     name = to_dsgx_string(animation.name)
     mesh_name = to_dsgx_string(animation.mesh_name if animation.mesh_name else "")
     data_type = animation.data_type
@@ -357,17 +588,90 @@ def generate_anim_chunk(tag_type, animation):
     # Determine the length of a data entry by encoding one at random, then
     # counting the number of parameters we get back. Each parameter is one
     # word.
-    data_length = len(encode_animation_data(channels[list(channels.keys())[0]][0], data_type))
+    data_length = len(encode_animation_data(channels[list(channels.keys())[0]][0], data_type, affine_bones))
     parameter_data = []
     for frame in range(animation.length):
         for channel_name in sorted(set(animation.channels.keys()) - {"default"}):
-            params = encode_animation_data(channels[channel_name][frame], data_type)
+            params = encode_animation_data(channels[channel_name][frame], data_type, affine_bones)
             parameter_data.extend(params)
-    parameter_data = b"".join(parameter_data)
+    parameter_data = struct.pack("< %dI" % len(parameter_data), *parameter_data)
     log.debug("Created ANIM ", animation.name, " for ", animation.mesh_name, ":", tag_type, " with length ", len(parameter_data))
     return wrap_chunk("ANIM", struct.pack("< 32s 32s 32s I I %ds" % len(parameter_data),
         name, data_type_str, mesh_name, animation.length, data_length, parameter_data))
 
+def generate_kanm_chunk(tag_type, animation, tolerance, affine_bones=False):
+    """Generate a keyed animation chunk, storing only the needed keyframes.
+
+    The header matches ANIM's, followed by the number of channels. Each
+    channel, in the same order as ANIM, then holds its key count, the frame
+    number of each key as 16 bit values padded to a word, and the encoded
+    value of each key. Frames between keys are interpolated linearly, frames
+    after the last key hold its value, and a channel with a single key is
+    constant. See model.keyframes for how keys are chosen.
+    """
+    name = to_dsgx_string(animation.name)
+    mesh_name = to_dsgx_string(animation.mesh_name if animation.mesh_name else "")
+    data_type = animation.data_type
+    data_type_str = to_dsgx_string(data_type)
+
+    channels = animation.channels
+    data_length = len(encode_animation_data(channels[list(channels.keys())[0]][0], data_type, affine_bones))
+    channel_names = sorted(set(channels.keys()) - {"default"})
+    channel_data = []
+    key_total = 0
+    for channel_name in channel_names:
+        frames = channels[channel_name][:animation.length]
+        keys = keyframes.reduce_keyframes(keyframes.channel_values(frames),
+            tolerance)
+        key_total += len(keys)
+        frame_numbers = struct.pack("< %dH" % len(keys), *keys)
+        channel_data.append(struct.pack("< I", len(keys)))
+        channel_data.append(frame_numbers + b"\0" * padding_to(len(frame_numbers)))
+        params = [param for key in keys
+            for param in encode_animation_data(frames[key], data_type,
+                affine_bones)]
+        channel_data.append(struct.pack("< %dI" % len(params), *params))
+    channel_data = b"".join(channel_data)
+    log.debug("Created KANM %s for %s:%s, keeping %d of %d keyframes",
+        animation.name, animation.mesh_name, tag_type, key_total,
+        animation.length * len(channel_names))
+    return wrap_chunk("KANM", struct.pack("< 32s 32s 32s I I I %ds" % len(channel_data),
+        name, data_type_str, mesh_name, animation.length, data_length,
+        len(channel_names), channel_data))
+
+def generate_vdlt_chunk(tag_type, animation, delta_bits):
+    """Generate a delta encoded vertex or normal animation chunk.
+
+    The header holds the animation, data type and mesh names, the length in
+    frames, the number of channels and delta_bits. It is followed by the first
+    frame's parameter word for each channel, in the same order as ANIM, the
+    word offset of each later frame within the encoded frames, and the encoded
+    frames. See model.vertex_deltas for their layout.
+    """
+    if not 2 <= delta_bits <= 16:
+        raise ValueError("vertex delta bits must be from 2 to 16, not %d" %
+            delta_bits)
+    name = to_dsgx_string(animation.name)
+    mesh_name = to_dsgx_string(animation.mesh_name if animation.mesh_name else "")
+    data_type = animation.data_type
+    data_type_str = to_dsgx_string(data_type)
+
+    channel_names = sorted(set(animation.channels.keys()) - {"default"})
+    words = numpy.array([[
+        encode_animation_data(animation.channels[channel_name][frame],
+        data_type)[0] for channel_name in channel_names]
+        for frame in range(animation.length)], dtype=numpy.uint32).reshape(
+        animation.length, len(channel_names))
+    offsets, frames = vertex_deltas.encode_frames(words, delta_bits)
+    base = words[0] if animation.length else []
+    data = numpy.concatenate((base, offsets, frames)).astype("<u4").tobytes()
+    log.debug("Created VDLT %s for %s:%s in %d words instead of %d",
+        animation.name, animation.mesh_name, tag_type, len(data) // 4,
+        words.size)
+    return wrap_chunk("VDLT", struct.pack("< 32s 32s 32s I I I %ds" % len(data),
+        name, data_type_str, mesh_name, animation.length, len(channel_names),
+        delta_bits, data))
+
 def generate_bani_chunk(animation):
     name = to_dsgx_string(animation.name)
     length = animation.length
@@ -379,11 +683,218 @@ def generate_bani_chunk(animation):
     matrices = b"".join(matrices)
     return wrap_chunk("BANI", struct.pack("< 32s I %ds" % len(matrices), name, length, matrices))
 
-def generate(model, vtx10=False, animation_mode="bone"):
+def bone_animations_affine(animations, animation_mode):
+    """Check whether every bone animation frame fits a 4x3 matrix command.
+
+    When they all do, bone matrices and their animation frames are sent as 4x3
+    matrices, which take 12 words instead of 16 and fewer cycles to multiply.
+    """
+    if animation_mode != "bone":
+        return True
+    return all(gc.is_affine(frame) for animation in animations.get("bone", [])
+        for channel in animation.channels.values() for frame in channel)
+
+def _generate_detached_mesh(job):
+    model, mesh, options = job
+    mesh.model = model
+    return generate_mesh(model, mesh, *options)
+
+def generate_meshes(model, options, jobs=1, cache=None, meshes=None):
+    """Run generate_mesh for every mesh in the model, in order.
+
+    meshes replaces the model's own list of meshes, if given. With more than
+    one job, the meshes are converted in that many worker processes. Each
+    worker is sent a mesh's arrays and a detached copy of the model's settings
+    rather than the whole model. Meshes found in the cache aren't converted
+    again.
+    """
+    meshes = list(model.meshes.values()) if meshes is None else meshes
+    results = [None] * len(meshes)
+    if cache:
+        keys = [cache.mesh_key(model, mesh, options) for mesh in meshes]
+        results = [cache.get_object(key) for key in keys]
+    missing = [index for index, result in enumerate(results) if result is None]
+    if jobs <= 1 or len(missing) <= 1:
+        generated = [generate_mesh(model, meshes[index], *options)
+            for index in missing]
+    else:
+        detached_model = model.detached()
+        work = ((detached_model, meshes[index], options) for index in missing)
+        with ProcessPoolExecutor(min(jobs, len(missing))) as executor:
+            generated = list(executor.map(_generate_detached_mesh, work))
+    for index, result in zip(missing, generated):
+        results[index] = result
+        if cache:
+            cache.put_object(keys[index], result)
+    return results
+
+def generate_clusters(mesh_name, clusters):
+    """Generate the chunk listing the clusters a mesh was split into."""
+    names = b"".join(to_dsgx_string(cluster.name) for cluster in clusters)
+    return wrap_chunk("CLST", struct.pack("< 32s I %ds" % len(names),
+        to_dsgx_string(mesh_name), len(clusters), names))
+
+def merge_triangle_pairs(mesh):
+    """Merge mesh's triangle pairs into quads, logging what it saves."""
+    merged, pairs = quads.merge_triangles(mesh)
+    if pairs:
+        log.info("Merged %d triangle pairs of %s into quads: worst case "
+            "polygon RAM use down from %d to %d, vertex commands (without "
+            "strips) down from %d to %d", pairs, mesh.name,
+            mesh.max_cull_polys(), merged.max_cull_polys(),
+            mesh.polygon_sizes().sum(), merged.polygon_sizes().sum())
+    return merged
+
+def generate_lod_table(mesh_name, levels):
+    """Generate the chunk listing a mesh's levels of detail.
+
+    levels holds (mesh, switch distance) pairs, from the full mesh down. Each
+    entry holds the level's mesh name, its polygon count and, as fixed point,
+    the distance from which it can be drawn instead of the level before. See
+    model.simplify.
+    """
+    entries = b"".join(struct.pack("< 32s I i", to_dsgx_string(level.name),
+        level.polygon_count(), _to_fixed_point(min(distance, MAX_DISTANCE)))
+        for level, distance in levels)
+    return wrap_chunk("LODT", struct.pack("< 32s I %ds" % len(entries),
+        to_dsgx_string(mesh_name), len(levels), entries))
+
+def fit_to_budget(model, options, jobs, cache, clusters, generated,
+    max_polygons=None, max_vertices=None, split=False, animation_mode="bone"):
+    """Make sure every generated mesh fits the polygon and vertex budget.
+
+    clusters lists the meshes generated for each of the model's meshes (and
+    each of their levels of detail), and generated their results, in the same
+    order. With split, meshes over budget are split into clusters until each
+    part fits; otherwise, or if a mesh can't be split, BudgetExceeded is
+    raised, listing every mesh over budget. It is also raised if two parts
+    would share a chunk name. Returns the new clusters and results.
+    """
+    results = iter(generated)
+    fitted = [[(mesh, next(results)) for mesh in group] for group in clusters]
+    while True:
+        over = [(mesh, result[1]["usage"]) for group in fitted
+            for mesh, result in group
+            if not budget.within(result[1]["usage"], max_polygons, max_vertices)]
+        if not over:
+            break
+        report = "\n".join(budget.describe(mesh.name, usage, max_polygons,
+            max_vertices) for mesh, usage in over)
+        if not split:
+            raise BudgetExceeded("Meshes over budget:\n" + report)
+        if animation_mode == "vertex":
+            raise BudgetExceeded("Meshes over budget can't be split "
+                "under vertex animation:\n" + report)
+        unsplittable = [mesh.name for mesh, _ in over
+            if mesh.polygon_count() < 2]
+        if unsplittable:
+            raise BudgetExceeded("Meshes over budget with too few "
+                "polygons to split: %s\n%s" % (", ".join(unsplittable), report))
+
+        parts = {}
+        for mesh, (polygons, vertices) in over:
+            part_count = max(2,
+                -(-polygons // max_polygons) if max_polygons else 0,
+                -(-vertices // max_vertices) if max_vertices else 0)
+            parts[mesh.name] = partition.split_mesh(mesh,
+                -(-mesh.polygon_count() // part_count))
+            log.info("%s is over budget, splitting it into %d parts",
+                mesh.name, len(parts[mesh.name]))
+        new_meshes = [part for mesh_parts in parts.values()
+            for part in mesh_parts]
+        results = iter(generate_meshes(model, options, jobs, cache, new_meshes))
+        # The parts take their mesh's place within its group.
+        refitted = []
+        for group in fitted:
+            refitted.append([])
+            for mesh, result in group:
+                if mesh.name in parts:
+                    refitted[-1].extend((part, next(results))
+                        for part in parts[mesh.name])
+                else:
+                    refitted[-1].append((mesh, result))
+        fitted = refitted
+        clashes = find_clashes(mesh.name for group in fitted
+            for mesh, _ in group)
+        if clashes:
+            raise BudgetExceeded("Meshes split to fit the budget would share "
+                "a chunk name: %s" % ", ".join(clashes))
+    for group in fitted:
+        for mesh, result in group:
+            log.info(budget.describe(mesh.name, result[1]["usage"],
+                max_polygons, max_vertices))
+    return ([[mesh for mesh, _ in group] for group in fitted],
+        [result for group in fitted for _, result in group])
+
+def generate(model, vtx10=False, animation_mode="bone", strip_mode=None,
+    packed=False, compact_vtx=False, optimize=False, jobs=1, cache=None,
+    anim_tolerance=None, vertex_delta_bits=None, bone_bounds=False,
+    cluster_polygons=None, cone_angle=None, max_polygons=None,
+    max_vertices=None, split_over_budget=False, lod_levels=None,
+    merge_quads=False):
+    if compact_vtx and animation_mode == "vertex":
+        # Animated vertices are patched in place, which would break any vertex
+        # sent relative to them.
+        log.warning("Compact vertex commands can't be used with vertex animation, ignoring.")
+        compact_vtx = False
+    if cluster_polygons and animation_mode == "vertex":
+        # Vertex animation channels are keyed by the mesh's vertex indices,
+        # which a cluster renumbers.
+        log.warning("Meshes can't be split into clusters with vertex animation, ignoring.")
+        cluster_polygons = None
+    if lod_levels and animation_mode == "vertex":
+        log.warning("Levels of detail can't be built with vertex animation, ignoring.")
+        lod_levels = None
     chunks = []
-    for mesh_name in model.meshes:
-        mesh = model.meshes[mesh_name]
-        mesh_chunks, references = generate_mesh(model, mesh, vtx10)
+    affine_bones = bone_animations_affine(model.animations, animation_mode)
+    measure_usage = bool(max_polygons or max_vertices)
+    options = (vtx10, strip_mode, packed, compact_vtx, optimize, animation_mode,
+        affine_bones, cone_angle, measure_usage)
+    levels = []
+    lod_tables = []
+    for source in model.meshes.values():
+        mesh = merge_triangle_pairs(source) if merge_quads else source
+        chain = (simplify.lod_chain(mesh, lod_levels) if lod_levels
+            else [(mesh, 0.0)])
+        if merge_quads:
+            # Simplifying leaves triangles where quads lost a corner.
+            chain[1:] = [(merge_triangle_pairs(level), distance)
+                for level, distance in chain[1:]]
+        if len(chain) > 1:
+            log.info("Built %d levels of detail for %s, down to %d polygons",
+                len(chain) - 1, source.name, chain[-1][0].polygon_count())
+            lod_tables.append((len(levels), generate_lod_table(source.name,
+                chain)))
+        levels.extend((source, level) for level, _ in chain)
+    clusters = [partition.split_mesh(level, cluster_polygons)
+        if cluster_polygons else [level] for _, level in levels]
+    clashes = find_clashes(mesh.name for group in clusters for mesh in group)
+    if clashes:
+        raise NameClash("Meshes would share a chunk name: %s" %
+            ", ".join(clashes))
+    generated = generate_meshes(model, options, jobs, cache,
+        [mesh for group in clusters for mesh in group])
+    if measure_usage:
+        clusters, generated = fit_to_budget(model, options, jobs, cache,
+            clusters, generated, max_polygons, max_vertices, split_over_budget,
+            animation_mode)
+    sources = []
+    meshes = []
+    leading_chunks = {}
+    for index, lod_table in lod_tables:
+        leading_chunks[clusters[index][0].name] = [lod_table]
+    for (source, level), group in zip(levels, clusters):
+        if len(group) > 1:
+            log.info("Split %s into %d clusters", level.name, len(group))
+            leading_chunks.setdefault(group[0].name, []).append(
+                generate_clusters(level.name, group))
+        sources.extend([source] * len(group))
+        meshes.extend(group)
+    for source, mesh, (mesh_chunks, references) in zip(sources, meshes,
+        generated):
+        # A mesh's level of detail table, and a split mesh's cluster list, come
+        # just before its first cluster.
+        chunks.append(leading_chunks.get(mesh.name))
         chunks.append(mesh_chunks)
         # if "bone" in model.animations and animation_mode == "bone":
         #     chunks.append(generate_bones(model.animations["bone"], mesh.name, references["bones"]))
@@ -394,13 +905,25 @@ def generate(model, vtx10=False, animation_mode="bone"):
                 chunks.append(generate_animation_references(model.animations["normal"], mesh.name, "normal", references["normals"]))
         if animation_mode == "bone":
             if "bone" in model.animations:
-                chunks.append(generate_animation_references(model.animations["bone"], mesh.name, "bone", references["bones"]))
+                chunks.append(generate_animation_references(model.animations["bone"], mesh.name, "bone", references["bones"], source.name))
         chunks.append(generate_textures(mesh, references["textures"]))
-    chunks.extend(generate_animations(model.animations, animation_mode))
+        if bone_bounds:
+            chunks.append(generate_bone_bounds(model, mesh, source.name))
+    chunks.extend(generate_animations(model.animations, animation_mode,
+        anim_tolerance, affine_bones, vertex_delta_bits))
     return list(flatten(chunk for chunk in chunks if chunk))
 
 class Writer:
-    def write(self, filename, model, vtx10=False, animation_mode="bone"):
-        chunks = generate(model, vtx10, animation_mode)
+    def write(self, filename, model, vtx10=False, animation_mode="bone",
+        strip_mode=None, packed=False, compact_vtx=False, optimize=False,
+        jobs=1, cache=None, anim_tolerance=None, vertex_delta_bits=None,
+        bone_bounds=False, cluster_polygons=None, cone_angle=None,
+        max_polygons=None, max_vertices=None, split_over_budget=False,
+        lod_levels=None, merge_quads=False):
+        chunks = generate(model, vtx10, animation_mode, strip_mode, packed,
+            compact_vtx, optimize, jobs, cache, anim_tolerance,
+            vertex_delta_bits, bone_bounds, cluster_polygons, cone_angle,
+            max_polygons, max_vertices, split_over_budget, lod_levels,
+            merge_quads)
         with open(filename, "wb") as fp:
             fp.write(b"".join(chunks))
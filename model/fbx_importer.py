@@ -1,9 +1,11 @@
 import euclid3 as euclid
+import numpy
 from .model import Model
 import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
-from FbxCommon import InitializeSdkObjects, LoadScene, FbxNodeAttribute, FbxSurfacePhong, FbxAnimStack, FbxTime, FbxAMatrix, FbxTexture, FbxLayerElement
+from FbxCommon import InitializeSdkObjects, LoadScene, FbxNodeAttribute, FbxSurfacePhong, FbxAnimStack, FbxTime, FbxAMatrix, FbxTexture, FbxLayerElement, FbxTransform
 
 import logging
 log = logging.getLogger()
@@ -17,146 +19,275 @@ def fbx_to_euclid(input_matrix):
 
 
 
+def find_layer_element(fbx_mesh, getter):
+    """Find the first layer holding an element, such as normals or UVs."""
+    for layer in range(fbx_mesh.GetLayerCount()):
+        element = getattr(fbx_mesh.GetLayer(layer), getter)()
+        if element:
+            return element
+    return None
+
+def read_layer_array(array, convert=None):
+    """Copy an FBX layer element array into a list in one pass."""
+    convert = convert if convert else lambda value: value
+    return [convert(array.GetAt(i)) for i in range(array.GetCount())]
+
+def corner_values(element, corner_vertices, corner_polygons, convert=None,
+    direct=True):
+    """Look up a layer element's value for every polygon corner.
+
+    corner_vertices and corner_polygons give the control point and polygon of
+    each corner. With direct set to False, the indices themselves are returned
+    instead of values from the direct array; material elements work this way.
+    Returns None if there is no element or its mapping isn't supported.
+    """
+    if not element:
+        return None
+    mapping = element.GetMappingMode()
+    if mapping == FbxLayerElement.eByControlPoint:
+        keys = corner_vertices
+    elif mapping == FbxLayerElement.eByPolygonVertex:
+        keys = range(len(corner_vertices))
+    elif mapping == FbxLayerElement.eByPolygon:
+        keys = corner_polygons
+    elif mapping == FbxLayerElement.eAllSame:
+        keys = [0] * len(corner_vertices)
+    else:
+        log.warning("Unsupported layer element mapping mode: %s", mapping)
+        return None
+    if element.GetReferenceMode() != FbxLayerElement.eDirect:
+        index = read_layer_array(element.GetIndexArray())
+        keys = [index[key] for key in keys]
+    if not direct:
+        return list(keys)
+    values = read_layer_array(element.GetDirectArray(), convert)
+    return [values[key] for key in keys]
+
+def fbx_to_arrays(matrices):
+    """Convert FbxAMatrix objects to one (count, 4, 4) numpy array, laid out
+    like fbx_to_euclid.
+
+    The SDK only hands out one element at a time, so every element is read
+    straight into a single array for all of the matrices, rather than into a
+    list and an array for each one.
+    """
+    matrices = list(matrices)
+    return numpy.fromiter((matrix.Get(row, column) for matrix in matrices
+        for row in range(4) for column in range(4)), dtype=float,
+        count=16 * len(matrices)).reshape(len(matrices), 4, 4)
+
+def euclid_to_array(matrix):
+    # matrix[:] lists the elements a, e, i, m, b, ... one column at a time.
+    return numpy.array(matrix[:]).reshape(4, 4).T
+
+def array_to_euclid(matrix):
+    return euclid.Matrix4.new(*matrix.T.ravel().tolist())
+
+def sample_times(length):
+    # Animations in blender are 60FPS, but FBX forces it to read as 30 FPS.
+    # It totally accepts half-frames for steps, so sample at half frames to
+    # convert it back to 60 FPS for export.
+    one_frame = FbxTime()
+    one_frame.SetFrame(1)
+    times = []
+    for sample in range(length):
+        timestamp = FbxTime()
+        timestamp.Set(one_frame.Get() * sample // 2)
+        times.append(timestamp)
+    return times
+
+def sample_global_transforms(nodes, times):
+    """Sample the global transforms of nodes at each of times.
+
+    Each node's local transform is evaluated once per sample, and global
+    transforms are composed down the hierarchy from cached parent results, so
+    the work grows with the number of nodes rather than with their depth.
+    Returns a (samples, 4, 4) array for each node, in the fbx_to_euclid
+    layout.
+
+    A child's global transform is local @ parent only when it inherits its
+    parent's transform the default (RSrs) way. Nodes inheriting any other way,
+    and nodes without a parent, have their global transform evaluated whole.
+    """
+    cache = {}
+    def global_transforms(node):
+        key = node.GetUniqueID()
+        if key not in cache:
+            parent = node.GetParent()
+            if (parent and node.GetTransform().GetInheritType() ==
+                FbxTransform.eInheritRSrs):
+                local = fbx_to_arrays(node.EvaluateLocalTransform(time)
+                    for time in times)
+                cache[key] = local @ global_transforms(parent)
+            else:
+                cache[key] = fbx_to_arrays(node.EvaluateGlobalTransform(time)
+                    for time in times)
+        return cache[key]
+    return [global_transforms(node) for node in nodes]
+
+def sample_stack(scene, stack, bind_poses):
+    """Sample every bone's animated transform over one animation stack.
+
+    bind_poses maps each channel name to the bone's node name and bind pose
+    inverse. Returns the animation length in samples, and a (samples, 4, 4)
+    array of transforms for each channel.
+    """
+    scene.SetCurrentAnimationStack(stack)
+    length = stack.LocalStop.Get().GetFrameCount() * 2
+    log.debug("Length: %d", length)
+    channel_names = list(bind_poses)
+    nodes = [scene.FindNodeByName(bind_poses[name][0]) for name in channel_names]
+    transforms = sample_global_transforms(nodes, sample_times(length))
+    return length, {name: bind_poses[name][1] @ transform
+        for name, transform in zip(channel_names, transforms)}
+
+def sample_stack_from_file(filename, stack_index, bind_poses):
+    SdkManager, scene = InitializeSdkObjects()
+    if not LoadScene(SdkManager, scene, filename):
+        raise IOError("Could not parse %s as .fbx" % filename)
+    stack = scene.GetSrcObject(FbxAnimStack.ClassId, stack_index)
+    return sample_stack(scene, stack, bind_poses)
+
 class Reader:
-    def __init__(self):
+    def __init__(self, jobs=1):
+        self.jobs = jobs
         self.material_index = []
         self.bones = {}
         self.cluster_transforms = {}
         pass
 
-    def process_clusters(self, object, mesh):
+    def process_clusters(self, mesh, fbx_mesh):
         # each mesh should contain a single deformer, containing
         # multiple clusters; roughly each cluster corresponds
         # to each bone in our models.
-        if mesh.GetDeformerCount() > 0:
-            deformer = mesh.GetDeformer(0)
-            # loop over all the bones
-
-            for i in range(deformer.GetClusterCount()):
-                cluster = deformer.GetCluster(i)
-
-                transform_link_matrix = FbxAMatrix()
-                transform_matrix = FbxAMatrix()
-                cluster.GetTransformLinkMatrix(transform_link_matrix) #if this even works
-                cluster.GetTransformMatrix(transform_matrix) #if this even works
-                self.cluster_transforms[cluster.GetLink().GetName()] = fbx_to_euclid(transform_matrix) * fbx_to_euclid(transform_link_matrix).inverse()
-                #print("Cluster: ", cluster.GetLink().GetName())
-                #print(self.cluster_transforms[cluster.GetLink().GetName()])
-                #print(fbx_to_euclid(transform_matrix))
-
-                #print(cluster.GetLink().GetName(), ": ", cluster.GetControlPointIndicesCount())
-                # loop over every point this bone controlls
-                for j in range(cluster.GetControlPointIndicesCount()):
-                    if object.vertecies[cluster.GetControlPointIndices()[j]].group != "default":
-                        log.warn("Oh no! Multiple bones affect the same vertex. Bad things!!")
-                    object.vertecies[cluster.GetControlPointIndices()[j]].setGroup(cluster.GetLink().GetName())
+        if fbx_mesh.GetDeformerCount() == 0:
+            return
+        deformer = fbx_mesh.GetDeformer(0)
+        # A vertex only belongs to a single group, so each one goes to the
+        # bone with the most weight on it.
+        best_weights = {}
+        shared_count = 0
+        for i in range(deformer.GetClusterCount()):
+            cluster = deformer.GetCluster(i)
+            bone_name = cluster.GetLink().GetName()
+
+            transform_link_matrix = FbxAMatrix()
+            transform_matrix = FbxAMatrix()
+            cluster.GetTransformLinkMatrix(transform_link_matrix) #if this even works
+            cluster.GetTransformMatrix(transform_matrix) #if this even works
+            self.cluster_transforms[bone_name] = fbx_to_euclid(transform_matrix) * fbx_to_euclid(transform_link_matrix).inverse()
+
+            # Fetch the indices and weights once; each call copies the whole
+            # list out of the SDK.
+            indices = cluster.GetControlPointIndices()
+            weights = cluster.GetControlPointWeights()
+            for index, weight in zip(indices, weights):
+                if index in best_weights:
+                    shared_count += 1
+                    if weight <= best_weights[index][0]:
+                        continue
+                best_weights[index] = (weight, bone_name)
+        if shared_count:
+            log.warning("%d vertices are affected by more than one bone; each is assigned to the bone with the most weight.", shared_count)
+        for index, (_, bone_name) in best_weights.items():
+            mesh.setVertexGroup(index, bone_name)
 
     def process_materials(self, object, fbx_mesh):
-        material_count = fbx_mesh.GetNode().GetMaterialCount()
-        #print("Layer count: ", fbx_mesh.GetLayerCount())
-        for l in range(fbx_mesh.GetLayerCount()):
-            for i in range(material_count):
-                material = fbx_mesh.GetNode().GetMaterial(i)
-                #print("Material: ", material.GetName())
-                if material.GetClassId().Is(FbxSurfacePhong.ClassId):
-                    #check for and process textures
-                    texture_name = None
-                    texture_width = 1
-                    texture_height = 1
-                    if material.Diffuse.GetSrcObjectCount(FbxTexture.ClassId) > 0:
-                        texture = material.Diffuse.GetSrcObject(FbxTexture.ClassId,0)
-                        log.debug("Texture original path/name: %s", texture.GetFileName())
-                        texture_name = os.path.basename(texture.GetFileName())
-                        texture_name = os.path.splitext(texture_name)[0]
-                        log.debug("Found texture: %s", texture_name)
-                        try:
-                            image = Image.open(texture.GetFileName())
-                            texture_width = image.size[0]
-                            texture_height = image.size[1]
-                        except:
-                            log.warn("Could not load texture file: %s", texture.GetFileName())
-
-
-
-                    #print("Is phong!")
-                    #this is a valid enough material to add, so do it!
-                    object.addMaterial(material.GetName(),
-                        {"r": material.Ambient.Get()[0],
-                         "g": material.Ambient.Get()[1],
-                         "b": material.Ambient.Get()[2]},
-
-                        {"r": material.Specular.Get()[0],
-                         "g": material.Specular.Get()[1],
-                         "b": material.Specular.Get()[2]},
-
-                        {"r": material.Diffuse.Get()[0],
-                         "g": material.Diffuse.Get()[1],
-                         "b": material.Diffuse.Get()[2]},
-                         texture_name, texture_width, texture_height)
-
-
-    #TODO: More gracefully handle multiple meshes in a single file; we would need to
-    #offset the vertex count somehow when coding in polygons.
-    def process_mesh(self, object, mesh):
-        # Import polygon and vertex data.
-        log.debug("Polygons: %d", mesh.GetPolygonCount())
-        log.debug("Verticies: %d", len(mesh.GetControlPoints()))
-
-        #this list contains all the points in the model; polygons will
-        #index into this list
-        vertex_list = mesh.GetControlPoints()
-
-        #add the verticies to the model
-        for i in range(len(vertex_list)):
-            object.addVertex(euclid.Vector3(vertex_list[i][0], vertex_list[i][1], vertex_list[i][2]))
-
-        #do something about materials
-        self.process_materials(object, mesh)
-        material_map = mesh.GetLayer(0).GetMaterials().GetIndexArray()
+        node = fbx_mesh.GetNode()
+        for i in range(node.GetMaterialCount()):
+            material = node.GetMaterial(i)
+            if material.GetClassId().Is(FbxSurfacePhong.ClassId):
+                #check for and process textures
+                texture_name = None
+                texture_width = 1
+                texture_height = 1
+                if material.Diffuse.GetSrcObjectCount(FbxTexture.ClassId) > 0:
+                    texture = material.Diffuse.GetSrcObject(FbxTexture.ClassId,0)
+                    log.debug("Texture original path/name: %s", texture.GetFileName())
+                    texture_name = os.path.basename(texture.GetFileName())
+                    texture_name = os.path.splitext(texture_name)[0]
+                    log.debug("Found texture: %s", texture_name)
+                    object.dependencies.append(texture.GetFileName())
+                    try:
+                        image = Image.open(texture.GetFileName())
+                        texture_width = image.size[0]
+                        texture_height = image.size[1]
+                    except:
+                        log.warn("Could not load texture file: %s", texture.GetFileName())
+
+                #this is a valid enough material to add, so do it!
+                color = lambda value: (value[0], value[1], value[2])
+                object.addMaterial(material.GetName(),
+                    ambient=color(material.Ambient.Get()),
+                    specular=color(material.Specular.Get()),
+                    diffuse=color(material.Diffuse.Get()),
+                    emit=color(material.Emissive.Get()),
+                    texture=texture_name, texwidth=texture_width,
+                    texheight=texture_height)
+
+    def process_mesh(self, object, fbx_mesh):
+        # Every array is copied out of the SDK once per mesh, and the faces
+        # are then put together from those copies, rather than asking the SDK
+        # for each polygon corner.
+        node = fbx_mesh.GetNode()
+        mesh = object.addMesh(node.GetName())
+        control_points = fbx_mesh.GetControlPoints()
+        polygon_count = fbx_mesh.GetPolygonCount()
+        log.debug("Polygons: %d", polygon_count)
+        log.debug("Verticies: %d", len(control_points))
+
+        for point in control_points:
+            mesh.addVertex((point[0], point[1], point[2]))
+
+        self.process_materials(object, fbx_mesh)
+        material_names = [node.GetMaterial(i).GetName()
+            for i in range(node.GetMaterialCount())]
 
         log.debug("Mesh Global Transform:")
-        log.debug(fbx_to_euclid(mesh.GetNode().EvaluateGlobalTransform()))
-        #exit()
+        log.debug(fbx_to_euclid(node.EvaluateGlobalTransform()))
         #well ... that explains a lot.
-        self.mesh_global = fbx_to_euclid(mesh.GetNode().EvaluateGlobalTransform())
+        self.mesh_global = fbx_to_euclid(node.EvaluateGlobalTransform())
         object.global_matrix = self.mesh_global
 
-        for face in range(mesh.GetPolygonCount()):
-            #this importer only supports triangles and
-            #quads, so we need to throw out any weird
-            #sizes here
-            vertex_count = mesh.GetPolygonSize(face)
-            if vertex_count >= 3 and vertex_count <= 4:
-                points = []
-                normals = []
-                uvlist = []
-                for v in range(vertex_count):
-                    points.append(mesh.GetPolygonVertex(face,v))
-
-                    #figure out if there's normal data?
-                    #TODO: Why does this need to loop over layer data? Investigate!
-                    for l in range(mesh.GetLayerCount()):
-                        normal_data = mesh.GetLayer(l).GetNormals()
-                        if normal_data:
-                            normal = normal_data.GetDirectArray().GetAt(v)
-                            #print(normal)
-                            normals.append((normal[0],normal[1],normal[2]))
-                        uv_data = mesh.GetLayer(l).GetUVs()
-                        if uv_data:
-                            if uv_data.GetMappingMode() == FbxLayerElement.eByControlPoint:
-                                log.warn("eByControlPoint not supported for UVs!")
-                            elif uv_data.GetMappingMode() ==  FbxLayerElement.eByPolygonVertex:
-                                uv_index = mesh.GetTextureUVIndex(face, v)
-                                uv = uv_data.GetDirectArray().GetAt(uv_index)
-                                #print("UVs: ", uv)
-                                uvlist.append((uv[0], uv[1]))
-
-                #todo: not discard UV coordinates here
-                if len(uvlist) == 0:
-                    uvlist = None
-                object.addPoly(points, uvlist, normals, mesh.GetNode().GetMaterial(material_map.GetAt(face)).GetName())
-
-        self.process_clusters(object, mesh)
+        corner_vertices = fbx_mesh.GetPolygonVertices()
+        polygon_sizes = [fbx_mesh.GetPolygonSize(face)
+            for face in range(polygon_count)]
+        corner_polygons = [face for face, size in enumerate(polygon_sizes)
+            for _ in range(size)]
+
+        normals = corner_values(find_layer_element(fbx_mesh, "GetNormals"),
+            corner_vertices, corner_polygons,
+            lambda normal: (normal[0], normal[1], normal[2]))
+        uvs = corner_values(find_layer_element(fbx_mesh, "GetUVs"),
+            corner_vertices, corner_polygons, lambda uv: (uv[0], uv[1]))
+        materials = corner_values(find_layer_element(fbx_mesh, "GetMaterials"),
+            list(range(polygon_count)), list(range(polygon_count)),
+            direct=False)
+
+        start = 0
+        for face, size in enumerate(polygon_sizes):
+            end = start + size
+            if size < 3:
+                log.debug("Skipping polygon %d with only %d points", face, size)
+                start = end
+                continue
+            material = None
+            if materials is not None and materials[face] < len(material_names):
+                material = material_names[materials[face]]
+            # The hardware draws triangles and quads; anything larger is split
+            # into a fan of triangles.
+            if size <= 4:
+                corner_lists = [range(start, end)]
+            else:
+                corner_lists = [(start, i, i + 1) for i in range(start + 1, end - 1)]
+            for corners in corner_lists:
+                mesh.addPolygon([corner_vertices[i] for i in corners],
+                    [uvs[i] for i in corners] if uvs else None,
+                    [normals[i] for i in corners] if normals else None,
+                    material, smooth=bool(normals))
+            start = end
+
+        self.process_clusters(mesh, fbx_mesh)
 
     def process_skeleton(self, object, skeleton):
         #TODO: This obviously.
@@ -181,58 +312,41 @@ class Reader:
             #print("recursing into: ", node.GetName())
             self.process_node(object, node.GetChild(i))
 
-    def calculate_transformation(self, bone, frame, last_step=True):
-        timestamp = FbxTime()
-        timestamp.SetFrame(frame)
-        #animation_transform = bone.GetNode().EvaluateLocalTransform(timestamp)
-        animation_transform = bone.GetNode().EvaluateGlobalTransform(timestamp)
-
-        #make this euclid format please
-        animation_transform = fbx_to_euclid(animation_transform)
-
-        bind_pose_inverse = self.cluster_transforms[bone.GetNode().GetName()]
-
-        #print("\n".join(sorted(dir(bone.GetNode().GetScene().GetRootNode()))))
-        #exit()
-
-        #animation_transform = self.cluster_transforms[bone.GetNode().GetName()].inverse() * animation_transform
-        #animation_transform = animation_transform.identity()
-        #return euclid.Matrix4()
-
-        #print(bone.GetNode().GetName())
-        return bind_pose_inverse * animation_transform
-
-        #return self.mesh_global * animation_transform * bind_pose.inverse() * self.mesh_global.inverse()
-
-        #return animation_transform.inverse()
-
-    def process_animation(self, object, scene):
-        #print(sorted(dir(scene)))
-        #evaluator = scene.GetAnimationEvaluator()
-        #print(sorted(dir(evaluator)))
-
-        for i in range(scene.GetSrcObjectCount(FbxAnimStack.ClassId)):
-            animation_stack = scene.GetSrcObject(FbxAnimStack.ClassId, i)
-            log.debug("Animation: %s", animation_stack.GetName())
-            log.debug("Length: %d", animation_stack.LocalStop.Get().GetFrameCount())
-
-            #evaluator.SetContext(animation_stack)
-            scene.SetCurrentAnimationStack(animation_stack)
-            obj_animation = object.createAnimation(animation_stack.GetName())
-
-            # Note here: animations in blender are 60FPS, but FBX forces it to
-            # read as 30 FPS. It totally accepts half-frames for steps, so we're
-            # fiddling with the numbers to convert it back to 60 FPS for export.
-            obj_animation.length = animation_stack.LocalStop.Get().GetFrameCount() * 2
-
-            #initialize our list of animation stuffs
-            for k in self.bones:
-                transform_list = []
-                for frame in range(obj_animation.length * 2):
-                    transform_list.append(self.calculate_transformation(self.bones[k], frame / 2))
-
-                obj_animation.addNode(self.bones[k].GetName(), transform_list)
+    def bind_pose_inverses(self):
+        """Map each bone's channel name to its node and bind pose inverse."""
+        bind_poses = {}
+        for bone in self.bones.values():
+            node_name = bone.GetNode().GetName()
+            if node_name not in self.cluster_transforms:
+                log.warning("Bone %s has no cluster, skipping its animation",
+                    node_name)
+                continue
+            bind_poses[bone.GetName()] = (node_name,
+                euclid_to_array(self.cluster_transforms[node_name]))
+        return bind_poses
+
+    def process_animation(self, object, scene, filename):
+        bind_poses = self.bind_pose_inverses()
+        stacks = [scene.GetSrcObject(FbxAnimStack.ClassId, i)
+            for i in range(scene.GetSrcObjectCount(FbxAnimStack.ClassId))]
+        if self.jobs > 1 and len(stacks) > 1:
+            # Scenes can't be sent between processes, so each worker loads
+            # the file again and samples one animation stack from it.
+            with ProcessPoolExecutor(min(self.jobs, len(stacks))) as executor:
+                samples = list(executor.map(sample_stack_from_file,
+                    [filename] * len(stacks), range(len(stacks)),
+                    [bind_poses] * len(stacks)))
+        else:
+            samples = [sample_stack(scene, stack, bind_poses)
+                for stack in stacks]
 
+        for stack, (length, channels) in zip(stacks, samples):
+            log.debug("Animation: %s", stack.GetName())
+            obj_animation = object.create_animation(stack.GetName(), "bone")
+            obj_animation.length = length
+            for channel_name, transforms in channels.items():
+                obj_animation.add_channel(channel_name,
+                    [array_to_euclid(transform) for transform in transforms])
 
     def read(self, filename):
         #first, make sure we can open the file
@@ -249,6 +363,6 @@ class Reader:
                 self.process_node(object, node_list.GetChild(i))
 
             #animation is handled separately for some weird reason
-            self.process_animation(object, scene)
+            self.process_animation(object, scene, filename)
 
             return object
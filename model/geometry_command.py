@@ -4,29 +4,55 @@ Not all commands are implemented. The reference used for all commands can be
 found at http://problemkaputt.de/gbatek.htm#ds3dvideo .
 """
 
-import struct
 import euclid3 as euclid
+import numpy
+
+# The number of cycles the geometry engine spends on each command.
+CYCLES = {
+    0x40: 1,
+    0x20: 1,
+    0x30: 4,
+    0x17: 30,
+    0x18: 35,
+    0x19: 31,
+    0x1B: 22,
+    0x21: 12,
+    0x29: 1,
+    0x12: 36,
+    0x11: 17,
+    0x31: 4,
+    0x22: 1,
+    0x2A: 1,
+    0x2B: 1,
+    0x24: 8,
+    0x23: 9,
+    0x25: 8,
+    0x26: 8,
+    0x27: 8,
+    0x28: 8,
+}
 
 _24bit_to_16bit = lambda components: _scale_components(components, 1 / 8, int)
 
-def _command(command, parameters=None, tag=None):
-    """Wrap up a command byte, its parameters, and an optional tag in a dict.
+def _command(command, parameters=(), tag=None):
+    """Wrap up a command byte, its parameters, and an optional tag in a tuple.
 
     The command byte should be the command to be passed into the geometry FIFO.
 
-    The parameters are a list of all the arguments for the specified command.
-    There is no validation as to whether the required number of arguments lines
-    up with the number of arguments provided.
+    The parameters are a list of all the arguments for the specified command,
+    each an unsigned 32 bit integer word. There is no validation as to whether
+    the required number of arguments lines up with the number of arguments
+    provided.
 
     The tag is a marker for use within the converter to identify the structures
     of origin the command was derived from. This is used to keep track of which
     matrices belong to which bones and which texture commands use what textures,
     among other things.
+
+    Returns an (instruction, parameter words, tag) triple, the form
+    CommandBuffer.add takes.
     """
-    parameters = parameters if parameters else []
-    if tag:
-        return dict(instruction=command, params=parameters, tag=tag)
-    return dict(instruction=command, params=parameters)
+    return command, list(parameters), tag
 
 def _pack_bits(*bit_value_pairs):
     """Package valuse into a single integer given a description of bit fields.
@@ -50,16 +76,42 @@ def _pack_bits(*bit_value_pairs):
         packed_bits |= (value & mask) << lower
     return packed_bits
 
+def _pack_bits_many(*bit_value_pairs):
+    """Package arrays of values into an array of integers, like _pack_bits.
+
+    The bit value pairs take the same form as for _pack_bits, but each value is
+    an array; element i of the result packs element i of every value. The
+    values are masked the same way, so the results are bit-identical.
+    """
+    packed_bits = numpy.zeros(numpy.shape(bit_value_pairs[0][1]),
+        dtype=numpy.int64)
+    for key, values in bit_value_pairs:
+        lower, upper = (key, key) if isinstance(key, int) else key
+        bit_count = upper - lower + 1
+        mask = (bit_count << bit_count) -1
+        packed_bits |= (numpy.asarray(values, dtype=numpy.int64) & mask) << lower
+    return packed_bits.astype(numpy.uint32)
+
 def _pack_fixed_point_matrix_componentwise(matrix):
-    """Convert a matrix to a row vector of binary packed fixed point values.
+    """Convert a matrix to a row vector of fixed point parameter words.
 
     The matrix is converted in row major order.
     """
     # matrix.transposed must be used because normal iteration yields a column
     # major result.
-    return [struct.pack("< i", _to_fixed_point(element))
+    return [_to_fixed_point(element) & 0xFFFFFFFF
         for element in matrix.transposed()]
 
+def _pack_fixed_point_matrix_4x3(matrix):
+    """Convert an affine matrix to the 12 parameter words of a 4x3 command.
+
+    The matrix is converted in row major order, leaving out the last element of
+    each row, which the hardware takes to be (0, 0, 0, 1).
+    """
+    return [word for index, word in
+        enumerate(_pack_fixed_point_matrix_componentwise(matrix))
+        if index % 4 != 3]
+
 def _scale_components(components, constant, cast=None):
     """Scale all elements of components with an optional cast."""
     cast = cast if cast else lambda x: x
@@ -88,6 +140,14 @@ def _to_fixed_point(float_value, fraction=12):
     """
     return int(float_value * 2 ** fraction)
 
+def _to_fixed_point_many(float_values, fraction=12):
+    """Convert an array of floating point values to fixed point integers.
+
+    Values are truncated towards zero, the same as _to_fixed_point.
+    """
+    return (numpy.asarray(float_values, dtype=float) *
+        2 ** fraction).astype(numpy.int64)
+
 class PrimitiveType:
     SEPARATE_TRIANGLES = 0
     SEPAPATE_QUADRILATERALS = 1
@@ -99,8 +159,8 @@ def begin_vtxs(primitive_type):
 
     http://problemkaputt.de/gbatek.htm#ds3dpolygondefinitionsbyvertices
     """
-    return _command(0x40, [struct.pack("< I", _pack_bits(
-        ((0, 1), primitive_type)))])
+    return _command(0x40, [_pack_bits(
+        ((0, 1), primitive_type))])
 
 def color(red, green, blue, use_24bit=False):
     """Directly set the vertex color for all following vertex commands.
@@ -109,10 +169,10 @@ def color(red, green, blue, use_24bit=False):
     """
     change_bitdepth = _24bit_to_16bit if use_24bit else lambda x: x
     red, green, blue = change_bitdepth([red, green, blue])
-    return _command(0x20, [struct.pack("< I", _pack_bits(
+    return _command(0x20, [_pack_bits(
         ((0, 4), red),
         ((5, 9), green),
-        ((10, 14), blue)))])
+        ((10, 14), blue))])
 
 def dif_amb(diffuse, ambient, use_diffuse_as_vertex_color=False,
     use_24bit=False):
@@ -123,14 +183,43 @@ def dif_amb(diffuse, ambient, use_diffuse_as_vertex_color=False,
     change_bitdepth = _24bit_to_16bit if use_24bit else lambda x: x
     diffuse = change_bitdepth(diffuse)
     ambient = change_bitdepth(ambient)
-    return _command(0x30, [struct.pack("< I", _pack_bits(
+    return _command(0x30, [_pack_bits(
         ((0, 4), diffuse[0]),
         ((5, 9), diffuse[1]),
         ((10, 14), diffuse[2]),
         (15, use_diffuse_as_vertex_color),
         ((16, 20), ambient[0]),
         ((21, 25), ambient[1]),
-        ((26, 30), ambient[2])))])
+        ((26, 30), ambient[2]))])
+
+def is_affine(matrix):
+    """Check whether a matrix can be sent with the 4x3 matrix commands.
+
+    That is the case when the last element of every row is (0, 0, 0, 1) once
+    converted to fixed point.
+    """
+    return [_to_fixed_point(element) for element in
+        (matrix.d, matrix.h, matrix.l, matrix.p)] == [0, 0, 0, 1 << 12]
+
+def mtx_load_4x3(matrix, tag=None):
+    """Replace the matrix at the top of the stack with an affine matrix.
+
+    http://problemkaputt.de/gbatek.htm#ds3dmatrixloadmultiply
+    """
+    return _command(0x17, _pack_fixed_point_matrix_4x3(matrix), tag=tag)
+
+def mtx_mult(matrix, tag=None):
+    """Multiply by matrix, using the shorter 4x3 command if it is affine."""
+    if is_affine(matrix):
+        return mtx_mult_4x3(matrix, tag=tag)
+    return mtx_mult_4x4(matrix, tag=tag)
+
+def mtx_mult_4x3(matrix, tag=None):
+    """Multiply the matrix at the top of the stack by an affine matrix.
+
+    http://problemkaputt.de/gbatek.htm#ds3dmatrixloadmultiply
+    """
+    return _command(0x19, _pack_fixed_point_matrix_4x3(matrix), tag=tag)
 
 def mtx_mult_4x4(matrix, tag=None):
     """Multiply the matrix at the top of the stack by the provided matrix.
@@ -145,7 +234,7 @@ def mtx_scale(sx, sy, sz):
 
     http://problemkaputt.de/gbatek.htm#ds3dmatrixloadmultiply
     """
-    return _command(0x1B, [struct.pack("< i", _to_fixed_point(axis))
+    return _command(0x1B, [_to_fixed_point(axis) & 0xFFFFFFFF
         for axis in (sx, sy, sz)])
 
 def normal(x, y, z, tag=None):
@@ -159,10 +248,23 @@ def normal(x, y, z, tag=None):
     # resulting in incorrect lighting. To compensate, reduce the size of all
     # normal components slightly.
     to_fixed_9 = lambda x: _to_fixed_point(x * 0.95, fraction=9) & 0x3FF
-    return _command(0x21, [struct.pack("< I", _pack_bits(
+    return _command(0x21, [_pack_bits(
         ((0, 9), to_fixed_9(x)),
         ((10, 19), to_fixed_9(y)),
-        ((20, 29), to_fixed_9(z))))], tag=tag)
+        ((20, 29), to_fixed_9(z)))], tag=tag)
+
+def normal_many(normals):
+    """Pack the parameter words of a NORMAL command for each row of normals.
+
+    Returns an array with one row of words per normal, bit-identical to the
+    parameters built by normal.
+    """
+    to_fixed_9 = lambda x: _to_fixed_point_many(x * 0.95, fraction=9) & 0x3FF
+    normals = numpy.asarray(normals, dtype=float).reshape(-1, 3)
+    return _pack_bits_many(
+        ((0, 9), to_fixed_9(normals[:, 0])),
+        ((10, 19), to_fixed_9(normals[:, 1])),
+        ((20, 29), to_fixed_9(normals[:, 2])))[:, None]
 
 class PolygonAttr:
     class DepthTest:
@@ -205,7 +307,7 @@ def polygon_attr(light0=PolygonAttr.Light.DISABLE,
 
     http://problemkaputt.de/gbatek.htm#ds3dpolygonattributes
     """
-    return _command(0x29, [struct.pack("< I", _pack_bits(
+    return _command(0x29, [_pack_bits(
         (0, light0),
         (1, light1),
         (2, light2),
@@ -219,14 +321,14 @@ def polygon_attr(light0=PolygonAttr.Light.DISABLE,
         (14, depth_test),
         (15, fog_enable),
         ((16, 20), alpha),
-        ((24, 29), polygon_id)))])
+        ((24, 29), polygon_id))])
 
 def pop():
     """Remove one matrix from the top of the matrix stack.
 
     http://problemkaputt.de/gbatek.htm#ds3dmatrixstack
     """
-    return _command(0x12, [struct.pack("< I", 1)])
+    return _command(0x12, [1])
 
 def push():
     """Add another matrix to the top of the matrix stack.
@@ -243,14 +345,14 @@ def spe_emi(specular, emit, use_specular_table=False, use_24bit=False):
     change_bitdepth = _24bit_to_16bit if use_24bit else lambda x: x
     specular = change_bitdepth(specular)
     emit = change_bitdepth(emit)
-    return _command(0x31, [struct.pack("< I", _pack_bits(
+    return _command(0x31, [_pack_bits(
         ((0, 4), specular[0]),
         ((5, 9), specular[1]),
         ((10, 14), specular[2]),
         (15, use_specular_table),
         ((16, 20), emit[0]),
         ((21, 25), emit[1]),
-        ((26, 30), emit[2])))])
+        ((26, 30), emit[2]))])
 
 def texcoord(u, v):
     """Specifies the source texel in the current texture for the next vertex.
@@ -259,9 +361,23 @@ def texcoord(u, v):
     """
     to_fixed_4 = lambda x: _to_fixed_point(x, fraction=4) & 0xFFFF
     return _command(0x22, [
-        struct.pack("< I", _pack_bits(
+        _pack_bits(
             ((0, 15), to_fixed_4(u)),
-            ((16, 31), to_fixed_4(v))))])
+            ((16, 31), to_fixed_4(v)))])
+
+def texcoord_many(uvs, size):
+    """Pack the parameter words of a TEXCOORD command for each row of uvs.
+
+    The uvs are scaled by the texture size (width, height) to get texels.
+    Returns an array with one row of words per coordinate, bit-identical to the
+    parameters built by texcoord.
+    """
+    to_fixed_4 = lambda x: _to_fixed_point_many(x, fraction=4) & 0xFFFF
+    texels = (numpy.asarray(uvs, dtype=float).reshape(-1, 2) *
+        numpy.asarray(size, dtype=float))
+    return _pack_bits_many(
+        ((0, 15), to_fixed_4(texels[:, 0])),
+        ((16, 31), to_fixed_4(texels[:, 1])))[:, None]
 
 class TeximageParam:
     class Flip:
@@ -293,7 +409,7 @@ def teximage_param(width, height, vram_offset=0,
 
     http://problemkaputt.de/gbatek.htm#ds3dtextureattributes
     """
-    return _command(0x2A, [struct.pack("< I", _pack_bits(
+    return _command(0x2A, [_pack_bits(
         ((0, 15), int(vram_offset / 8)),
         (16, u_repeat),
         (17, v_repeat),
@@ -303,7 +419,7 @@ def teximage_param(width, height, vram_offset=0,
         ((23, 25), _texture_size_shift(height)),
         ((26, 28), format),
         (29, palette_transparency),
-        ((30, 31), transform_mode)))], tag=texture_name)
+        ((30, 31), transform_mode))], tag=texture_name)
 
 def texpllt_base(offset, texture_format):
     """Set the palette offset for paletted textures.
@@ -311,8 +427,8 @@ def texpllt_base(offset, texture_format):
     http://problemkaputt.de/gbatek.htm#ds3dtextureattributes
     """
     shift = 8 if texture_format == TeximageParam.Format.PALETTED_4_COLOR else 16
-    return _command(0x2B, [struct.pack("< I", _pack_bits(
-        ((0, 12), offset >> shift)))])
+    return _command(0x2B, [_pack_bits(
+        ((0, 12), offset >> shift))])
 
 def vtx_10(x, y, z, tag=None):
     """Specify a vertex with 1.3.6 fixed point components.
@@ -328,10 +444,23 @@ def vtx_10(x, y, z, tag=None):
     """
     to_fixed_6 = lambda x: _to_fixed_point(x, fraction=6) & 0x3FF
     return _command(0x24, [
-        struct.pack("< I", _pack_bits(
+        _pack_bits(
             ((0, 9), to_fixed_6(x)),
             ((10, 19), to_fixed_6(y)),
-            ((20, 29), to_fixed_6(z))))], tag=tag)
+            ((20, 29), to_fixed_6(z)))], tag=tag)
+
+def vtx_10_many(positions):
+    """Pack the parameter words of a VTX_10 command for each row of positions.
+
+    Returns an array with one row of words per vertex, bit-identical to the
+    parameters built by vtx_10.
+    """
+    to_fixed_6 = lambda x: _to_fixed_point_many(x, fraction=6) & 0x3FF
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    return _pack_bits_many(
+        ((0, 9), to_fixed_6(positions[:, 0])),
+        ((10, 19), to_fixed_6(positions[:, 1])),
+        ((20, 29), to_fixed_6(positions[:, 2])))[:, None]
 
 def vtx_16(x, y, z, tag=None):
     """Specify a vertex with 1.3.12 fixed point components.
@@ -346,7 +475,78 @@ def vtx_16(x, y, z, tag=None):
     """
     to_fixed_12 = lambda x: _to_fixed_point(x, fraction=12) & 0xFFFF
     return _command(0x23, [
-        struct.pack("< I", _pack_bits(
+        _pack_bits(
+            ((0, 15), to_fixed_12(x)),
+            ((16, 31), to_fixed_12(y))),
+        _pack_bits(
+            ((0, 15), to_fixed_12(z)))], tag=tag)
+
+def vtx_16_many(positions):
+    """Pack the parameter words of a VTX_16 command for each row of positions.
+
+    Returns an array with one row of two words per vertex, bit-identical to the
+    parameters built by vtx_16.
+    """
+    to_fixed_12 = lambda x: _to_fixed_point_many(x, fraction=12) & 0xFFFF
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+    return numpy.stack((
+        _pack_bits_many(
+            ((0, 15), to_fixed_12(positions[:, 0])),
+            ((16, 31), to_fixed_12(positions[:, 1]))),
+        _pack_bits_many(
+            ((0, 15), to_fixed_12(positions[:, 2])))), axis=1)
+
+def vtx_xy(x, y, tag=None):
+    """Specify a vertex with 1.3.12 fixed point X and Y components.
+
+    The Z component is reused from the previous vertex. This takes one argument
+    word instead of the two needed by vtx_16 without losing any precision.
+
+    http://problemkaputt.de/gbatek.htm#ds3dpolygondefinitionsbyvertices
+    """
+    to_fixed_12 = lambda x: _to_fixed_point(x, fraction=12) & 0xFFFF
+    return _command(0x25, [
+        _pack_bits(
             ((0, 15), to_fixed_12(x)),
-            ((16, 31), to_fixed_12(y)))), struct.pack("< I", _pack_bits(
-            ((0, 15), to_fixed_12(z))))], tag=tag)
+            ((16, 31), to_fixed_12(y)))], tag=tag)
+
+def vtx_xz(x, z, tag=None):
+    """Specify a vertex with 1.3.12 fixed point X and Z components.
+
+    The Y component is reused from the previous vertex.
+
+    http://problemkaputt.de/gbatek.htm#ds3dpolygondefinitionsbyvertices
+    """
+    to_fixed_12 = lambda x: _to_fixed_point(x, fraction=12) & 0xFFFF
+    return _command(0x26, [
+        _pack_bits(
+            ((0, 15), to_fixed_12(x)),
+            ((16, 31), to_fixed_12(z)))], tag=tag)
+
+def vtx_yz(y, z, tag=None):
+    """Specify a vertex with 1.3.12 fixed point Y and Z components.
+
+    The X component is reused from the previous vertex.
+
+    http://problemkaputt.de/gbatek.htm#ds3dpolygondefinitionsbyvertices
+    """
+    to_fixed_12 = lambda x: _to_fixed_point(x, fraction=12) & 0xFFFF
+    return _command(0x27, [
+        _pack_bits(
+            ((0, 15), to_fixed_12(y)),
+            ((16, 31), to_fixed_12(z)))], tag=tag)
+
+def vtx_diff(dx, dy, dz, tag=None):
+    """Specify a vertex as a small offset from the previous vertex.
+
+    Each offset is a signed 10 bit count of 1/4096ths, the same fractional
+    precision as vtx_16, so offsets must lie within [-512/4096, 511/4096].
+
+    http://problemkaputt.de/gbatek.htm#ds3dpolygondefinitionsbyvertices
+    """
+    to_fixed_12 = lambda x: _to_fixed_point(x, fraction=12) & 0x3FF
+    return _command(0x28, [
+        _pack_bits(
+            ((0, 9), to_fixed_12(dx)),
+            ((10, 19), to_fixed_12(dy)),
+            ((20, 29), to_fixed_12(dz)))], tag=tag)
@@ -0,0 +1,46 @@
+"""Reduces sampled animation channels to the keyframes they need.
+
+Animations are imported as one sample per channel per frame. Most channels
+hold still or move steadily for long stretches, and the frames in between can
+be recovered by interpolating linearly between their neighbours. This pass
+keeps only the frames that can't be recovered to within a tolerance.
+
+A channel's keys always start at frame 0. A channel that never moves further
+than the tolerance from its first value keeps only that key; otherwise the
+last frame is kept too. Frames after the last key hold its value.
+
+Errors are measured on the channel's values before encoding (matrix elements,
+or vertex and normal components), as the largest difference in any one of
+them.
+"""
+
+import numpy
+
+def channel_values(frames):
+    """Convert a channel's frames into a (frames, components) array."""
+    return numpy.array([frame[:] for frame in frames], dtype=float).reshape(
+        len(frames), -1)
+
+def interpolation_error(values, start, end):
+    """Return the largest error of interpolating between frames start and end."""
+    steps = numpy.arange(end - start + 1, dtype=float)[:, None] / (end - start)
+    interpolated = values[start] + (values[end] - values[start]) * steps
+    return numpy.abs(values[start:end + 1] - interpolated).max()
+
+def reduce_keyframes(values, tolerance):
+    """Choose the keyframes needed to recover values to within tolerance.
+
+    values is a (frames, components) array. Returns the frame indices to keep,
+    in order.
+    """
+    frame_count = len(values)
+    if frame_count <= 1 or numpy.abs(values - values[0]).max() <= tolerance:
+        return [0]
+    keys = [0]
+    start = 0
+    for end in range(2, frame_count):
+        if interpolation_error(values, start, end) > tolerance:
+            start = end - 1
+            keys.append(start)
+    keys.append(frame_count - 1)
+    return keys
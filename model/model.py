@@ -1,68 +1,304 @@
+from array import array
+from collections.abc import Sequence
+
 import euclid3 as euclid
+import numpy
+
+from .bounds import minimal_sphere
 
 import logging
 log = logging.getLogger()
 
+def _max_facing_count(directions, counts, block_size=1024):
+    """Find the largest weighted count of directions on one side of a plane.
+
+    Each direction is used in turn as a plane normal; directions with a dot
+    product >= 0 count as positive and the rest as negative, matching the
+    comparison in Mesh.max_cull_polys. The dot product is summed in x, y, z
+    order so the signs agree exactly with euclid's Vector3.dot.
+
+    counts may have a column per kind of weight, each maximized separately
+    over the same sweep; the result then has one value per column.
+    """
+    best = numpy.zeros(counts.shape[1:], dtype=int)
+    for start in range(0, len(directions), block_size):
+        test = directions[start:start + block_size]
+        angles = (test[:, 0, None] * directions[None, :, 0] +
+                  test[:, 1, None] * directions[None, :, 1] +
+                  test[:, 2, None] * directions[None, :, 2])
+        positive = (angles >= 0) @ counts
+        negative = (angles < 0) @ counts
+        best = numpy.maximum(best, numpy.maximum(positive.max(axis=0),
+            negative.max(axis=0)))
+    return best
+
 class Model:
     def __init__(self):
         self.materials = {}
         self.materials[None] = self.Material()
         self.animations = {}
         self.groups = ["default"]
+        self._group_codes = {"default": 0}
         self.global_matrix = euclid.Matrix4()
+        # Files other than the model file the model was built from, such as
+        # material libraries and textures.
+        self.dependencies = []
         # self.active_mesh = "default"
         self.meshes = {}
 
     class Mesh:
+        # Mesh data is kept in flat typed arrays rather than as one object per
+        # vertex and polygon. Polygons are stored as runs of corners: polygon
+        # i owns corners polygon_offsets[i] up to polygon_offsets[i + 1], and
+        # each corner has a vertex index, a UV pair and a vertex normal.
+        # Groups and materials are stored as integer codes; vertex groups
+        # index into model.groups and polygon materials into material_names.
+        #
+        # The vertices and polygons attributes are sequence views that build
+        # Vertex and Polygon objects on demand, so code written against the
+        # object interface keeps working, while the geometry queries below
+        # operate on whole arrays at once.
+        HAS_UVS = 0x1
+        HAS_NORMALS = 0x2
+        SMOOTH = 0x4
+
         def __init__(self, model):
-            self.vertices = []
-            self.polygons = []
             self.model = model
             self.name = ""
+            # The (name, suffix) pair the name was derived from, for meshes
+            # made out of another mesh; see model.names.
+            self.name_origin = None
+            self.material_names = []
+            self._material_codes = {}
+            self._positions = array("d")
+            self._vertex_groups = array("i")
+            self._polygon_offsets = array("i", [0])
+            self._polygon_vertices = array("i")
+            self._polygon_uvs = array("d")
+            self._polygon_vertex_normals = array("d")
+            self._polygon_normals = array("d")
+            self._polygon_materials = array("i")
+            self._polygon_flags = array("B")
+            self._numpy_cache = {}
+
+        def __getstate__(self):
+            # Pickle only the mesh's own arrays, leaving out the model (and
+            # with it every other mesh and animation); the receiving side
+            # attaches the mesh to a model again.
+            state = self.__dict__.copy()
+            del state["model"]
+            state["_numpy_cache"] = {}
+            return state
+
+        def __setstate__(self, state):
+            self.__dict__.update(state)
+            self.model = None
+
+        @property
+        def vertices(self):
+            return Model._VertexView(self)
+
+        @property
+        def polygons(self):
+            return Model._PolygonView(self)
+
+        def vertex_count(self):
+            return len(self._vertex_groups)
+
+        def polygon_count(self):
+            return len(self._polygon_flags)
+
+        def _as_numpy(self, name, dtype, columns=None):
+            # numpy copies of the storage arrays are cached until the next
+            # modification, and handed out read-only so the cache can't be
+            # changed behind our back.
+            if name not in self._numpy_cache:
+                values = numpy.array(getattr(self, "_" + name), dtype=dtype)
+                if columns:
+                    values = values.reshape(-1, columns)
+                values.flags.writeable = False
+                self._numpy_cache[name] = values
+            return self._numpy_cache[name]
+
+        @property
+        def positions(self):
+            return self._as_numpy("positions", float, 3)
+
+        @property
+        def vertex_groups(self):
+            return self._as_numpy("vertex_groups", int)
+
+        @property
+        def polygon_offsets(self):
+            return self._as_numpy("polygon_offsets", int)
+
+        @property
+        def polygon_vertices(self):
+            return self._as_numpy("polygon_vertices", int)
+
+        @property
+        def polygon_uvs(self):
+            return self._as_numpy("polygon_uvs", float, 2)
+
+        @property
+        def polygon_vertex_normals(self):
+            return self._as_numpy("polygon_vertex_normals", float, 3)
+
+        @property
+        def polygon_normals(self):
+            return self._as_numpy("polygon_normals", float, 3)
+
+        @property
+        def polygon_materials(self):
+            return self._as_numpy("polygon_materials", int)
+
+        @property
+        def polygon_flags(self):
+            return self._as_numpy("polygon_flags", int)
+
+        def polygon_sizes(self):
+            return numpy.diff(self.polygon_offsets)
+
+        def material_code(self, material):
+            if material not in self._material_codes:
+                self._material_codes[material] = len(self.material_names)
+                self.material_names.append(material)
+            return self._material_codes[material]
+
+        def location(self, vertex_index):
+            offset = vertex_index * 3
+            return euclid.Vector3(*self._positions[offset:offset + 3])
 
         def addVertex(self, location=euclid.Vector3(0.0, 0.0, 0.0), group="default"):
-            self.vertices.append(Model.Vertex(location, group))
-            if group not in self.model.groups:
-                self.model.groups.append(group)
+            self._positions.extend((location[0], location[1], location[2]))
+            self._vertex_groups.append(self.model.group_code(group))
+            self._numpy_cache.clear()
+
+        def setVertexGroup(self, vertex_index, group):
+            self._vertex_groups[vertex_index] = self.model.group_code(group)
+            self._numpy_cache.clear()
 
         def addPolygon(self, vertex_list=None, uvlist=None, vertex_normals=None, material=None, smooth=True):
             face_normal = self.face_normal(vertex_list)
 
             #if this is a 2-point polygon, turn it into a triangle; this will draw
             #on hardware as a perfect line segment
-            if abs(self.vertices[vertex_list[0]].location - self.vertices[vertex_list[1]].location) < 0.01:
+            if abs(self.location(vertex_list[0]) - self.location(vertex_list[1])) < 0.01:
                 log.debug("Encountered LINE SEGMENT variant 1")
                 vertex_list = [vertex_list[0], vertex_list[2], vertex_list[2]]
-                vertex_normals = [vertex_normals[0], vertex_normals[2], vertex_normals[2]]
-                face_normal = euclid.Vector3(vertex_normals[0][0],vertex_normals[0][1],vertex_normals[0][2]) #pick one at random
-            elif abs(self.vertices[vertex_list[1]].location - self.vertices[vertex_list[2]].location) < 0.01:
+                if vertex_normals:
+                    vertex_normals = [vertex_normals[0], vertex_normals[2], vertex_normals[2]]
+                    face_normal = euclid.Vector3(vertex_normals[0][0],vertex_normals[0][1],vertex_normals[0][2]) #pick one at random
+            elif abs(self.location(vertex_list[1]) - self.location(vertex_list[2])) < 0.01:
                 log.debug("Encountered LINE SEGMENT variant 2")
                 vertex_list = [vertex_list[0], vertex_list[1], vertex_list[1]]
-                vertex_normals = [vertex_normals[0], vertex_normals[1], vertex_normals[1]]
-                face_normal = euclid.Vector3(vertex_normals[0][0],vertex_normals[0][1],vertex_normals[0][2])
-            elif abs(self.vertices[vertex_list[2]].location - self.vertices[vertex_list[0]].location) < 0.01:
+                if vertex_normals:
+                    vertex_normals = [vertex_normals[0], vertex_normals[1], vertex_normals[1]]
+                    face_normal = euclid.Vector3(vertex_normals[0][0],vertex_normals[0][1],vertex_normals[0][2])
+            elif abs(self.location(vertex_list[2]) - self.location(vertex_list[0])) < 0.01:
                 log.debug("Encountered LINE SEGMENT variant 3")
                 vertex_list = [vertex_list[0], vertex_list[1], vertex_list[1]]
-                vertex_normals = [vertex_normals[0], vertex_normals[1], vertex_normals[1]]
-                face_normal = euclid.Vector3(vertex_normals[0][0],vertex_normals[0][1],vertex_normals[0][2])
-
-            self.polygons.append(Model.Polygon(vertex_list, uvlist, material,
-                                 face_normal, vertex_normals, self, smooth))
+                if vertex_normals:
+                    vertex_normals = [vertex_normals[0], vertex_normals[1], vertex_normals[1]]
+                    face_normal = euclid.Vector3(vertex_normals[0][0],vertex_normals[0][1],vertex_normals[0][2])
+
+            flags = self.SMOOTH if smooth else 0
+            self._polygon_vertices.extend(vertex_list)
+            for i in range(len(vertex_list)):
+                if uvlist:
+                    self._polygon_uvs.extend((uvlist[i][0], uvlist[i][1]))
+                else:
+                    self._polygon_uvs.extend((0.0, 0.0))
+                if vertex_normals:
+                    self._polygon_vertex_normals.extend((vertex_normals[i][0],
+                        vertex_normals[i][1], vertex_normals[i][2]))
+                else:
+                    self._polygon_vertex_normals.extend((0.0, 0.0, 0.0))
+            if uvlist:
+                flags |= self.HAS_UVS
+            if vertex_normals:
+                flags |= self.HAS_NORMALS
+            self._polygon_offsets.append(len(self._polygon_vertices))
+            self._polygon_normals.extend((face_normal.x, face_normal.y, face_normal.z))
+            self._polygon_materials.append(self.material_code(material))
+            self._polygon_flags.append(flags)
+            self._numpy_cache.clear()
+
+        def subset(self, name, polygon_indices):
+            """Copy the given polygons, and the vertices they use, to a new mesh.
+
+            The new mesh belongs to the same model but isn't added to it. It
+            keeps the material list, so material codes carry over unchanged.
+            """
+            polygon_indices = numpy.asarray(polygon_indices, dtype=int)
+            offsets = self.polygon_offsets
+            sizes = numpy.diff(offsets)[polygon_indices]
+            new_offsets = numpy.concatenate(([0], numpy.cumsum(sizes)))
+            corners = (numpy.repeat(offsets[polygon_indices] - new_offsets[:-1],
+                sizes) + numpy.arange(new_offsets[-1]))
+            return self.from_corners(name, polygon_indices, sizes, corners)
+
+        def from_corners(self, name, polygon_indices, sizes, corners,
+            polygon_normals=None, keep_vertices=False):
+            """Build a new mesh from polygons made of this mesh's corners.
+
+            New polygon i takes its material and flags from polygon
+            polygon_indices[i], and the next sizes[i] entries of corners as its
+            corners, each bringing its vertex, UV and vertex normal along. The
+            face normals are taken from polygon_indices too, unless given.
+            Only the vertices used are copied, in their original order, unless
+            keep_vertices is set: then every vertex is kept, at the same index.
+            As with subset, the new mesh isn't added to the model.
+            """
+            polygon_indices = numpy.asarray(polygon_indices, dtype=int)
+            corners = numpy.asarray(corners, dtype=int)
+            new_offsets = numpy.concatenate(([0], numpy.cumsum(sizes)))
+            if keep_vertices:
+                used = numpy.arange(self.vertex_count())
+                polygon_vertices = self.polygon_vertices[corners]
+            else:
+                used, polygon_vertices = numpy.unique(
+                    self.polygon_vertices[corners], return_inverse=True)
+            if polygon_normals is None:
+                polygon_normals = self.polygon_normals[polygon_indices]
+
+            mesh = Model.Mesh(self.model)
+            mesh.name = name
+            if name == self.name:
+                mesh.name_origin = self.name_origin
+            mesh.material_names = list(self.material_names)
+            mesh._material_codes = dict(self._material_codes)
+            for attribute, typecode, values in (
+                ("_positions", "d", self.positions[used]),
+                ("_vertex_groups", "i", self.vertex_groups[used]),
+                ("_polygon_offsets", "i", new_offsets),
+                ("_polygon_vertices", "i", polygon_vertices),
+                ("_polygon_uvs", "d", self.polygon_uvs[corners]),
+                ("_polygon_vertex_normals", "d",
+                    self.polygon_vertex_normals[corners]),
+                ("_polygon_normals", "d", polygon_normals),
+                ("_polygon_materials", "i",
+                    self.polygon_materials[polygon_indices]),
+                ("_polygon_flags", "B", self.polygon_flags[polygon_indices])):
+                storage = array(typecode)
+                storage.frombytes(numpy.ascontiguousarray(values,
+                    dtype=storage.typecode).tobytes())
+                setattr(mesh, attribute, storage)
+            return mesh
 
         def bounding_box(self):
             # returns a bounding box, as a dict of 6 values.
             # x,y,z indicate the negative side of the box, and
             # wx, wy, and wz are the width of the box.
 
+            # the box always includes the origin
             x,y,z = 0,0,0
             wx, wy, wz = 0,0,0
-            for point in self.vertices:
-                x = min((x, point.location.x))
-                y = min((y, point.location.y))
-                z = min((z, point.location.z))
-                wx = max((wx, point.location.x))
-                wy = max((wy, point.location.y))
-                wz = max((wz, point.location.z))
+            if self.vertex_count():
+                x, y, z = (float(value) for value in
+                           numpy.minimum(self.positions.min(axis=0), 0))
+                wx, wy, wz = (float(value) for value in
+                              numpy.maximum(self.positions.max(axis=0), 0))
 
             # distance
             wx = wx - x
@@ -79,40 +315,45 @@ class Model:
             }
 
         def bounding_sphere(self):
-            # returns the center of the object, and the magnitude of the furthest
-            # point from that center.
-
-            all_points = []
-            all_points.extend(self.vertices)
-
-            midpoint = sum([point.location
-                            for point in all_points],
-                           euclid.Vector3()) / len(all_points)
-
-            radius = max( abs( abs(point.location - midpoint) )  for point in all_points)
-            return midpoint, radius
+            # returns the center and radius of the smallest sphere that
+            # encloses every vertex.
+            center, radius = minimal_sphere(self.positions)
+            return euclid.Vector3(*(float(value) for value in center)), radius
 
         def max_cull_polys(self):
             # for this model, compute the maximum number of polygons
             # that will ever be drawn at a given orientation.
-
-            max = 0
-            for testface in self.polygons:
-                countPositive = 0
-                countNegative = 0
-                for face in self.polygons:
-                    angle = face.face_normal.dot(testface.face_normal)
-                    #print(angle)
-                    if angle >= 0:
-                        countPositive += 1
-                    if angle < 0:
-                        countNegative += 1
-                if countPositive > max:
-                    max = countPositive
-                if countNegative > max:
-                    max = countNegative
-
-            return max
+            #
+            # Every face normal is tried as a view direction, counting the
+            # faces on either side of it. Identical normals are grouped first
+            # so each distinct direction is only tested once, then the dot
+            # products are taken a block at a time over the whole normal
+            # matrix. The result is kept until the mesh changes.
+            return self._max_facing_weights()[0]
+
+        def max_cull_vertices(self):
+            # the same as max_cull_polys, but counting the vertices of the
+            # polygons drawn, as if no polygons shared any.
+            return self._max_facing_weights()[1]
+
+        def _max_facing_weights(self):
+            # both worst cases come from one sweep over the normals, and are
+            # cached together.
+            if "max_facing_weights" not in self._numpy_cache:
+                if not self.polygon_count():
+                    weights = (0, 0)
+                else:
+                    directions, inverse = numpy.unique(self.polygon_normals,
+                        axis=0, return_inverse=True)
+                    inverse = inverse.ravel()
+                    totals = numpy.stack((
+                        numpy.bincount(inverse, minlength=len(directions)),
+                        numpy.bincount(inverse, weights=self.polygon_sizes(),
+                            minlength=len(directions)).astype(int)), axis=1)
+                    weights = tuple(int(weight) for weight in
+                        _max_facing_count(directions, totals))
+                self._numpy_cache["max_facing_weights"] = weights
+            return self._numpy_cache["max_facing_weights"]
 
         def face_normal(self, vertex_list):
             # todo: implement different method for handling concave edges
@@ -121,7 +362,7 @@ class Model:
 
             v = []
             for index in vertex_list[:3]:
-                v.append(self.vertices[index].location)
+                v.append(self.location(index))
 
             a = v[1] - v[0]
             b = v[2] - v[0]
@@ -131,74 +372,137 @@ class Model:
 
             return normal
 
+        def face_normals(self):
+            # the same calculation as face_normal, for every polygon at once
+            first_corners = self.polygon_offsets[:-1]
+            corners = self.polygon_vertices
+            points = self.positions
+            v0 = points[corners[first_corners]]
+            a = points[corners[first_corners + 1]] - v0
+            b = points[corners[first_corners + 2]] - v0
+            normals = numpy.stack((
+                a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+                -a[:, 0] * b[:, 2] + a[:, 2] * b[:, 0],
+                a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]), axis=1)
+            lengths = numpy.sqrt(normals[:, 0] ** 2 + normals[:, 1] ** 2 +
+                                 normals[:, 2] ** 2)
+            lengths[lengths == 0] = 1.0
+            return normals / lengths[:, None]
+
+        def point_normals(self):
+            # averages the face normals of every face referencing each point;
+            # points that no face references get a normal of NaN.
+            sizes = self.polygon_sizes()
+            face_normals = numpy.repeat(self.face_normals(), sizes, axis=0)
+            corners = self.polygon_vertices
+            # a face only counts once per point, even if it repeats the point
+            polygon_ids = numpy.repeat(numpy.arange(len(sizes)), sizes)
+            unique = numpy.unique(numpy.stack((polygon_ids, corners), axis=1),
+                                  axis=0, return_index=True)[1]
+            totals = numpy.zeros((self.vertex_count(), 3))
+            numpy.add.at(totals, corners[unique], face_normals[unique])
+            counts = numpy.bincount(corners[unique], minlength=self.vertex_count())
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                return totals / counts[:, None]
+
         def point_normal(self, vertex_index):
             # gather the face normals for every face which references this point
-            face_normals = [self.face_normal(face.vertices)
-                            for face in self.polygons
-                                if vertex_index in face.vertices]
-
             # if we didn't get any faces, there is *no normal*, since this is
             # just a point.
-            if len(face_normals) == 0:
+            normal = self.point_normals()[vertex_index]
+            if numpy.isnan(normal).any():
                 return None
-
-            # sum a list of tuples
-            result = [0.0, 0.0, 0.0]
-            for normal in face_normals:
-                result[0] += normal[0]
-                result[1] += normal[1]
-                result[2] += normal[2]
-
-            # average
-            result = (
-                result[0] / len(face_normals),
-                result[1] / len(face_normals),
-                result[2] / len(face_normals),
-            )
-
-            return result
+            return tuple(float(component) for component in normal)
+
+    class _VertexView(Sequence):
+        def __init__(self, mesh):
+            self.mesh = mesh
+
+        def __len__(self):
+            return self.mesh.vertex_count()
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("vertex index out of range")
+            return Model.Vertex(self.mesh, index)
+
+    class _PolygonView(Sequence):
+        def __init__(self, mesh):
+            self.mesh = mesh
+
+        def __len__(self):
+            return self.mesh.polygon_count()
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("polygon index out of range")
+            return Model.Polygon(self.mesh, index)
 
     class Vertex:
-        def __init__(self, location=euclid.Vector3(0.0, 0.0, 0.0), group="default"):
-            # if a list or a tuple is passed in, convert it to a Vector3
-            if type(location).__name__=='list' or type(location).__name__=='tuple':
-                location = euclid.Vector3(location[0], location[1], location[2])
+        # A view of one vertex in a Mesh's arrays.
+        def __init__(self, mesh, index):
+            self.mesh = mesh
+            self.index = index
 
-            self.location = location
-            self.group = group
+        @property
+        def location(self):
+            return self.mesh.location(self.index)
+
+        @property
+        def group(self):
+            return self.mesh.model.groups[self.mesh._vertex_groups[self.index]]
 
         def setGroup(self, group):
-            if group not in self.model.groups:
-                self.model.groups.append(group)
-            self.group = group
+            self.mesh.setVertexGroup(self.index, group)
 
     class Polygon:
-        def __init__(self, vertex_list = None, uvlist = None, material=None,
-                     face_normal=None, vertex_normals=None, model=None, smooth=True):
-            if vertex_list is None:
-                self.vertices = []
-            else:
-                self.vertices = vertex_list
-            self.material = material
-            self.uvlist = uvlist
-            self.face_normal = face_normal
-            self.vertex_normals = vertex_normals
-            self.model = model
-            self.smooth_shading = smooth
+        # A snapshot of one polygon in a Mesh's arrays.
+        __slots__ = ("model", "index", "vertices", "uvlist", "material",
+                     "face_normal", "vertex_normals", "smooth_shading")
+
+        def __init__(self, mesh, index):
+            start = mesh._polygon_offsets[index]
+            end = mesh._polygon_offsets[index + 1]
+            flags = mesh._polygon_flags[index]
+            self.model = mesh
+            self.index = index
+            self.vertices = list(mesh._polygon_vertices[start:end])
+            self.uvlist = None
+            if flags & mesh.HAS_UVS:
+                uvs = mesh._polygon_uvs
+                self.uvlist = [(uvs[corner * 2], uvs[corner * 2 + 1])
+                               for corner in range(start, end)]
+            self.vertex_normals = None
+            if flags & mesh.HAS_NORMALS:
+                normals = mesh._polygon_vertex_normals
+                self.vertex_normals = [tuple(normals[corner * 3:corner * 3 + 3])
+                                       for corner in range(start, end)]
+            self.material = mesh.material_names[mesh._polygon_materials[index]]
+            self.face_normal = euclid.Vector3(
+                *mesh._polygon_normals[index * 3:index * 3 + 3])
+            self.smooth_shading = bool(flags & mesh.SMOOTH)
 
         def vertexGroup(self):
             if self.isMixed():
                 return "__mixed"
-            return self.model.vertices[self.vertices[0]].group
+            return self.model.model.groups[self.model._vertex_groups[self.vertices[0]]]
 
         def isMixed(self):
-            orig = self.model.vertices[self.vertices[0]].group
+            groups = self.model._vertex_groups
+            orig = groups[self.vertices[0]]
             for v in self.vertices:
-                if orig != self.model.vertices[v].group:
+                if orig != groups[v]:
                     return True
             return False
 
-
     class Material:
         def __init__(self):
             self.texture = None
@@ -252,6 +556,25 @@ class Model:
     #def addPolygon(self, vertex_list=None, uvlist=None, vertex_normals=None, material=None, smooth=True):
     #    ActiveMesh().addPolygon(vertex_list, uvlist, vertex_normals, material, smooth)
 
+    def group_code(self, group):
+        if group not in self._group_codes:
+            self._group_codes[group] = len(self.groups)
+            self.groups.append(group)
+        return self._group_codes[group]
+
+    def detached(self):
+        """Copy the model's shared settings, without its meshes or animations.
+
+        The copy carries what converting a single mesh needs, and is small
+        enough to send to another process along with the mesh.
+        """
+        copy = Model()
+        copy.materials = self.materials
+        copy.groups = list(self.groups)
+        copy._group_codes = dict(self._group_codes)
+        copy.global_matrix = self.global_matrix.copy()
+        return copy
+
     def addMesh(self, mesh_name):
         self.meshes[mesh_name] = self.Mesh(self)
         self.meshes[mesh_name].name = mesh_name
@@ -0,0 +1,35 @@
+"""Names the converter gives the meshes it makes out of another mesh.
+
+Clusters and levels of detail are named after their mesh with a suffix, such
+as ".0" or ".lod1". DSGX chunks hold names of at most 31 bytes (see
+dsgx.to_dsgx_string), which would cut the suffix off a long name and leave the
+runtime unable to tell the meshes apart, so the mesh's own name is shortened
+instead.
+
+A mesh made out of one that was itself made from another, such as a cluster
+of a level of detail, adds its suffix after the one already there. Each mesh
+remembers the original name and its suffixes as its name_origin, so that it
+is always the original name that gets shortened.
+"""
+
+from collections import Counter
+
+MAX_LENGTH = 31
+
+class NameClash(ValueError):
+    pass
+
+def derived_name(mesh, suffix):
+    """Name a mesh made out of mesh, by appending suffix to mesh's name.
+
+    Returns the name, and the name_origin to give the new mesh.
+    """
+    name = mesh.name
+    if mesh.name_origin:
+        name, suffix = mesh.name_origin[0], mesh.name_origin[1] + suffix
+    return name[:MAX_LENGTH - len(suffix)] + suffix, (name, suffix)
+
+def find_clashes(names):
+    """List the names that would be the same once stored in a chunk."""
+    counts = Counter(name[:MAX_LENGTH] for name in names)
+    return sorted(name for name, count in counts.items() if count > 1)
@@ -1,158 +1,243 @@
-from __future__ import with_statement
-import model
-import euclid3 as euclid
+"""Reader for Wavefront OBJ files and their MTL material libraries.
+
+The file is parsed as it is read, line by line, without holding the text in
+memory. Vertex data goes straight into flat typed arrays, and faces are added
+to the current Model.Mesh as soon as they are parsed. Each object (o) or group
+(g) becomes a mesh of its own, holding only the vertices its faces use.
+
+http://paulbourke.net/dataformats/obj/
+http://paulbourke.net/dataformats/mtl/
+"""
+
+import logging
+import os
+from array import array
+
 from .model import Model
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger()
+
+READ_BUFFER_SIZE = 1 << 20
+DEFAULT_MESH_NAME = "default"
+
 class Reader:
     def __init__(self):
-        self.v = []
-        self.vn = []
-        self.vt = []
-        self.f = []
-        
-        self.smoothingGroup = 0
+        self.v = array("d")
+        self.vn = array("d")
+        self.vt = array("d")
         self.materials = {}
         self.current_material = None
-        
+        self.dependencies = []
+        self.directory = ""
+        self.model = None
+        self.mesh = None
+        self.vertex_map = None
+        self.vertex_maps = {}
+        self.unknown_commands = set()
 
     def read(self, filename):
-        with open(filename) as fp:
-            for line in fp.readlines():
-                self.process_command(self.remove_comments(line))
-        # ok, now we have the obj read in, convert it to a model
-        object = model.Model()
-        
-        #add the materials to the model
-        for k in self.materials.keys():
-            object.addMaterial(k, self.materials[k]["ambient"], self.materials[k]["specular"], self.materials[k]["diffuse"])
-        
-        # First, add the vertecies
-        for point in self.v:
-            object.addVertex(euclid.Vector3(point['x'], point['y'], point['z']))
-        
-        # for each polygon in the model, add the appropriate
-        # data to the model
-        for face in self.f:
-            # build a list of vertecies for this face
-            points = []
-            uvlist = []
-            normals = []
-            for point in face["points"]:
-                # todo: make sure this data is valid!
-                points.append(point['v'])
-                # do we have a uvlist?
-                uvlist = []
-                if (point['vt'] != None):
-                    uvlist.append( (
-                            self.vt[point['vt']]['x'],
-                            self.vt[point['vt']]['y'],
-                    ) )
-                if len(uvlist) == 0:
-                    uvlist = None
-                #similarly, do we have a Normals list?
-                if (point['vn'] != None):
-                    normals.append( (
-                            self.vn[point['vn']]['x'],
-                            self.vn[point['vn']]['y'],
-                            self.vn[point['vn']]['z'],
-                    ) )
-            if len(normals) == 0:
-                normals = None
-            #object.polygons.append(model.Model.Polygon(points, uvlist))
-            object.addPoly(points, uvlist, normals, face["material"]) # todo: vertex normals here
-        
-        return object
-    
-    def process_command(self, line):
-        parts = line.split()
-        if len(parts) > 0:
-            if parts[0] in self.commands:
-                self.commands[parts[0]](self, parts)
-            else:
-                print("Unrecognized command: {0}".format(parts[0]))
-        
+        self.directory = os.path.dirname(filename)
+        self.model = Model()
+        with open(filename, buffering=READ_BUFFER_SIZE) as fp:
+            for line in fp:
+                self.process_line(line)
+        for mesh_name in [name for name, mesh in self.model.meshes.items()
+            if not mesh.polygon_count()]:
+            del self.model.meshes[mesh_name]
+        self.model.dependencies.extend(self.dependencies)
+        return self.model
+
+    def process_line(self, line):
+        # The common cases come first, ahead of the general command lookup.
+        if "#" not in line:
+            if line.startswith("v "):
+                parts = line.split()
+                if len(parts) >= 4:
+                    self.v.extend((float(parts[1]), float(parts[2]),
+                        float(parts[3])))
+                    return
+            elif line.startswith("f "):
+                self._face(line.split())
+                return
+        self.process_command(self.remove_comments(line).split())
+
+    def process_command(self, parts):
+        if not parts:
+            return
+        if parts[0] in self.commands:
+            self.commands[parts[0]](self, parts)
+        elif parts[0] not in self.unknown_commands:
+            self.unknown_commands.add(parts[0])
+            log.debug("Unrecognized command: %s", parts[0])
+
     def remove_comments(self, line):
-        return line[:line.find("#")]
-        
+        comment = line.find("#")
+        return line[:comment] if comment >= 0 else line
+
     def _vertex(self, parts):
         if len(parts) < 4:
-            print("Bad 'v' command: not enough arguments")
+            log.warning("Bad 'v' command: not enough arguments")
         else:
-            self.v.append({'x': float(parts[1]), 'y': float(parts[2]), 'z': float(parts[3])})
-    
+            self.v.extend((float(parts[1]), float(parts[2]), float(parts[3])))
+
     def _vertex_normal(self, parts):
         if len(parts) < 4:
-            print("Bad 'vn' command: not enough arguments")
+            log.warning("Bad 'vn' command: not enough arguments")
         else:
-            self.vn.append({'x': float(parts[1]), 'y': float(parts[2]), 'z': float(parts[3])})
-    
+            self.vn.extend((float(parts[1]), float(parts[2]), float(parts[3])))
+
     def _vertex_uv(self, parts):
         if len(parts) < 3:
-            print("Bad 'vt' command: not enough arguments")
+            log.warning("Bad 'vt' command: not enough arguments")
         else:
-            self.vt.append({'x': float(parts[1]), 'y': float(parts[2])})
+            self.vt.extend((float(parts[1]), float(parts[2])))
+
+    def _resolve_index(self, index, count):
+        # OBJ indices start from 1, and negative indices count back from the
+        # most recent element.
+        index = int(index)
+        return index - 1 if index > 0 else count + index
+
+    def _use_mesh(self, name):
+        if name not in self.model.meshes:
+            self.model.addMesh(name)
+            self.vertex_maps[name] = {}
+        self.mesh = self.model.meshes[name]
+        self.vertex_map = self.vertex_maps[name]
+
+    def _mesh_vertex(self, index):
+        """Find the current mesh's vertex for position index, adding it if new."""
+        local_index = self.vertex_map.get(index)
+        if local_index is None:
+            local_index = self.mesh.vertex_count()
+            self.mesh.addVertex(self.v[index * 3:index * 3 + 3])
+            self.vertex_map[index] = local_index
+        return local_index
 
     def _face(self, parts):
         if len(parts) < 4:
-            print("Bad 'f' command: not enough arguments to make a polygon (need 3 points)")
-        else:
-            # A polygon is a list of points, normals, and uv coords. The last two
-            # can be omitted, in which case they should be ignored.
-            poly = []
-            for part in parts[1:]:
-                pieces = part.split("/")
-                point = int(float(pieces[0])) - 1 # note: -1 converts index to 0 based
-                texture = None
-                if len(pieces) > 1 and pieces[1] is not "":
-                    texture = int(float(pieces[1])) - 1
-                normal = None
-                if len(pieces) > 2 and pieces[2] is not "":
-                    normal = int(float(pieces[2])) - 1
-                poly.append({'v': point, 'vt': texture, 'vn': normal})
-                
-            # todo maybe: check for invalid polys?
-            # todo perhaps: check for and convert negative reference numbers?
-            # todo perhaps: check for and use smoothing group for polys
-            self.f.append({"points": poly, "material": self.current_material})
-    
-    def _smoothing_group(self, parts):
-        # sets the current smoothing group. This will be utilized by
-        # polygons which do not have vertex normals. (maybe)
-        if len(parts) > 1:
-            self.smoothingGroup = int(float(parts[1]))
+            log.warning("Bad 'f' command: not enough arguments to make a polygon (need 3 points)")
+            return
+        if self.mesh is None:
+            self._use_mesh(DEFAULT_MESH_NAME)
+        vertex_count = len(self.v) // 3
+        uv_count = len(self.vt) // 2
+        normal_count = len(self.vn) // 3
+        points = []
+        uvlist = []
+        normals = []
+        for part in parts[1:]:
+            # A corner is v, v/vt, v//vn or v/vt/vn.
+            pieces = part.split("/")
+            points.append(self._mesh_vertex(self._resolve_index(pieces[0],
+                vertex_count)))
+            if uvlist is not None and len(pieces) > 1 and pieces[1]:
+                uv = self._resolve_index(pieces[1], uv_count)
+                uvlist.append((self.vt[uv * 2], self.vt[uv * 2 + 1]))
+            else:
+                uvlist = None
+            if normals is not None and len(pieces) > 2 and pieces[2]:
+                normal = self._resolve_index(pieces[2], normal_count)
+                normals.append(tuple(self.vn[normal * 3:normal * 3 + 3]))
+            else:
+                normals = None
+
+        # The hardware draws triangles and quads; anything larger is split
+        # into a fan of triangles.
+        if len(points) <= 4:
+            corner_lists = [range(len(points))]
         else:
-            print("Bad 's' command: needs an argument.")
-            
+            corner_lists = [(0, i, i + 1) for i in range(1, len(points) - 1)]
+        for corners in corner_lists:
+            self.mesh.addPolygon([points[i] for i in corners],
+                [uvlist[i] for i in corners] if uvlist else None,
+                [normals[i] for i in corners] if normals else None,
+                self.current_material, smooth=bool(normals))
+
+    def _object(self, parts):
+        self._use_mesh(" ".join(parts[1:]) if len(parts) > 1 else
+            DEFAULT_MESH_NAME)
+
     def _mtllib(self, parts):
-        print("Loading material library: " + parts[1])
-        
-        with open(parts[1]) as fp:
-            for line in fp.readlines():
-                self.process_command(self.remove_comments(line))
-    
+        for library in parts[1:]:
+            filename = os.path.join(self.directory, library)
+            log.info("Loading material library: %s", filename)
+            self.dependencies.append(filename)
+            try:
+                with open(filename, buffering=READ_BUFFER_SIZE) as fp:
+                    for line in fp:
+                        self.process_command(self.remove_comments(line).split())
+            except OSError as error:
+                log.warning("Could not read material library %s: %s",
+                    filename, error)
+        # Faces use no material until the file picks one.
+        self.current_material = None
+
     def _usemtl(self, parts):
-        if parts[1] in self.materials:
+        if parts[1] in self.model.materials:
             self.current_material = parts[1]
         else:
-            print("Bad material reference: " + parts[1])
-        
+            log.warning("Bad material reference: %s", parts[1])
+            self.current_material = None
+
     def _new_material(self, parts):
-        self.materials[parts[1]] = {}
+        self.materials[parts[1]] = dict(ambient=(0.2, 0.2, 0.2),
+            diffuse=(0.8, 0.8, 0.8), specular=(1.0, 1.0, 1.0),
+            emit=(0.0, 0.0, 0.0), texture=None, texture_size=(0, 0))
         self.current_material = parts[1]
-    
-    def _mtl_Ns(self, parts):
-        #shininess exponent, or something; different modeling programs interpret this value differently.
-        self.materials[self.current_material]["Ns"] = parts[1]
-    
+        self._update_material()
+
+    def _update_material(self):
+        material = self.materials[self.current_material]
+        self.model.addMaterial(self.current_material, material["ambient"],
+            material["specular"], material["diffuse"], material["emit"],
+            material["texture"], *material["texture_size"])
+
+    def _set_material_property(self, name, value):
+        if self.current_material not in self.materials:
+            log.warning("Material property %s set outside of a material", name)
+            return
+        self.materials[self.current_material][name] = value
+        self._update_material()
+
+    def _color(self, parts):
+        return tuple(float(part) for part in parts[1:4])
+
     def _mtl_ambient_color(self, parts):
-        self.materials[self.current_material]["ambient"] = {"r": float(parts[1]), "g": float(parts[2]), "b": float(parts[3])}
-    
+        self._set_material_property("ambient", self._color(parts))
+
     def _mtl_diffuse_color(self, parts):
-        self.materials[self.current_material]["diffuse"] = {"r": float(parts[1]), "g": float(parts[2]), "b": float(parts[3])}
-    
+        self._set_material_property("diffuse", self._color(parts))
+
     def _mtl_specular_color(self, parts):
-        self.materials[self.current_material]["specular"] = {"r": float(parts[1]), "g": float(parts[2]), "b": float(parts[3])}
-        
+        self._set_material_property("specular", self._color(parts))
+
+    def _mtl_emissive_color(self, parts):
+        self._set_material_property("emit", self._color(parts))
+
+    def _mtl_diffuse_texture(self, parts):
+        # Options such as -s or -o may come before the file name, which is
+        # always last.
+        filename = os.path.join(self.directory, parts[-1])
+        self.dependencies.append(filename)
+        texture_name = os.path.splitext(os.path.basename(filename))[0]
+        size = (1, 1)
+        if Image is None:
+            log.warning("Pillow is needed to read the size of texture %s",
+                filename)
+        else:
+            try:
+                with Image.open(filename) as image:
+                    size = image.size
+            except OSError:
+                log.warning("Could not load texture file: %s", filename)
+        self._set_material_property("texture", texture_name)
+        self._set_material_property("texture_size", size)
 
     commands = {
         # .obj commands
@@ -160,13 +245,15 @@ class Reader:
         "vn": _vertex_normal,
         "vt": _vertex_uv,
         "f": _face,
-        #"s": _smoothing_group,
+        "o": _object,
+        "g": _object,
         "mtllib": _mtllib,
         "usemtl": _usemtl,
         # .mtl commands
         "newmtl": _new_material,
-        "Ns": _mtl_Ns,
         "Ka": _mtl_ambient_color,
         "Kd": _mtl_diffuse_color,
         "Ks": _mtl_specular_color,
-    }
\ No newline at end of file
+        "Ke": _mtl_emissive_color,
+        "map_Kd": _mtl_diffuse_texture,
+    }
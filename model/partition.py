@@ -0,0 +1,64 @@
+"""Splits large meshes into spatially coherent clusters.
+
+A mesh is drawn from a single call list, so the engine can only cull it as a
+whole. Splitting it into clusters, each with its own call list and bounding
+sphere, lets the engine skip the parts that are out of view.
+
+Clusters are built as a k-d tree over the polygons' centroids: a set of
+polygons larger than the budget is split at the median along the axis its
+centroids spread furthest over, and each half is split again until it fits.
+Clusters come out in tree order, so neighbouring clusters are near each other,
+and polygons keep their original order within a cluster.
+"""
+
+import numpy
+
+from model.names import derived_name
+
+def polygon_centroids(mesh):
+    """Return the average position of each polygon's corners."""
+    positions = mesh.positions[mesh.polygon_vertices]
+    offsets = mesh.polygon_offsets
+    return (numpy.add.reduceat(positions, offsets[:-1], axis=0) /
+        numpy.diff(offsets)[:, None])
+
+def partition(mesh, max_polygons):
+    """Group mesh's polygons into clusters of at most max_polygons each.
+
+    Returns a list of arrays of polygon indices.
+    """
+    if mesh.polygon_count() <= max_polygons:
+        return [numpy.arange(mesh.polygon_count())]
+    centroids = polygon_centroids(mesh)
+    clusters = []
+    pending = [numpy.arange(mesh.polygon_count())]
+    while pending:
+        polygons = pending.pop()
+        if len(polygons) <= max_polygons:
+            clusters.append(numpy.sort(polygons))
+            continue
+        points = centroids[polygons]
+        axis = numpy.ptp(points, axis=0).argmax()
+        order = numpy.argsort(points[:, axis], kind="stable")
+        middle = len(polygons) // 2
+        # The lower half goes on last, so it is split (and output) first.
+        pending.append(polygons[order[middle:]])
+        pending.append(polygons[order[:middle]])
+    return clusters
+
+def split_mesh(mesh, max_polygons):
+    """Split mesh into meshes of at most max_polygons polygons each.
+
+    A mesh that already fits is returned unchanged, as the only element of the
+    list. Otherwise the clusters are named after the mesh, numbered from zero,
+    shortening the mesh's name where the number wouldn't fit (see model.names).
+    """
+    clusters = partition(mesh, max_polygons)
+    if len(clusters) == 1:
+        return [mesh]
+    parts = []
+    for index, polygons in enumerate(clusters):
+        name, origin = derived_name(mesh, ".%d" % index)
+        parts.append(mesh.subset(name, polygons))
+        parts[-1].name_origin = origin
+    return parts
@@ -0,0 +1,106 @@
+"""Removes commands that don't change the state of the geometry engine.
+
+The emitter sends every normal, texture coordinate and material attribute it
+needs without checking whether the hardware already holds that value. This
+pass walks the finished command list, tracks what each state command last set,
+and drops commands that would set the same value again.
+
+Commands carrying a tag that the engine patches at runtime (bone matrices,
+textures, and vertices and normals under vertex animation) are always kept,
+and the value they set is treated as unknown afterwards.
+"""
+
+import logging
+
+import model.geometry_command as gc
+
+log = logging.getLogger()
+
+COLOR = 0x20
+NORMAL = 0x21
+TEXCOORD = 0x22
+POLYGON_ATTR = 0x29
+TEXIMAGE_PARAM = 0x2A
+PLTT_BASE = 0x2B
+DIF_AMB = 0x30
+SPE_EMI = 0x31
+BEGIN_VTXS = 0x40
+
+# Anything that changes a matrix also changes how later normals (and,
+# depending on the texture transform mode, texture coordinates) come out.
+MATRIX_COMMANDS = set(range(0x10, 0x1D))
+LIGHTING_COMMANDS = {COLOR, DIF_AMB, SPE_EMI, 0x32, 0x33, 0x34}
+
+TRACKED_COMMANDS = {COLOR, NORMAL, TEXCOORD, POLYGON_ATTR, TEXIMAGE_PARAM,
+    PLTT_BASE, DIF_AMB, SPE_EMI}
+
+# Stands in for a value the converter can't know, such as one the engine
+# patches in at runtime. It never compares equal to a real value.
+UNKNOWN = object()
+
+def is_patched(tag, patched_tag_types):
+    """Check whether the engine rewrites the parameters of a tagged command.
+
+    Texture tags are plain texture names and are always patched; other tags are
+    (type, name) pairs and are patched when their type is in patched_tag_types.
+    """
+    if not tag:
+        return False
+    if isinstance(tag, tuple):
+        return tag[0] in patched_tag_types
+    return True
+
+def optimize(commands, patched_tag_types=("bone",), packed=False):
+    """Drop commands that set state to the value it already has.
+
+    commands is a CommandBuffer. Returns a new buffer with the remaining
+    commands, and logs how many words and cycles were saved in the call list
+    laid out with the given packing.
+    """
+    state = {}
+    kept = []
+    removed = []
+    follows_patched_texture = False
+    for index, instruction in enumerate(commands.instructions):
+        # The engine may skip what came before a break, so nothing set
+        # before it can be counted on.
+        if index in commands.breaks:
+            state.clear()
+            follows_patched_texture = False
+        params = commands.parameters(index)
+        patched = is_patched(commands.tags.get(index), patched_tag_types)
+        # The palette base right after a patched texture belongs to that
+        # texture binding, so leave it (and its value) to the engine.
+        if instruction == PLTT_BASE and follows_patched_texture:
+            patched = True
+        if (instruction in TRACKED_COMMANDS and not patched and
+            state.get(instruction) == params):
+            removed.append(index)
+            continue
+        kept.append(index)
+        follows_patched_texture = instruction == TEXIMAGE_PARAM and patched
+
+        if instruction in TRACKED_COMMANDS:
+            state[instruction] = UNKNOWN if patched else params
+        # Lighting is worked out when the normal is sent, using the matrices,
+        # material and lights in effect at that moment, and the light enables
+        # latched by BEGIN_VTXS.
+        if (instruction in MATRIX_COMMANDS or
+            instruction in LIGHTING_COMMANDS or instruction == BEGIN_VTXS):
+            state.pop(NORMAL, None)
+        # Normals overwrite the vertex color, as can DIF_AMB.
+        if instruction in (NORMAL, DIF_AMB):
+            state.pop(COLOR, None)
+        if instruction in MATRIX_COMMANDS or instruction == TEXIMAGE_PARAM:
+            state.pop(TEXCOORD, None)
+
+    optimized = commands.select(kept)
+    # Packed, a removed command may free a slot rather than a whole command
+    # word, or move a dummy word, so compare the finished layouts.
+    saved_words = (len(commands.layout(packed)[0]) -
+        len(optimized.layout(packed)[0]))
+    saved_cycles = sum(gc.CYCLES[commands.instructions[index]]
+        for index in removed)
+    log.info("Removed %d redundant commands, saving %d words and %d cycles",
+        len(removed), saved_words, saved_cycles)
+    return optimized
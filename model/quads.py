@@ -0,0 +1,167 @@
+"""Merges pairs of triangles into quads.
+
+Meshes exported fully triangulated send six vertices for every pair of
+triangles that could have been drawn as one quad with four, and use two
+entries of polygon RAM instead of one. Two triangles sharing an edge are
+merged when the quad they make would be drawn the same:
+
+- they share material, flags (and so shading) and bone group
+- their corners on the shared edge have the same UVs and vertex normals
+- they face the same way, to within PLANAR_TOLERANCE
+- the quad is convex
+- the far corner's UV follows the same linear mapping as the first
+  triangle's, as the engine interpolates UVs across the whole quad
+
+Of the pairs that qualify, the ones making the squarest quads are merged
+first, and each triangle joins at most one quad. Every vertex is kept at the
+same index, so anything keyed by vertex index still applies.
+"""
+
+import math
+
+import numpy
+
+PLANAR_TOLERANCE = math.radians(1)
+# How far the far corner's UV may stray from the first triangle's mapping,
+# relative to the span of the quad's UVs.
+UV_TOLERANCE = 0.01
+# Corners whose sides turn less than this (as the sine of the angle) are
+# treated as straight, which makes the quad a triangle.
+CONVEX_TOLERANCE = 1e-6
+
+def _unit(vectors):
+    lengths = numpy.sqrt((vectors ** 2).sum(axis=-1, keepdims=True))
+    return vectors / numpy.where(lengths > 0, lengths, 1.0), lengths[..., 0]
+
+def _candidates(mesh, triangles):
+    """Pair up the triangles sharing each edge used by exactly two of them.
+
+    Returns the first triangle of each pair, the corner starting the shared
+    edge in it, and the same for the second triangle, with the edge running
+    the other way.
+    """
+    vertices = mesh.polygon_vertices[mesh.polygon_offsets[triangles][:, None] +
+        numpy.arange(3)]
+    starts = vertices.ravel()
+    ends = numpy.roll(vertices, -1, axis=1).ravel()
+    keys = starts * mesh.vertex_count() + ends
+    reverse = ends * mesh.vertex_count() + starts
+    _, inverse, counts = numpy.unique(keys, return_inverse=True,
+        return_counts=True)
+    order = numpy.argsort(keys, kind="stable")
+    position = numpy.minimum(numpy.searchsorted(keys[order], reverse),
+        len(keys) - 1)
+    partner = order[position]
+    # An edge used twice the same way round belongs to more than two
+    # triangles, or to triangles facing opposite ways. Each edge turns up from
+    # both of its triangles; only one is kept.
+    edge = numpy.arange(len(keys))
+    counts = counts[inverse.ravel()]
+    paired = ((keys[partner] == reverse) & (counts == 1) &
+        (counts[partner] == 1) & (edge < partner) &
+        (edge // 3 != partner // 3))
+    first, second = edge[paired], partner[paired]
+    return (triangles[first // 3], first % 3, triangles[second // 3],
+        second % 3)
+
+def merge_triangles(mesh):
+    """Merge pairs of mesh's triangles into quads.
+
+    Returns the merged mesh, which keeps mesh's name, and the number of pairs
+    merged. If there are none, mesh itself is returned.
+    """
+    triangles = numpy.flatnonzero(mesh.polygon_sizes() == 3)
+    if len(triangles) < 2:
+        return mesh, 0
+    first, first_edge, second, second_edge = _candidates(mesh, triangles)
+    offsets = mesh.polygon_offsets
+    # The quad runs p, o, q, r: the first triangle is p q r, and the second
+    # q p o, sharing the edge p q.
+    p = offsets[first] + first_edge
+    q = offsets[first] + (first_edge + 1) % 3
+    r = offsets[first] + (first_edge + 2) % 3
+    second_q = offsets[second] + second_edge
+    second_p = offsets[second] + (second_edge + 1) % 3
+    o = offsets[second] + (second_edge + 2) % 3
+
+    flags = mesh.polygon_flags
+    groups = mesh.vertex_groups[mesh.polygon_vertices]
+    triangle_groups = numpy.where((groups[p] == groups[q]) &
+        (groups[q] == groups[r]), groups[p], -1)
+    other_groups = numpy.where((groups[second_p] == groups[second_q]) &
+        (groups[second_q] == groups[o]), groups[o], -1)
+    uvs = mesh.polygon_uvs
+    vertex_normals = mesh.polygon_vertex_normals
+    same_corner = lambda values, one, other: numpy.isclose(values[one],
+        values[other], rtol=0, atol=1e-6).all(axis=1)
+    ok = ((mesh.polygon_materials[first] == mesh.polygon_materials[second]) &
+        (flags[first] == flags[second]) & (triangle_groups == other_groups) &
+        same_corner(uvs, p, second_p) & same_corner(uvs, q, second_q) &
+        same_corner(vertex_normals, p, second_p) &
+        same_corner(vertex_normals, q, second_q))
+
+    points = mesh.positions[mesh.polygon_vertices]
+    quad = numpy.stack((points[p], points[o], points[q], points[r]), axis=1)
+    first_normal, first_area = _unit(numpy.cross(quad[:, 2] - quad[:, 0],
+        quad[:, 3] - quad[:, 0]))
+    second_normal, second_area = _unit(numpy.cross(quad[:, 1] - quad[:, 0],
+        quad[:, 2] - quad[:, 0]))
+    ok &= (first_area > 0) & (second_area > 0)
+    ok &= ((first_normal * second_normal).sum(axis=1) >=
+        math.cos(PLANAR_TOLERANCE))
+
+    sides, _ = _unit(numpy.roll(quad, -1, axis=1) - quad)
+    turns = (numpy.cross(numpy.roll(sides, 1, axis=1), sides) *
+        first_normal[:, None]).sum(axis=2)
+    ok &= (turns > CONVEX_TOLERANCE).all(axis=1)
+
+    # Find the far corner as a mix of the first triangle's corners, and see if
+    # the same mix of their UVs lands on its UV.
+    edges = numpy.stack((quad[:, 2] - quad[:, 0], quad[:, 3] - quad[:, 0]),
+        axis=2)
+    gram = numpy.einsum("nki,nkj->nij", edges, edges)
+    gram[~ok] = numpy.identity(2)
+    weights = numpy.linalg.solve(gram, numpy.einsum("nki,nk->ni", edges,
+        quad[:, 1] - quad[:, 0])[..., None])[..., 0]
+    predicted = (uvs[p] + weights[:, :1] * (uvs[q] - uvs[p]) +
+        weights[:, 1:] * (uvs[r] - uvs[p]))
+    quad_uvs = numpy.stack((uvs[p], uvs[o], uvs[q], uvs[r]), axis=1)
+    span = numpy.ptp(quad_uvs, axis=1).max(axis=1)
+    textured = (flags[first] & mesh.HAS_UVS) != 0
+    ok &= ~textured | (numpy.abs(predicted - uvs[o]).max(axis=1) <=
+        UV_TOLERANCE * span)
+
+    # Squarer quads first: the worst corner's departure from a right angle.
+    squareness = numpy.abs((numpy.roll(sides, 1, axis=1) * sides).sum(axis=2)
+        ).max(axis=1)
+    candidates = numpy.flatnonzero(ok)
+    candidates = candidates[numpy.argsort(squareness[candidates],
+        kind="stable")]
+    merged = {}
+    used = numpy.zeros(mesh.polygon_count(), dtype=bool)
+    for candidate in candidates:
+        if used[first[candidate]] or used[second[candidate]]:
+            continue
+        used[first[candidate]] = used[second[candidate]] = True
+        merged[first[candidate]] = candidate
+    if not merged:
+        return mesh, 0
+
+    polygon_indices = []
+    sizes = []
+    corners = []
+    partners = set(second[candidate] for candidate in merged.values())
+    for polygon in range(mesh.polygon_count()):
+        if polygon in partners:
+            continue
+        polygon_indices.append(polygon)
+        if polygon in merged:
+            candidate = merged[polygon]
+            sizes.append(4)
+            corners.extend((p[candidate], o[candidate], q[candidate],
+                r[candidate]))
+        else:
+            sizes.append(offsets[polygon + 1] - offsets[polygon])
+            corners.extend(range(offsets[polygon], offsets[polygon + 1]))
+    return (mesh.from_corners(mesh.name, polygon_indices, sizes, corners,
+        keep_vertices=True), len(merged))
@@ -0,0 +1,214 @@
+"""Binary snapshots of imported models, kept next to their source files.
+
+Importing a model is the slow half of a conversion, and the result doesn't
+depend on the conversion options. A sidecar stores an imported Model so later
+runs can skip the importer entirely.
+
+A sidecar file is laid out as:
+
+   magic (8 bytes), format version (u32), metadata length (u32)
+   metadata: UTF-8 JSON
+   arrays, each starting on an 8 byte boundary
+
+The metadata holds the materials, groups, global matrix and animation
+structure, the source and dependency files' sizes, modification times and
+hashes, and the type, offset and length of every array. Mesh and animation data
+are stored as flat arrays in the host's byte order, so the file can be memory
+mapped and the arrays copied out in one go.
+
+A sidecar is used only while the source file and every file it depends on
+(material libraries, textures) are unchanged. A file whose size and modification
+time still match is assumed unchanged; otherwise its hash is compared.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+import euclid3 as euclid
+
+from model import VERSION
+from model.cache import hash_file
+from model.model import Model
+
+log = logging.getLogger()
+
+MAGIC = b"DSGXMDL\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("< 8s I I")
+ALIGNMENT = 8
+SUFFIX = ".sidecar"
+
+MESH_ARRAYS = ("_positions", "_vertex_groups", "_polygon_offsets",
+    "_polygon_vertices", "_polygon_uvs", "_polygon_vertex_normals",
+    "_polygon_normals", "_polygon_materials", "_polygon_flags")
+MATERIAL_ATTRIBUTES = ("texture", "texture_size", "ambient", "diffuse",
+    "specular", "emit", "smooth_shading")
+
+def sidecar_filename(filename):
+    return filename + SUFFIX
+
+def _file_state(filename):
+    status = os.stat(filename)
+    return dict(filename=os.path.abspath(filename), size=status.st_size,
+        mtime=status.st_mtime_ns, hash=hash_file(filename))
+
+def _unchanged(state):
+    try:
+        status = os.stat(state["filename"])
+    except OSError:
+        return False
+    if status.st_size == state["size"] and status.st_mtime_ns == state["mtime"]:
+        return True
+    return status.st_size == state["size"] and (
+        hash_file(state["filename"]) == state["hash"])
+
+def _from_json(value):
+    # JSON turns tuples into lists; the model uses tuples throughout.
+    return tuple(value) if isinstance(value, list) else value
+
+class _ArrayWriter:
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+
+    def add(self, values):
+        """Queue an array to be written, returning its description."""
+        self.size += -self.size % ALIGNMENT
+        description = dict(typecode=values.typecode, itemsize=values.itemsize,
+            offset=self.size, count=len(values))
+        self.arrays.append((self.size, values))
+        self.size += len(values) * values.itemsize
+        return description
+
+    def write(self, fp, base):
+        for offset, values in self.arrays:
+            fp.write(b"\0" * (base + offset - fp.tell()))
+            values.tofile(fp)
+
+def _animation_metadata(animation, arrays):
+    channels = []
+    for channel_name, frames in animation.channels.items():
+        frames = list(frames)
+        if frames and isinstance(frames[0], euclid.Matrix4):
+            kind, width = "matrix", 16
+        else:
+            kind, width = "vector", len(frames[0]) if frames else 0
+        values = array("d")
+        for frame in frames:
+            values.extend(frame[:] if kind == "matrix" else frame)
+        channels.append(dict(name=channel_name, kind=kind, width=width,
+            data=arrays.add(values)))
+    return dict(name=animation.name, data_type=animation.data_type,
+        mesh_name=animation.mesh_name, length=animation.length,
+        channels=channels)
+
+def write(filename, model, source_filename):
+    """Write model to a sidecar for source_filename."""
+    arrays = _ArrayWriter()
+    metadata = dict(
+        converter_version=VERSION,
+        byteorder=sys.byteorder,
+        sources=[_file_state(source_filename)] +
+            [_file_state(dependency) for dependency in model.dependencies
+            if os.path.exists(dependency)],
+        dependencies=model.dependencies,
+        groups=model.groups,
+        global_matrix=model.global_matrix[:],
+        materials=[[name, {attribute: getattr(material, attribute)
+            for attribute in MATERIAL_ATTRIBUTES
+            if hasattr(material, attribute)}]
+            for name, material in model.materials.items()],
+        meshes=[dict(name=mesh.name, material_names=mesh.material_names,
+            arrays={name: arrays.add(getattr(mesh, name))
+            for name in MESH_ARRAYS})
+            for mesh in model.meshes.values()],
+        animations=[_animation_metadata(animation, arrays)
+            for animations in model.animations.values()
+            for animation in animations])
+    encoded = json.dumps(metadata).encode("utf-8")
+    base = HEADER.size + len(encoded)
+    base += -base % ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(descriptor, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        fp.write(encoded)
+        arrays.write(fp, base)
+    os.replace(temporary_path, filename)
+
+def _read_array(data, base, description):
+    values = array(description["typecode"])
+    if values.itemsize != description["itemsize"]:
+        raise ValueError("array item sizes differ from the writing host")
+    start = base + description["offset"]
+    values.frombytes(data[start:start + description["count"] * values.itemsize])
+    return values
+
+def read(filename):
+    """Load the model stored in a sidecar, or return None if it is stale.
+
+    Returns None if the sidecar is missing, unreadable, was written by another
+    converter version or host, or if its source or dependencies have changed.
+    """
+    try:
+        with open(filename, "rb") as fp, mmap.mmap(fp.fileno(), 0,
+            access=mmap.ACCESS_READ) as data:
+            magic, version, metadata_size = HEADER.unpack_from(data)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                return None
+            metadata = json.loads(bytes(
+                data[HEADER.size:HEADER.size + metadata_size]).decode("utf-8"))
+            if (metadata["converter_version"] != VERSION or
+                metadata["byteorder"] != sys.byteorder or
+                not all(_unchanged(state) for state in metadata["sources"])):
+                return None
+            base = HEADER.size + metadata_size
+            base += -base % ALIGNMENT
+            with memoryview(data) as view:
+                return _build_model(metadata,
+                    lambda description: _read_array(view, base, description))
+    except (OSError, ValueError, KeyError, struct.error) as error:
+        log.debug("Ignoring sidecar %s: %s", filename, error)
+        return None
+
+def _build_model(metadata, read_array):
+    model = Model()
+    model.dependencies = list(metadata["dependencies"])
+    for group in metadata["groups"]:
+        model.group_code(group)
+    model.global_matrix = euclid.Matrix4.new(*metadata["global_matrix"])
+    for name, attributes in metadata["materials"]:
+        material = model.Material()
+        for attribute, value in attributes.items():
+            setattr(material, attribute, _from_json(value))
+        model.materials[name] = material
+
+    for mesh_metadata in metadata["meshes"]:
+        mesh = model.addMesh(mesh_metadata["name"])
+        for material in mesh_metadata["material_names"]:
+            mesh.material_code(material)
+        for name, description in mesh_metadata["arrays"].items():
+            setattr(mesh, name, read_array(description))
+
+    for animation_metadata in metadata["animations"]:
+        animation = model.create_animation(animation_metadata["name"],
+            animation_metadata["data_type"], animation_metadata["mesh_name"])
+        animation.length = animation_metadata["length"]
+        for channel in animation_metadata["channels"]:
+            values = read_array(channel["data"])
+            width = channel["width"]
+            frames = [values[start:start + width]
+                for start in range(0, len(values), width or 1)]
+            if channel["kind"] == "matrix":
+                frames = [euclid.Matrix4.new(*frame) for frame in frames]
+            else:
+                frames = [tuple(frame) for frame in frames]
+            animation.add_channel(channel["name"], frames)
+    return model
@@ -0,0 +1,270 @@
+"""Simplifies meshes by quadric edge collapse, for distant levels of detail.
+
+Each vertex keeps a quadric: the sum of the squared distance functions of the
+planes of the polygons around it. Collapsing an edge moves one of its vertices
+onto the other, and costs the other's position under both quadrics, which
+measures how far the result strays from the original surface. The cheapest
+collapses are made first until the mesh is down to the polygons wanted.
+
+Collapses only ever move a vertex onto one of its neighbours, so the vertices
+left are a subset of the original ones, with their bone groups unchanged. A
+vertex stays put if moving it would tear anything the engine relies on:
+
+- it lies on the mesh's border, or on an edge shared by more than two polygons
+- its polygons differ in material or flags, or its corners in UVs or vertex
+  normals, so it lies on a material border, UV seam or hard edge
+- the neighbour belongs to another bone group
+- the move would turn one of its polygons too far, or flatten it
+
+A polygon that loses a corner to a collapse becomes a triangle, and one left
+with fewer than three corners is removed.
+"""
+
+import heapq
+import math
+
+import numpy
+
+from model.names import derived_name
+
+# The screen the switch distances are worked out for: the DS's height in
+# pixels, and a typical vertical field of view.
+SCREEN_HEIGHT = 192
+FIELD_OF_VIEW = math.radians(70)
+
+# The most a collapse may turn any polygon it changes. Beyond this, polygons
+# fold over, or stand on edge along a seam they were pulled onto.
+MAX_NORMAL_CHANGE = math.radians(60)
+
+def _plane_quadric(points):
+    """Find the quadric of the plane through points, or None if degenerate."""
+    normal = _newell_normal(points)
+    length = math.sqrt(normal @ normal)
+    if length < 1e-12:
+        return None
+    normal = normal / length
+    plane = numpy.append(normal, -normal @ points.mean(axis=0))
+    return numpy.outer(plane, plane)
+
+def _newell_normal(points):
+    following = numpy.roll(points, -1, axis=0)
+    return numpy.cross(points, following).sum(axis=0)
+
+class _Simplifier:
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.positions = mesh.positions
+        self.groups = mesh.vertex_groups
+        self.corner_vertices = mesh.polygon_vertices
+        flags = mesh.polygon_flags
+        offsets = mesh.polygon_offsets
+        self.polygons = [list(range(offsets[index], offsets[index + 1]))
+            for index in range(mesh.polygon_count())]
+        self.polygon_count = len(self.polygons)
+        self.vertex_polygons = [set() for _ in range(mesh.vertex_count())]
+        # A corner's attributes that must match all around a vertex it moves.
+        uvs = mesh.polygon_uvs
+        normals = mesh.polygon_vertex_normals
+        materials = mesh.polygon_materials
+        self.corner_keys = []
+        for polygon, corners in enumerate(self.polygons):
+            for corner in corners:
+                self.corner_keys.append((int(materials[polygon]),
+                    int(flags[polygon]),
+                    tuple(uvs[corner]) if flags[polygon] & mesh.HAS_UVS
+                        else None,
+                    tuple(normals[corner]) if flags[polygon] & mesh.HAS_NORMALS
+                        else None))
+        self.fixed = numpy.zeros(mesh.vertex_count(), dtype=bool)
+        self.quadrics = numpy.zeros((mesh.vertex_count(), 4, 4))
+        for polygon, corners in enumerate(self.polygons):
+            vertices = self.corner_vertices[corners]
+            for vertex in vertices:
+                self.vertex_polygons[vertex].add(polygon)
+            if len(set(vertices)) < len(vertices):
+                # Degenerate polygons, like the triangles standing in for line
+                # segments, are left exactly as they are.
+                self.fixed[vertices] = True
+                continue
+            quadric = _plane_quadric(self.positions[vertices])
+            if quadric is not None:
+                self.quadrics[vertices] += quadric
+        self.modified = set()
+        self.error = 0.0
+        self.min_cosine = math.cos(MAX_NORMAL_CHANGE)
+
+    def vertices(self, polygon):
+        return [int(self.corner_vertices[corner])
+            for corner in self.polygons[polygon]]
+
+    def neighbours(self, vertex):
+        """Count the polygons along each edge from vertex, by its other end."""
+        edges = {}
+        for polygon in self.vertex_polygons[vertex]:
+            vertices = self.vertices(polygon)
+            position = vertices.index(vertex)
+            for other in (vertices[position - 1],
+                vertices[(position + 1) % len(vertices)]):
+                edges[other] = edges.get(other, 0) + 1
+        return edges
+
+    def movable(self, vertex):
+        if self.fixed[vertex]:
+            return False
+        if any(count != 2 for count in self.neighbours(vertex).values()):
+            return False
+        keys = {self.corner_keys[corner]
+            for polygon in self.vertex_polygons[vertex]
+            for corner in self.polygons[polygon]
+            if self.corner_vertices[corner] == vertex}
+        return len(keys) == 1
+
+    def cost(self, vertex, target):
+        point = numpy.append(self.positions[target], 1.0)
+        return float(point @ (self.quadrics[vertex] + self.quadrics[target]) @
+            point)
+
+    def collapsible(self, vertex, target):
+        """Check that moving vertex onto target keeps the mesh intact."""
+        if self.groups[vertex] != self.groups[target]:
+            return False
+        if not self.movable(vertex):
+            return False
+        shared = self.vertex_polygons[vertex] & self.vertex_polygons[target]
+        # Any other neighbour the two share would end up with an edge to
+        # target used by more than two polygons.
+        allowed = {other for polygon in shared
+            for other in self.vertices(polygon)}
+        common = set(self.neighbours(vertex)) & set(self.neighbours(target))
+        if not common <= allowed:
+            return False
+        for polygon in self.vertex_polygons[vertex]:
+            vertices = self.vertices(polygon)
+            before = _newell_normal(self.positions[vertices])
+            after = [target if other == vertex else other
+                for other in vertices if other != vertex or
+                polygon not in shared]
+            if len(set(after)) < 3:
+                continue
+            after = _newell_normal(self.positions[after])
+            lengths = math.sqrt((after @ after) * (before @ before))
+            if lengths < 1e-24 or after @ before < self.min_cosine * lengths:
+                return False
+        return True
+
+    def collapse(self, vertex, target, cost):
+        shared = self.vertex_polygons[vertex] & self.vertex_polygons[target]
+        # Moved corners take the target's attributes from a polygon both share,
+        # which lies on the same side of any seam as the vertex's polygons.
+        target_corner = next(corner for polygon in sorted(shared)
+            for corner in self.polygons[polygon]
+            if self.corner_vertices[corner] == target)
+        for polygon in list(self.vertex_polygons[vertex]):
+            corners = self.polygons[polygon]
+            if polygon in shared:
+                corners = [corner for corner in corners
+                    if self.corner_vertices[corner] != vertex]
+            else:
+                corners = [target_corner if self.corner_vertices[corner] ==
+                    vertex else corner for corner in corners]
+                self.vertex_polygons[target].add(polygon)
+            self.polygons[polygon] = corners
+            self.modified.add(polygon)
+            if len(set(self.vertices(polygon))) < 3:
+                for other in set(self.vertices(polygon)):
+                    self.vertex_polygons[other].discard(polygon)
+                self.polygons[polygon] = None
+                self.polygon_count -= 1
+        self.vertex_polygons[vertex] = set()
+        self.quadrics[target] += self.quadrics[vertex]
+        self.error = max(self.error, math.sqrt(max(cost, 0.0)))
+
+    def run(self, polygon_target):
+        versions = [0] * len(self.vertex_polygons)
+        heap = []
+
+        def push_edges(vertex):
+            for other in self.neighbours(vertex):
+                for source, target in ((vertex, other), (other, vertex)):
+                    heapq.heappush(heap, (self.cost(source, target), source,
+                        target, versions[source], versions[target]))
+
+        for vertex in range(len(self.vertex_polygons)):
+            if self.vertex_polygons[vertex] and not self.fixed[vertex]:
+                for other in self.neighbours(vertex):
+                    heapq.heappush(heap, (self.cost(vertex, other), vertex,
+                        other, 0, 0))
+        while heap and self.polygon_count > polygon_target:
+            cost, vertex, target, vertex_version, target_version = (
+                heapq.heappop(heap))
+            if (versions[vertex] != vertex_version or
+                versions[target] != target_version or
+                not self.collapsible(vertex, target)):
+                continue
+            self.collapse(vertex, target, cost)
+            changed = {target} | set(self.neighbours(target))
+            versions[vertex] += 1
+            for other in changed:
+                versions[other] += 1
+            for other in changed:
+                push_edges(other)
+
+    def build(self, name):
+        mesh = self.mesh
+        kept = [polygon for polygon, corners in enumerate(self.polygons)
+            if corners is not None]
+        sizes = [len(self.polygons[polygon]) for polygon in kept]
+        corners = [corner for polygon in kept
+            for corner in self.polygons[polygon]]
+        normals = numpy.array(mesh.polygon_normals[kept], dtype=float)
+        for index, polygon in enumerate(kept):
+            if polygon in self.modified:
+                # The same normal Mesh.face_normal gives.
+                points = self.positions[self.vertices(polygon)[:3]]
+                normal = numpy.cross(points[1] - points[0], points[2] - points[0])
+                length = math.sqrt(normal @ normal)
+                if length:
+                    normals[index] = normal / length
+        return mesh.from_corners(name, kept, sizes, corners,
+            normals.reshape(-1, 3))
+
+def simplify(mesh, polygon_target, name=None):
+    """Collapse mesh's edges until at most polygon_target polygons are left.
+
+    Stops early if no collapse is left that keeps the mesh intact. Returns the
+    simplified mesh, named name (the mesh's own name by default), and the
+    largest error of any collapse made, as a distance in model units.
+    """
+    simplifier = _Simplifier(mesh)
+    simplifier.run(polygon_target)
+    return simplifier.build(name or mesh.name), simplifier.error
+
+def switch_distance(error, pixels=1.0):
+    """Find the distance beyond which error (in model units) spans less than
+    pixels on screen."""
+    return error * SCREEN_HEIGHT / (2 * math.tan(FIELD_OF_VIEW / 2) * pixels)
+
+def lod_chain(mesh, fractions):
+    """Build a chain of simplified meshes, at each fraction of mesh's polygons.
+
+    Each level is simplified from the one before it and named after the mesh
+    with its level number, counting mesh itself as level 0; a long mesh name
+    is shortened so the level number still fits (see model.names). Levels that can't
+    be simplified below the polygon count of the level before are left out.
+    Returns (mesh, switch distance) pairs, starting with mesh itself at 0.
+    """
+    levels = [(mesh, 0.0)]
+    previous = mesh
+    distance = 0.0
+    for fraction in fractions:
+        target = max(1, int(round(mesh.polygon_count() * fraction)))
+        name, origin = derived_name(mesh, ".lod%d" % len(levels))
+        level, error = simplify(previous, target, name)
+        level.name_origin = origin
+        if level.polygon_count() >= previous.polygon_count():
+            break
+        # Errors are measured against the level before, so they add up.
+        distance += switch_distance(error)
+        levels.append((level, distance))
+        previous = level
+    return levels
@@ -0,0 +1,210 @@
+"""Joins runs of polygons into triangle and quadrilateral strips.
+
+Polygons are matched up by their corners rather than by their vertex indices
+alone. A corner is the vertex index together with everything sent alongside
+it (texture coordinate, normal and shading mode), so two polygons only share
+an edge when both ends of that edge could be sent to the hardware once and be
+correct for both polygons.
+
+Strips keep the winding of every polygon in them intact, following the
+hardware's vertex order for strips:
+
+   triangle strips:       (v0 v1 v2) (v2 v1 v3) (v2 v3 v4) ...
+   quadrilateral strips:  (v0 v1 v3 v2) (v2 v3 v5 v4) ...
+
+http://problemkaputt.de/gbatek.htm#ds3dpolygondefinitionsbyvertices
+"""
+
+import heapq
+from collections import defaultdict
+
+MODES = ("greedy", "optimal")
+
+def corner_key(face, corner):
+    """Identify everything the hardware is sent for one corner of face."""
+    uv = tuple(face.uvlist[corner]) if face.uvlist else None
+    if face.smooth_shading:
+        normal = (tuple(face.vertex_normals[corner])
+            if face.vertex_normals else None)
+    else:
+        normal = tuple(face.face_normal)
+    return face.vertices[corner], uv, face.smooth_shading, normal
+
+class _Adjacency:
+    """Directed edge lookup for a list of polygons with the same size."""
+    def __init__(self, faces):
+        self.keys = [[corner_key(face, corner)
+            for corner in range(len(face.vertices))] for face in faces]
+        self.edges = defaultdict(list)
+        for face_id, keys in enumerate(self.keys):
+            for corner in range(len(keys)):
+                edge = keys[corner], keys[(corner + 1) % len(keys)]
+                self.edges[edge].append((face_id, corner))
+
+    def find(self, first, second, visited, used):
+        """Find a face in neither visited nor used with the edge first -> second.
+
+        Returns the face id and the corner the edge starts from.
+        """
+        for face_id, corner in self.edges.get((first, second), ()):
+            if face_id not in visited and face_id not in used:
+                return face_id, corner
+        return None
+
+    def neighbours(self, face_id, visited):
+        """Count the unvisited faces sharing an edge with face_id."""
+        keys = self.keys[face_id]
+        count = 0
+        for corner in range(len(keys)):
+            # Neighbours have the edge in the opposite direction.
+            edge = keys[(corner + 1) % len(keys)], keys[corner]
+            count += sum(1 for other, _ in self.edges.get(edge, ())
+                if other != face_id and other not in visited)
+        return count
+
+def _walk_triangles(adjacency, start, rotation, visited):
+    """Extend a triangle strip from start as far as it will go.
+
+    Returns the faces in the strip, and the corners to send to the hardware as
+    (face id, corner) pairs.
+    """
+    keys = adjacency.keys
+    faces = [start]
+    corners = [(start, (rotation + i) % 3) for i in range(3)]
+    strip = [keys[face_id][corner] for face_id, corner in corners]
+    used = {start}
+    while True:
+        # The next triangle is index t; odd triangles are wound backwards.
+        t = len(strip) - 2
+        edge = ((strip[t], strip[t + 1]) if t % 2 == 0 else
+            (strip[t + 1], strip[t]))
+        found = adjacency.find(edge[0], edge[1], visited, used)
+        if not found:
+            return faces, corners
+        face_id, corner = found
+        third = (corner + 2) % 3
+        faces.append(face_id)
+        corners.append((face_id, third))
+        strip.append(keys[face_id][third])
+        used.add(face_id)
+
+def _walk_quads(adjacency, start, rotation, visited):
+    """Extend a quadrilateral strip from start as far as it will go.
+
+    Returns the faces in the strip, and the corners to send to the hardware as
+    (face id, corner) pairs.
+    """
+    keys = adjacency.keys
+    faces = [start]
+    # A quad a b c d is sent as a b d c.
+    corners = [(start, (rotation + i) % 4) for i in (0, 1, 3, 2)]
+    strip = [keys[face_id][corner] for face_id, corner in corners]
+    used = {start}
+    while True:
+        found = adjacency.find(strip[-2], strip[-1], visited, used)
+        if not found:
+            return faces, corners
+        face_id, corner = found
+        # The face continues p q after the shared edge; p q are sent as q p.
+        p, q = (corner + 2) % 4, (corner + 3) % 4
+        faces.append(face_id)
+        corners.extend([(face_id, q), (face_id, p)])
+        strip.extend([keys[face_id][q], keys[face_id][p]])
+        used.add(face_id)
+
+def _reverse_triangles(adjacency, faces, corners, visited):
+    """Try to grow a triangle strip off of its starting end.
+
+    Sending a strip with an even number of triangles backwards keeps the
+    winding of every triangle, so the reversed strip can be walked forward
+    again.
+    """
+    if len(faces) % 2:
+        return faces, corners
+    used = set(faces)
+    keys = adjacency.keys
+    strip = [keys[face_id][corner] for face_id, corner in reversed(corners)]
+    corners = list(reversed(corners))
+    faces = list(reversed(faces))
+    while True:
+        t = len(strip) - 2
+        edge = ((strip[t], strip[t + 1]) if t % 2 == 0 else
+            (strip[t + 1], strip[t]))
+        found = adjacency.find(edge[0], edge[1], visited, used)
+        if not found:
+            return faces, corners
+        face_id, corner = found
+        third = (corner + 2) % 3
+        faces.append(face_id)
+        corners.append((face_id, third))
+        strip.append(keys[face_id][third])
+        used.add(face_id)
+
+def _best_strip(adjacency, start, points_per_face, visited, mode):
+    walk = _walk_triangles if points_per_face == 3 else _walk_quads
+    best = None
+    for rotation in range(points_per_face):
+        faces, corners = walk(adjacency, start, rotation, visited)
+        if mode == "optimal" and points_per_face == 3:
+            faces, corners = _reverse_triangles(adjacency, faces, corners,
+                visited)
+        if best is None or len(faces) > len(best[0]):
+            best = faces, corners
+    return best
+
+def _seeds_in_order(faces, adjacency, visited):
+    for face_id in range(len(faces)):
+        if face_id not in visited:
+            yield face_id
+
+def _seeds_by_fewest_neighbours(faces, adjacency, visited):
+    # Starting from the faces with the fewest free neighbours leaves fewer
+    # faces stranded on their own. Neighbour counts only ever drop, so stale
+    # heap entries are re-counted and pushed back when they come up.
+    heap = [(adjacency.neighbours(face_id, visited), face_id)
+        for face_id in range(len(faces))]
+    heapq.heapify(heap)
+    while heap:
+        count, face_id = heapq.heappop(heap)
+        if face_id in visited:
+            continue
+        current = adjacency.neighbours(face_id, visited)
+        if current < count:
+            heapq.heappush(heap, (current, face_id))
+            continue
+        yield face_id
+
+def stripify(faces, points_per_face, mode="greedy"):
+    """Group faces of the same size into strips.
+
+    greedy walks the faces in order, starting a strip from each face not yet
+    used and keeping the longest of the walks from each of its corners.
+    optimal starts each strip from the face with the fewest unused neighbours
+    and also grows triangle strips backwards, which is slower but leaves fewer
+    short strips.
+
+    Returns a list of strips and a list of leftover faces. Each strip is a list
+    of (face, corner) pairs in the order they must be sent to the hardware.
+    """
+    assert points_per_face in (3, 4), \
+        "invalid number of points in polygon: %d" % points_per_face
+    assert mode in MODES, "unknown strip mode: %s" % mode
+    faces = list(faces)
+    adjacency = _Adjacency(faces)
+    seeds = (_seeds_by_fewest_neighbours if mode == "optimal" else
+        _seeds_in_order)
+    visited = set()
+    strips = []
+    singles = []
+    for start in seeds(faces, adjacency, visited):
+        if start in visited:
+            continue
+        strip_faces, corners = _best_strip(adjacency, start, points_per_face,
+            visited, mode)
+        visited.update(strip_faces)
+        if len(strip_faces) > 1:
+            strips.append([(faces[face_id], corner)
+                for face_id, corner in corners])
+        else:
+            singles.append(faces[start])
+    return strips, singles
@@ -0,0 +1,85 @@
+"""Delta encoding for vertex and normal animation.
+
+Vertex animation patches VTX_10 and NORMAL parameter words, each of which
+holds three signed 10 bit components. Between one frame and the next most of
+them move a little or not at all, so rather than storing every word for every
+frame, the first frame is stored in full and each later frame as the changes
+from the frame before it:
+
+   a bit mask with one bit per channel, set if the channel changed, padded to
+   whole words
+   for each changed channel, in order, a record of three signed deltas, one
+   per component, of delta_bits each
+
+A record whose first delta is the most negative delta_bits value is an
+escape, for changes too large to fit: the channel's full word follows in the
+next 32 bits. Records are packed least significant bit first into little
+endian words, and each frame starts on a new word.
+
+Decoding keeps the current word of every channel and applies each frame's
+changes to it in turn, so the result can be patched through the existing AREF
+offsets exactly like ANIM data.
+"""
+
+import numpy
+
+COMPONENT_BITS = 10
+COMPONENTS = 3
+
+def unpack_components(words):
+    """Split parameter words into an array of their signed 10 bit components."""
+    words = numpy.asarray(words, dtype=numpy.int64)
+    shifts = numpy.arange(COMPONENTS) * COMPONENT_BITS
+    components = (words[..., None] >> shifts) & ((1 << COMPONENT_BITS) - 1)
+    return components - ((components >> (COMPONENT_BITS - 1)) <<
+        COMPONENT_BITS)
+
+class _BitWriter:
+    def __init__(self):
+        self.words = []
+        self.current = 0
+        self.bit_count = 0
+
+    def write(self, value, bits):
+        value &= (1 << bits) - 1
+        self.current |= value << self.bit_count
+        self.bit_count += bits
+        while self.bit_count >= 32:
+            self.words.append(self.current & 0xFFFFFFFF)
+            self.current >>= 32
+            self.bit_count -= 32
+
+    def align(self):
+        if self.bit_count:
+            self.words.append(self.current)
+            self.current = 0
+            self.bit_count = 0
+
+def encode_frames(words, delta_bits):
+    """Delta encode a (frames, channels) array of parameter words.
+
+    Returns the word offset of each frame after the first within the encoded
+    stream, and the stream itself as a list of words.
+    """
+    words = numpy.asarray(words, dtype=numpy.int64)
+    components = unpack_components(words)
+    escape = 1 << (delta_bits - 1)
+    writer = _BitWriter()
+    offsets = []
+    for frame in range(1, len(words)):
+        offsets.append(len(writer.words))
+        deltas = components[frame] - components[frame - 1]
+        changed = words[frame] != words[frame - 1]
+        for channel in range(len(changed)):
+            writer.write(int(changed[channel]), 1)
+        writer.align()
+        for channel in numpy.flatnonzero(changed):
+            if numpy.abs(deltas[channel]).max() < escape:
+                for delta in deltas[channel]:
+                    writer.write(int(delta), delta_bits)
+            else:
+                writer.write(escape, delta_bits)
+                writer.write(0, delta_bits * (COMPONENTS - 1))
+                writer.write(int(words[frame, channel]), 32)
+        writer.align()
+    return offsets, writer.words
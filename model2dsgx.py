@@ -7,6 +7,8 @@ Created on Thu Oct 21 00:31:54 2010
 @author: Nicholas Flynt, Cristián Romo
 
 Usage:
+    model2dsgx.py cache (info | clear) [options]
+    model2dsgx.py batch [options] [--manifest=<file>] [--output-dir=<dir>] [<inputs>...]
     model2dsgx.py [options] <input_filename>
     model2dsgx.py [options] <input_filename> <output_filename>
 
@@ -16,6 +18,54 @@ Options:
     --debug         Display debugging info
     --quiet         Silence all but Warnings and Errors
     --vtx10         Output 10-bit vertex coordinates (default is 16-bit)
+    --strips=<mode>  Join polygons into strips: none, greedy (fast) or
+                     optimal (slower, fewer strips) [default: none]
+    --packed        Pack up to four commands into each command word
+    --compact-vtx   Send each vertex with the smallest command that keeps its
+                    full 16-bit position (VTX_XY/XZ/YZ/DIFF)
+    --optimize      Remove commands that set state to its current value
+    --merge-quads   Merge pairs of triangles that make flat, convex quads
+                    with matching UVs and normals into single quads
+    --cluster-polys=<n>  Split meshes of more than n polygons into clusters
+                         the engine can cull separately
+    --cone-angle=<degrees>  Group faces into clusters whose normals lie within
+                            this angle of the cluster's axis, so the engine
+                            can skip clusters facing away; smaller angles
+                            give tighter cones but more clusters
+    --lod=<fractions>  Add simplified levels of detail of each mesh, with these
+                       fractions of its polygons, e.g. 0.5,0.25,0.125
+    --max-polys=<n>  Check that no mesh can send more than n polygons in a
+                     frame; the hardware holds at most 2048
+    --max-verts=<n>  Check that no mesh can send more than n vertices in a
+                     frame; the hardware holds at most 6144
+    --over-budget=<action>  What to do with meshes over budget: fail, or
+                            split them into clusters that fit [default: fail]
+    --bone-bounds   Add a bounding sphere for each bone's vertices over all
+                    of its animation poses
+    --anim-tolerance=<t>  Store animations as keyframes, dropping frames that
+                          linear interpolation recovers to within t (in model
+                          units and matrix elements); 0 drops only exact ones
+    --jobs=<n>      Convert up to n meshes (or, in batch mode, files) at once
+                    in separate processes, and sample up to n FBX animations
+                    at once [default: 1]
+    --sidecar       Keep a binary copy of each imported model next to its
+                    source file, and load that instead of importing again
+                    while the source is unchanged
+    --cache         Reuse earlier conversions of unchanged files and meshes
+    --cache-dir=<dir>  Keep the cache in dir instead of
+                       ~/.cache/dsgx-converter; implies --cache
+    --cache-size=<mb>  Evict the least recently used cache entries beyond
+                       this size in megabytes [default: 512]
+
+Batch mode converts every input in one run. Inputs may be file names or glob
+patterns, and may also be listed one per line in a manifest file; relative
+paths in a manifest are relative to the manifest. A file that fails to convert
+is reported and skipped without stopping the rest.
+
+Batch options:
+    --manifest=<file>   Read more inputs from file
+    --output-dir=<dir>  Write the .dsgx files to dir instead of next to each
+                        input
 
 """
 from docopt import docopt
@@ -23,20 +73,89 @@ import logging
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger()
 
-import os, sys
-from model import dsgx, fbx_importer, obj_importer, assimp_importer
+import glob, importlib, os, sys, time, traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from model import VERSION, cache, dsgx, sidecar, stripify
 
 
 def main(args):
-    arguments = docopt(__doc__, version="0.1a")
+    arguments = docopt(__doc__, version=VERSION)
     adjust_logging_level(arguments)
 
+    if arguments["cache"]:
+        manage_cache(open_cache(arguments, always=True), arguments)
+        return
+
+    if arguments["--strips"] not in ("none",) + stripify.MODES:
+        error_exit(1, "Unknown strip mode: %s" % arguments["--strips"])
+    if not arguments["--jobs"].isdigit() or int(arguments["--jobs"]) < 1:
+        error_exit(1, "Invalid number of jobs: %s" % arguments["--jobs"])
+    if arguments["--cluster-polys"] is not None and (
+        not arguments["--cluster-polys"].isdigit() or
+        int(arguments["--cluster-polys"]) < 1):
+        error_exit(1, "Invalid cluster size: %s" % arguments["--cluster-polys"])
+    for option, name in (("--max-polys", "polygon"),
+        ("--max-verts", "vertex")):
+        if arguments[option] is not None and (
+            not arguments[option].isdigit() or int(arguments[option]) < 1):
+            error_exit(1, "Invalid %s budget: %s" % (name, arguments[option]))
+    if arguments["--lod"] is not None:
+        try:
+            fractions = lod_fractions(arguments["--lod"])
+            if not all(0 < fraction < 1 for fraction in fractions) or any(
+                later >= earlier for earlier, later in zip(fractions,
+                    fractions[1:])):
+                raise ValueError
+        except ValueError:
+            error_exit(1, "Invalid level of detail fractions: %s" %
+                arguments["--lod"])
+    if arguments["--over-budget"] not in ("fail", "split"):
+        error_exit(1, "Unknown over budget action: %s" %
+            arguments["--over-budget"])
+    if arguments["--cone-angle"] is not None:
+        try:
+            if not 0 < float(arguments["--cone-angle"]) <= 180:
+                raise ValueError
+        except ValueError:
+            error_exit(1, "Invalid cone angle: %s" % arguments["--cone-angle"])
+    if arguments["--anim-tolerance"] is not None:
+        try:
+            if float(arguments["--anim-tolerance"]) < 0:
+                raise ValueError
+        except ValueError:
+            error_exit(1, "Invalid animation tolerance: %s" %
+                arguments["--anim-tolerance"])
+
+    if arguments["batch"]:
+        convert_batch(arguments)
+        return
+
     input_filename = arguments["<input_filename>"]
     output_filename = determine_output_filename(input_filename, arguments)
 
-    model_to_convert = load_model(input_filename)
+    conversion_cache = open_cache(arguments)
+    options = conversion_options(arguments)
+    if conversion_cache:
+        if write_cached_conversion(conversion_cache, input_filename,
+            output_filename, options):
+            log.info("%s is unchanged, used the cached conversion",
+                input_filename)
+            return
+    try:
+        model_to_convert = load_model(input_filename, arguments["--sidecar"],
+            int(arguments["--jobs"]))
+    except ImporterUnavailable as error:
+        error_exit(1, str(error))
     display_model_info(model_to_convert)
-    save_model_as_dsgx(model_to_convert, output_filename, arguments)
+    try:
+        save_model_as_dsgx(model_to_convert, output_filename, options,
+            int(arguments["--jobs"]), conversion_cache, input_filename)
+    except (dsgx.BudgetExceeded, dsgx.NameClash) as error:
+        error_exit(1, str(error))
+    if conversion_cache:
+        conversion_cache.evict()
 
 def adjust_logging_level(arguments):
     if arguments["--debug"]:
@@ -47,7 +166,7 @@ def adjust_logging_level(arguments):
         log.setLevel(logging.INFO)
 
 def determine_output_filename(input_filename, args):
-    if "<output_filename>" in args:
+    if args["<output_filename>"]:
         return args["<output_filename>"]
     return substitute_extension(input_filename, ".dsgx")
 
@@ -63,43 +182,246 @@ def known_file_type(filename):
     return file_extension(filename) in _readers
 
 def file_extension(filename):
-    return os.path.splitext(filename)[1]
+    return os.path.splitext(filename)[1].lower()
 
-def load_model(filename):
+def load_model(filename, use_sidecar=False, jobs=1):
+    if use_sidecar:
+        model = sidecar.read(sidecar.sidecar_filename(filename))
+        if model:
+            log.debug("Loaded %s from its sidecar", filename)
+            return model
     if known_file_type(filename):
-        return _readers[file_extension(filename)](filename)
+        model = _readers[file_extension(filename)](filename, jobs)
     else:
-        return read_using_assimp(filename)
+        model = read_using_assimp(filename, jobs)
+    if use_sidecar and model:
+        try:
+            sidecar.write(sidecar.sidecar_filename(filename), model, filename)
+        except (OSError, TypeError, ValueError) as error:
+            log.warning("Could not write a sidecar for %s: %s", filename, error)
+    return model
 
 def display_model_info(model):
-    log.info("Polygons: %d" % len(model.polygons))
-    log.info("Vertecies: %d" % len(model.vertecies))
+    for mesh in model.meshes.values():
+        log.info("Mesh: %s" % mesh.name)
+        log.info("Polygons: %d" % mesh.polygon_count())
+        log.info("Vertecies: %d" % mesh.vertex_count())
+
+        textured_polygons = int((mesh.polygon_flags & mesh.HAS_UVS != 0).sum())
+        log.info("Textured Polygons: %d" % textured_polygons)
 
-    textured_polygons = sum(1 for polygon in model.polygons if polygon.uvlist)
-    log.info("Textured Polygons: %d" % textured_polygons)
+        log.info("Bounding Sphere: %s" % str(mesh.bounding_sphere()))
+        log.info("Bounding Box: %s" % str(mesh.bounding_box()))
 
-    log.info("Bounding Sphere: %s" % str(model.bounding_sphere()))
-    log.info("Bounding Box: %s" % str(model.bounding_box()))
+        log.info("Worst-case Draw Cost (polygons): %d" % mesh.max_cull_polys())
 
-    log.info("Worst-case Draw Cost (polygons): %d" % model.max_cull_polys())
+def conversion_options(arguments):
+    strip_mode = arguments["--strips"] if arguments["--strips"] != "none" else None
+    anim_tolerance = arguments["--anim-tolerance"]
+    return dict(vtx10=arguments["--vtx10"], animation_mode="bone",
+        strip_mode=strip_mode, packed=arguments["--packed"],
+        compact_vtx=arguments["--compact-vtx"],
+        optimize=arguments["--optimize"],
+        merge_quads=arguments["--merge-quads"],
+        bone_bounds=arguments["--bone-bounds"],
+        cone_angle=float(arguments["--cone-angle"])
+            if arguments["--cone-angle"] is not None else None,
+        cluster_polygons=int(arguments["--cluster-polys"])
+            if arguments["--cluster-polys"] is not None else None,
+        max_polygons=int(arguments["--max-polys"])
+            if arguments["--max-polys"] is not None else None,
+        max_vertices=int(arguments["--max-verts"])
+            if arguments["--max-verts"] is not None else None,
+        split_over_budget=arguments["--over-budget"] == "split",
+        lod_levels=lod_fractions(arguments["--lod"])
+            if arguments["--lod"] is not None else None,
+        anim_tolerance=float(anim_tolerance) if anim_tolerance is not None
+            else None)
 
-def save_model_as_dsgx(model, filename, arguments):
+def lod_fractions(text):
+    return tuple(float(fraction) for fraction in text.split(","))
+
+def save_model_as_dsgx(model, filename, options, jobs=1, conversion_cache=None,
+    input_filename=None):
     log.debug("Attempting output...")
-    dsgx.Writer().write(filename, model, arguments["--vtx10"])
+    if conversion_cache:
+        data = b"".join(dsgx.generate(model, jobs=jobs, cache=conversion_cache,
+            **options))
+        conversion_cache.store_conversion(input_filename, options,
+            model.dependencies, data)
+        with open(filename, "wb") as fp:
+            fp.write(data)
+    else:
+        dsgx.Writer().write(filename, model, jobs=jobs, **options)
     log.debug("Output Successful!")
 
-def read_autodesk_fbx(filename):
+def open_cache(arguments, always=False):
+    if not (always or arguments["--cache"] or arguments["--cache-dir"]):
+        return None
+    return cache.Cache(arguments["--cache-dir"],
+        int(arguments["--cache-size"]) * 1024 * 1024)
+
+def write_cached_conversion(conversion_cache, input_filename, output_filename,
+    options):
+    data = conversion_cache.load_conversion(input_filename, options)
+    if data is None:
+        return False
+    with open(output_filename, "wb") as fp:
+        fp.write(data)
+    return True
+
+def manage_cache(conversion_cache, arguments):
+    if arguments["clear"]:
+        conversion_cache.clear()
+        print("Cleared %s" % conversion_cache.directory)
+    else:
+        count, size = conversion_cache.info()
+        print("%s: %d entries, %.1f MB of %.1f MB" % (conversion_cache.directory,
+            count, size / (1024 * 1024), conversion_cache.max_size / (1024 * 1024)))
+
+def batch_inputs(arguments):
+    inputs = []
+    patterns = list(arguments["<inputs>"])
+    if arguments["--manifest"]:
+        manifest_directory = os.path.dirname(arguments["--manifest"])
+        with open(arguments["--manifest"]) as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(os.path.join(manifest_directory, line))
+    for pattern in patterns:
+        # Patterns that match nothing are kept, so they are reported as
+        # missing files rather than silently dropped.
+        inputs.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern)
+            else [pattern])
+    return inputs
+
+def batch_output_filename(input_filename, output_directory):
+    output_filename = substitute_extension(input_filename, ".dsgx")
+    if output_directory:
+        return os.path.join(output_directory, os.path.basename(output_filename))
+    return output_filename
+
+def convert_file(input_filename, output_filename, options,
+    conversion_cache=None, use_sidecar=False):
+    """Convert one file, returning the time taken and any error."""
+    start = time.perf_counter()
+    try:
+        if not (conversion_cache and write_cached_conversion(conversion_cache,
+            input_filename, output_filename, options)):
+            model = load_model(input_filename, use_sidecar)
+            save_model_as_dsgx(model, output_filename, options,
+                conversion_cache=conversion_cache,
+                input_filename=input_filename)
+        error = None
+    except Exception as exception:
+        log.debug(traceback.format_exc())
+        error = "%s: %s" % (type(exception).__name__, exception)
+    return time.perf_counter() - start, error
+
+def convert_in_processes(work, jobs):
+    """Run convert_file over work in jobs worker processes.
+
+    Errors are caught in the workers, but a worker can still die outright,
+    for instance if an importer's native library crashes, which breaks the
+    whole pool. The files that were still in flight are then converted again
+    one at a time, each in a fresh process, so only the file that kills its
+    process is reported as failed. Returns the results in the order of work.
+    """
+    results = [None] * len(work)
+    broken = []
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {executor.submit(convert_file, *item): index
+            for index, item in enumerate(work)}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+    for index in sorted(broken):
+        start = time.perf_counter()
+        with ProcessPoolExecutor(1) as executor:
+            try:
+                results[index] = executor.submit(convert_file,
+                    *work[index]).result()
+            except BrokenProcessPool:
+                results[index] = (time.perf_counter() - start,
+                    "the converter process died")
+    return results
+
+def convert_batch(arguments):
+    inputs = batch_inputs(arguments)
+    if not inputs:
+        error_exit(1, "No input files given")
+    output_directory = arguments["--output-dir"]
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+    outputs = [batch_output_filename(input_filename, output_directory)
+        for input_filename in inputs]
+    clashes = [output_filename for output_filename, count
+        in Counter(os.path.abspath(output) for output in outputs).items()
+        if count > 1]
+    if clashes:
+        error_exit(1, "Several inputs would be written to the same file: %s" %
+            ", ".join(sorted(clashes)))
+    conversion_cache = open_cache(arguments)
+    work = [(input_filename, output_filename, conversion_options(arguments),
+        conversion_cache, arguments["--sidecar"])
+        for input_filename, output_filename in zip(inputs, outputs)]
+    jobs = int(arguments["--jobs"])
+
+    start = time.perf_counter()
+    if jobs > 1 and len(inputs) > 1:
+        results = convert_in_processes(work, min(jobs, len(inputs)))
+    else:
+        results = [convert_file(*item) for item in work]
+    elapsed = time.perf_counter() - start
+    if conversion_cache:
+        conversion_cache.evict()
+
+    failures = 0
+    for input_filename, output_filename, (seconds, error) in zip(inputs,
+        outputs, results):
+        if error:
+            failures += 1
+            print("FAILED %8.2fs  %s: %s" % (seconds, input_filename, error))
+        else:
+            print("ok     %8.2fs  %s -> %s" % (seconds, input_filename,
+                output_filename))
+    print("%d converted, %d failed in %.2fs" % (len(inputs) - failures,
+        failures, elapsed))
+    if failures:
+        error_exit(1)
+
+class ImporterUnavailable(Exception):
+    pass
+
+def load_importer(module_name, requirements):
+    """Import one of the model importers on first use.
+
+    Importers pull in their own, often large or proprietary, libraries, so
+    they are only loaded once a file needs them. requirements names what the
+    importer needs, for the error raised when it can't be loaded.
+    """
+    try:
+        return importlib.import_module("model." + module_name)
+    except ImportError as error:
+        raise ImporterUnavailable("%s could not be loaded (%s). It needs %s." %
+            (module_name, error, requirements)) from error
+
+def read_autodesk_fbx(filename, jobs=1):
     log.debug("--Parsing FBX file--")
-    model = fbx_importer.Reader().read(filename)
-    return model
+    fbx_importer = load_importer("fbx_importer",
+        "the FBX Python SDK (FbxCommon) and Pillow")
+    return fbx_importer.Reader(jobs).read(filename)
 
-def read_wavefront_obj(filename):
+def read_wavefront_obj(filename, jobs=1):
     log.debug("---Parsing OBJ file---")
-    return obj_importer.Reader().read(filename)
+    return load_importer("obj_importer", "euclid3").Reader().read(filename)
 
-def read_using_assimp(filename):
+def read_using_assimp(filename, jobs=1):
     log.debug("---Falling back to ASSIMP---")
-    return assimp_importer.Reader().read(filename)
+    return load_importer("assimp_importer", "pyassimp").Reader().read(filename)
 
 _readers = {
     ".fbx": read_autodesk_fbx,
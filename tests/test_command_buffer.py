@@ -0,0 +1,98 @@
+import pytest
+
+import model.geometry_command as gc
+from model.command_buffer import CommandBuffer
+
+# Parameter words taken by each command used below.
+PARAMETER_COUNTS = {0x11: 0, 0x12: 1, 0x21: 1, 0x22: 1, 0x23: 2, 0x40: 1}
+
+def decode(words, packed):
+    """Read a call list back into (instruction, parameters) pairs.
+
+    Also returns the positions of the dummy words following command words that
+    end in a command without parameters.
+    """
+    commands = []
+    dummies = []
+    position = 0
+    while position < len(words):
+        command_word = int(words[position])
+        position += 1
+        slots = range(4) if packed else range(1)
+        instructions = [(command_word >> (8 * slot)) & 0xFF for slot in slots]
+        # Unused slots are left as zero, and only ever follow used ones.
+        used = [instruction for instruction in instructions if instruction]
+        assert instructions[:len(used)] == used
+        for instruction in used:
+            count = PARAMETER_COUNTS[instruction]
+            commands.append((instruction,
+                [int(word) for word in words[position:position + count]]))
+            position += count
+        if packed and PARAMETER_COUNTS[used[-1]] == 0:
+            assert words[position] == 0
+            dummies.append(position)
+            position += 1
+    assert position == len(words)
+    return commands, dummies
+
+def build(commands, breaks=()):
+    buffer = CommandBuffer()
+    for index, command in enumerate(commands):
+        if index in breaks:
+            buffer.add_break()
+        buffer.append(command)
+    return buffer
+
+def strip_commands():
+    return [gc.begin_vtxs(gc.PrimitiveType.TRIANGLE_STRIPS),
+        gc.normal(0.0, 1.0, 0.0), gc.texcoord(0.5, 0.25),
+        gc.vtx_16(0.5, -0.25, 1.0), gc.vtx_16(1.0, 0.0, -1.0), gc.push(),
+        gc.pop(), gc.vtx_16(0.0, 0.0, 0.0), gc.push()]
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_layout_keeps_commands_in_order(packed):
+    commands = strip_commands()
+    words, _ = build(commands).layout(packed)
+    decoded, _ = decode(words, packed)
+    assert decoded == [(instruction, list(params))
+        for instruction, params, _ in commands]
+
+def test_unpacked_layout_has_one_command_per_word():
+    buffer = build(strip_commands())
+    words, _ = buffer.layout(packed=False)
+    assert len(words) == buffer.word_count()
+    assert decode(words, False)[1] == []
+
+def test_packed_layout_moves_trailing_parameterless_commands():
+    commands = [gc.push(), gc.pop(), gc.push(), gc.push(), gc.pop()]
+    words, positions = build(commands).layout(True)
+    # Ending the first word with the two PUSHes would need a dummy, so they
+    # go on to the next word, ahead of the POP.
+    assert words.tolist() == [0x1211, 1, 0x121111, 1]
+    assert positions.tolist() == [1, 1, 3, 3, 3]
+
+def test_packed_layout_pads_a_final_parameterless_command():
+    words, positions = build([gc.push(), gc.pop(), gc.push()]).layout(True)
+    assert words.tolist() == [0x111211, 1, 0]
+    assert positions.tolist() == [1, 1, 2]
+
+def test_packed_layout_fills_words_before_dummies():
+    words, _ = build(strip_commands()).layout(True)
+    # BEGIN_VTXS, NORMAL, TEXCOORD and VTX_16 share the first word, lowest
+    # byte first; the PUSH in the middle of the second needs no dummy.
+    assert words[0] == 0x23222140
+    assert words[6] == 0x23121123
+    _, dummies = decode(words, True)
+    assert dummies == [len(words) - 1]
+
+def test_packed_layout_starts_a_word_at_each_break():
+    commands = strip_commands()
+    words, positions = build(commands, breaks={3}).layout(True)
+    decoded, dummies = decode(words, True)
+    assert [instruction for instruction, _ in decoded] == [
+        instruction for instruction, _, _ in commands]
+    # The break ends the first word after three commands, and the VTX_16
+    # after it opens the next word.
+    assert words[0] == 0x222140
+    assert words[positions[3] - 1] == 0x12112323
+    assert dummies == [len(words) - 1]
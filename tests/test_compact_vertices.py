@@ -0,0 +1,99 @@
+import random
+
+import pytest
+
+import model.geometry_command as gc
+from model.command_buffer import CommandBuffer
+from model.dsgx import compact_vertex, compact_vertices
+
+def signed(value, bits):
+    return value - (1 << bits) if value >> (bits - 1) & 1 else value
+
+def apply(command, previous):
+    """Work out the 16 bit position the hardware holds after a vertex command,
+    given the one it held before."""
+    instruction, words, _ = command
+    if instruction == 0x23:
+        return words[0] & 0xFFFF, words[0] >> 16, words[1] & 0xFFFF
+    x, y, z = previous
+    if instruction == 0x25:
+        return words[0] & 0xFFFF, words[0] >> 16, z
+    if instruction == 0x26:
+        return words[0] & 0xFFFF, y, words[0] >> 16
+    if instruction == 0x27:
+        return x, words[0] & 0xFFFF, words[0] >> 16
+    assert instruction == 0x28
+    assert words[0] >> 30 == 0
+    deltas = [signed(words[0] >> shift & 0x3FF, 10) for shift in (0, 10, 20)]
+    return tuple((old + delta) & 0xFFFF
+        for old, delta in zip(previous, deltas))
+
+def sixteen_bit(x, y, z):
+    return apply(gc.vtx_16(x, y, z), None)
+
+@pytest.mark.parametrize("axes, instruction", [((0, 1), 0x25),
+    ((0, 2), 0x26), ((1, 2), 0x27)])
+def test_two_coordinate_commands_quantize_like_vtx_16(axes, instruction):
+    generate = {0x25: gc.vtx_xy, 0x26: gc.vtx_xz, 0x27: gc.vtx_yz}[instruction]
+    values = [0.0, 1.0, -1.0, 0.5, -0.25, 7.999755859375, -8.0, 1 / 3,
+        -2 / 3, 3.14159, -0.000123]
+    for first in values:
+        for second in values:
+            position = [0.75, -0.75, 0.75]
+            position[axes[0]], position[axes[1]] = first, second
+            command = generate(first, second)
+            assert command[0] == instruction
+            assert len(command[1]) == 1
+            # The coordinate left out comes from the previous vertex.
+            previous = sixteen_bit(0.75, -0.75, 0.75)
+            assert apply(command, previous) == sixteen_bit(*position)
+
+def test_vtx_diff_packs_signed_ten_bit_offsets():
+    for deltas in [(0, 0, 0), (511, -512, 1), (-1, -1, -1), (-512, 511, 0),
+        (3, -200, 77)]:
+        command = gc.vtx_diff(*(delta / 4096 for delta in deltas))
+        assert command[0] == 0x28
+        assert apply(command, (0x100, 0xFF00, 0)) == tuple(
+            (old + delta) & 0xFFFF for old, delta in zip((0x100, 0xFF00, 0),
+            deltas))
+
+def test_compact_vertex_reproduces_every_position_exactly():
+    rng = random.Random(4)
+    coordinate = lambda: rng.randrange(0x10000)
+    near = lambda value: (value + rng.randint(-600, 600)) & 0xFFFF
+    for _ in range(2000):
+        previous = coordinate(), coordinate(), coordinate()
+        position = [near(value) for value in previous]
+        # Keep one coordinate half the time, so every command turns up.
+        if rng.random() < 0.5:
+            axis = rng.randrange(3)
+            position[axis] = previous[axis]
+        position = tuple(position)
+        command = compact_vertex(position, previous)
+        deltas = [signed(new, 16) - signed(old, 16)
+            for new, old in zip(position, previous)]
+        if command is None:
+            assert not any(new == old for new, old in zip(position, previous))
+            assert any(not -512 <= delta <= 511 for delta in deltas)
+            continue
+        assert len(command[1]) == 1
+        assert apply(command, previous) == position
+
+def test_compact_vertices_restarts_at_each_polygon_list():
+    points = [(0.5, 0.25, -1.0), (0.5, 0.75, -1.0), (0.5, 0.75, 2.0),
+        (0.5625, 0.7, 2.03), (-3.0, 4.0, 5.0)]
+    commands = CommandBuffer()
+    for _ in range(2):
+        commands.append(gc.begin_vtxs(gc.PrimitiveType.TRIANGLE_STRIPS))
+        commands.extend([gc.vtx_16(*point) for point in points])
+    compacted = compact_vertices(commands)
+    assert list(compacted.instructions) == [0x40, 0x23, 0x25, 0x26, 0x28,
+        0x23] * 2
+    position = None
+    for index, instruction in enumerate(compacted.instructions):
+        if instruction == 0x40:
+            expected = iter(points)
+            continue
+        position = apply((instruction, compacted.parameters(index), None),
+            position)
+        assert position == sixteen_bit(*next(expected))
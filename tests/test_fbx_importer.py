@@ -0,0 +1,56 @@
+import numpy
+import pytest
+
+fbx = pytest.importorskip("fbx")
+FbxCommon = pytest.importorskip("FbxCommon")
+
+from model import fbx_importer
+
+INHERIT_TYPES = [fbx.FbxTransform.eInheritRSrs, fbx.FbxTransform.eInheritRrSs,
+    fbx.FbxTransform.eInheritRrs, fbx.FbxTransform.eInheritRSrs]
+
+def frame_time(frame):
+    time = fbx.FbxTime()
+    time.SetFrame(frame)
+    return time
+
+def build_chain(scene):
+    """Build a chain of nodes, one for each of INHERIT_TYPES, each scaled
+    unevenly and spinning, in an animation stack 10 frames long."""
+    stack = fbx.FbxAnimStack.Create(scene, "stack")
+    layer = fbx.FbxAnimLayer.Create(scene, "layer")
+    stack.AddMember(layer)
+    stack.LocalStop.Set(frame_time(10))
+    parent = scene.GetRootNode()
+    nodes = []
+    for index, inherit_type in enumerate(INHERIT_TYPES):
+        node = fbx.FbxNode.Create(scene, "node%d" % index)
+        node.SetTransformationInheritType(inherit_type)
+        node.LclTranslation.Set(fbx.FbxDouble3(index, 1.0, 0.0))
+        node.LclScaling.Set(fbx.FbxDouble3(1.0, 2.0, 0.5))
+        curve = node.LclRotation.GetCurve(layer, "Z", True)
+        curve.KeyModifyBegin()
+        for frame, angle in ((0, 15.0 * index), (10, 90.0 + 15.0 * index)):
+            key = curve.KeyAdd(frame_time(frame))[0]
+            curve.KeySetValue(key, angle)
+            curve.KeySetInterpolation(key,
+                fbx.FbxAnimCurveDef.eInterpolationLinear)
+        curve.KeyModifyEnd()
+        parent.AddChild(node)
+        nodes.append(node)
+        parent = node
+    scene.SetCurrentAnimationStack(stack)
+    return nodes
+
+def test_sampling_matches_global_evaluation():
+    manager, scene = FbxCommon.InitializeSdkObjects()
+    try:
+        nodes = build_chain(scene)
+        times = fbx_importer.sample_times(20)
+        sampled = fbx_importer.sample_global_transforms(nodes, times)
+        for node, transforms in zip(nodes, sampled):
+            expected = fbx_importer.fbx_to_arrays(
+                node.EvaluateGlobalTransform(time) for time in times)
+            numpy.testing.assert_allclose(transforms, expected, atol=1e-9)
+    finally:
+        manager.Destroy()
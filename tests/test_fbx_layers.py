@@ -0,0 +1,114 @@
+"""Checks the FBX importer's layer element lookups without the FBX SDK.
+
+corner_values only calls a few methods on the layer elements it is given, so
+these tests hand it stand-ins, and import the importer against a stand-in
+FbxCommon module that has just the mapping and reference mode constants.
+"""
+
+import importlib
+import sys
+import types
+
+import pytest
+
+# A triangle over control points 0, 1, 2 and a quad over 2, 1, 3, 4.
+CORNER_VERTICES = [0, 1, 2, 2, 1, 3, 4]
+CORNER_POLYGONS = [0, 0, 0, 1, 1, 1, 1]
+
+class FbxLayerElement:
+    eNone, eByControlPoint, eByPolygonVertex, eByPolygon, eByEdge, eAllSame = (
+        range(6))
+    eDirect, eIndex, eIndexToDirect = range(3)
+
+class LayerArray:
+    def __init__(self, values):
+        self.values = list(values)
+
+    def GetAt(self, index):
+        return self.values[index]
+
+    def GetCount(self):
+        return len(self.values)
+
+class LayerElement:
+    def __init__(self, mapping, reference, direct, index=None):
+        self.mapping = mapping
+        self.reference = reference
+        self.direct = LayerArray(direct)
+        self.index = LayerArray(index or [])
+
+    def GetMappingMode(self):
+        return self.mapping
+
+    def GetReferenceMode(self):
+        return self.reference
+
+    def GetDirectArray(self):
+        return self.direct
+
+    def GetIndexArray(self):
+        return self.index
+
+@pytest.fixture
+def fbx_importer(monkeypatch):
+    sdk = types.ModuleType("FbxCommon")
+    for name in ("InitializeSdkObjects", "LoadScene", "FbxNodeAttribute",
+        "FbxSurfacePhong", "FbxAnimStack", "FbxTime", "FbxAMatrix",
+        "FbxTexture", "FbxTransform"):
+        setattr(sdk, name, None)
+    sdk.FbxLayerElement = FbxLayerElement
+    monkeypatch.setitem(sys.modules, "FbxCommon", sdk)
+    monkeypatch.delitem(sys.modules, "model.fbx_importer", raising=False)
+    module = importlib.import_module("model.fbx_importer")
+    yield module
+    sys.modules.pop("model.fbx_importer", None)
+
+# The key each mapping mode looks values up by, for every corner.
+MAPPING_KEYS = {
+    FbxLayerElement.eByControlPoint: CORNER_VERTICES,
+    FbxLayerElement.eByPolygonVertex: list(range(len(CORNER_VERTICES))),
+    FbxLayerElement.eByPolygon: CORNER_POLYGONS,
+    FbxLayerElement.eAllSame: [0] * len(CORNER_VERTICES),
+}
+
+@pytest.mark.parametrize("mapping", sorted(MAPPING_KEYS))
+def test_direct_values(fbx_importer, mapping):
+    keys = MAPPING_KEYS[mapping]
+    direct = ["value %d" % key for key in range(max(keys) + 1)]
+    element = LayerElement(mapping, FbxLayerElement.eDirect, direct)
+    assert fbx_importer.corner_values(element, CORNER_VERTICES,
+        CORNER_POLYGONS) == [direct[key] for key in keys]
+
+@pytest.mark.parametrize("mapping", sorted(MAPPING_KEYS))
+def test_indexed_values(fbx_importer, mapping):
+    keys = MAPPING_KEYS[mapping]
+    # Every key points somewhere else in the direct array.
+    index = [(3 * key + 1) % 7 for key in range(max(keys) + 1)]
+    direct = [(float(value), -float(value)) for value in range(7)]
+    element = LayerElement(mapping, FbxLayerElement.eIndexToDirect, direct,
+        index)
+    values = fbx_importer.corner_values(element, CORNER_VERTICES,
+        CORNER_POLYGONS, convert=lambda pair: pair[0])
+    assert values == [float(index[key]) for key in keys]
+
+def test_material_indices(fbx_importer):
+    # Materials are looked up once per polygon, and the index itself is the
+    # material.
+    polygons = [0, 1, 2]
+    by_polygon = LayerElement(FbxLayerElement.eByPolygon,
+        FbxLayerElement.eIndexToDirect, ["unused"], [2, 0, 1])
+    assert fbx_importer.corner_values(by_polygon, polygons, polygons,
+        direct=False) == [2, 0, 1]
+    all_same = LayerElement(FbxLayerElement.eAllSame,
+        FbxLayerElement.eIndexToDirect, ["unused"], [3])
+    assert fbx_importer.corner_values(all_same, polygons, polygons,
+        direct=False) == [3, 3, 3]
+
+def test_missing_or_unsupported_elements(fbx_importer, caplog):
+    assert fbx_importer.corner_values(None, CORNER_VERTICES,
+        CORNER_POLYGONS) is None
+    by_edge = LayerElement(FbxLayerElement.eByEdge, FbxLayerElement.eDirect,
+        [1.0])
+    assert fbx_importer.corner_values(by_edge, CORNER_VERTICES,
+        CORNER_POLYGONS) is None
+    assert "Unsupported layer element mapping mode" in caplog.text
@@ -0,0 +1,38 @@
+import euclid3 as euclid
+
+import model.partition as partition
+from model.model import Model
+from model.names import MAX_LENGTH, find_clashes
+
+def strip_mesh(name, quads):
+    """Build a row of quads, named name."""
+    model = Model()
+    mesh = model.addMesh(name)
+    for index in range(quads + 1):
+        mesh.addVertex(euclid.Vector3(index, 0.0, 0.0))
+        mesh.addVertex(euclid.Vector3(index, 0.0, 1.0))
+    for index in range(quads):
+        a = 2 * index
+        mesh.addPolygon([a, a + 2, a + 3, a + 1], None, [(0.0, 1.0, 0.0)] * 4)
+    return mesh
+
+def test_clusters_keep_their_number_under_a_long_name():
+    mesh = strip_mesh("a_fairly_long_mesh_name_here_x", 16)
+    parts = partition.split_mesh(mesh, 4)
+    assert [part.name for part in parts] == [
+        "a_fairly_long_mesh_name_here_.%d" % index for index in range(4)]
+    # Splitting a cluster again shortens the mesh's name, not the cluster's
+    # number.
+    parts = [piece for part in parts
+        for piece in partition.split_mesh(part, 2)]
+    assert all(len(part.name) <= MAX_LENGTH for part in parts)
+    assert parts[-1].name == "a_fairly_long_mesh_name_her.3.1"
+    assert find_clashes(part.name for part in parts) == []
+
+def test_short_names_are_kept_whole():
+    parts = partition.split_mesh(strip_mesh("road", 4), 2)
+    assert [part.name for part in parts] == ["road.0", "road.1"]
+
+def test_find_clashes_compares_stored_names():
+    long = "x" * MAX_LENGTH
+    assert find_clashes(["a", "b", long + "1", long + "2"]) == [long]
@@ -0,0 +1,37 @@
+import euclid3 as euclid
+
+import model.simplify as simplify
+from model.model import Model
+from model.names import MAX_LENGTH
+
+SIZE = 8
+
+def grid_mesh(name):
+    """Build a flat SIZE by SIZE grid of triangle pairs, named name."""
+    model = Model()
+    mesh = model.addMesh(name)
+    for row in range(SIZE + 1):
+        for column in range(SIZE + 1):
+            mesh.addVertex(euclid.Vector3(column, 0.0, row))
+    for row in range(SIZE):
+        for column in range(SIZE):
+            a = row * (SIZE + 1) + column
+            b, c, d = a + 1, a + SIZE + 2, a + SIZE + 1
+            mesh.addPolygon([a, c, b], None, [(0.0, 1.0, 0.0)] * 3)
+            mesh.addPolygon([a, d, c], None, [(0.0, 1.0, 0.0)] * 3)
+    return mesh
+
+def test_levels_keep_their_number_under_a_long_name():
+    levels = simplify.lod_chain(grid_mesh("a_fairly_long_mesh_name_here_x"),
+        (0.5, 0.25))
+    names = [level.name for level, _ in levels]
+    assert names == ["a_fairly_long_mesh_name_here_x",
+        "a_fairly_long_mesh_name_he.lod1", "a_fairly_long_mesh_name_he.lod2"]
+    assert all(len(name) <= MAX_LENGTH for name in names)
+
+def test_levels_shrink():
+    levels = simplify.lod_chain(grid_mesh("grid"), (0.5, 0.25))
+    assert [level.name for level, _ in levels] == ["grid", "grid.lod1",
+        "grid.lod2"]
+    counts = [level.polygon_count() for level, _ in levels]
+    assert counts == sorted(counts, reverse=True)
@@ -0,0 +1,57 @@
+import euclid3 as euclid
+import pytest
+
+import model.stripify as stripify
+from model.model import Model
+
+SIZE = 5
+
+def grid_faces(points_per_face):
+    """Build a SIZE by SIZE grid of quads, or of triangles splitting them,
+    with every corner of a vertex sent the same way."""
+    model = Model()
+    mesh = model.addMesh("grid")
+    for row in range(SIZE + 1):
+        for column in range(SIZE + 1):
+            mesh.addVertex(euclid.Vector3(column, 0.0, row))
+    corner = lambda vertex: (vertex % (SIZE + 1) / SIZE,
+        vertex // (SIZE + 1) / SIZE)
+    add = lambda vertices: mesh.addPolygon(vertices,
+        [corner(vertex) for vertex in vertices],
+        [(0.0, 1.0, 0.0)] * len(vertices))
+    for row in range(SIZE):
+        for column in range(SIZE):
+            a = row * (SIZE + 1) + column
+            b, c, d = a + 1, a + SIZE + 2, a + SIZE + 1
+            if points_per_face == 4:
+                add([a, b, c, d])
+            else:
+                add([a, b, c])
+                add([a, c, d])
+    return list(mesh.polygons)
+
+def canonical(vertices):
+    """Rotate a polygon's vertices to start at the lowest, keeping winding."""
+    start = vertices.index(min(vertices))
+    return tuple(vertices[start:] + vertices[:start])
+
+def strip_polygons(strip, points_per_face):
+    """Split a strip into the polygons the hardware draws from it."""
+    vertices = [face.vertices[corner] for face, corner in strip]
+    if points_per_face == 3:
+        return [[vertices[t], vertices[t + 1], vertices[t + 2]] if t % 2 == 0
+            else [vertices[t + 1], vertices[t], vertices[t + 2]]
+            for t in range(len(vertices) - 2)]
+    return [[vertices[q], vertices[q + 1], vertices[q + 3], vertices[q + 2]]
+        for q in range(0, len(vertices) - 2, 2)]
+
+@pytest.mark.parametrize("mode", stripify.MODES)
+@pytest.mark.parametrize("points_per_face", [3, 4])
+def test_strips_keep_every_face_and_its_winding(points_per_face, mode):
+    faces = grid_faces(points_per_face)
+    strips, singles = stripify.stripify(faces, points_per_face, mode)
+    assert strips
+    drawn = [canonical(polygon) for strip in strips
+        for polygon in strip_polygons(strip, points_per_face)]
+    drawn += [canonical(face.vertices) for face in singles]
+    assert sorted(drawn) == sorted(canonical(face.vertices) for face in faces)